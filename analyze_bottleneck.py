@@ -1,69 +1,92 @@
-import sqlite3
 import argparse
 import pandas as pd
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from tqdm import tqdm
-
-def analyze_gpu_data(gpu_id, database_path):
-    """Analyze kernel data for a given gpuId and return relevant statistics."""
-    conn = sqlite3.connect(database_path)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        SELECT SUM(duration) 
-        FROM kernel 
-        WHERE gpuId = ?
-    ''', (gpu_id,))
-    total_duration = cursor.fetchone()[0] or 0
-
-    cursor.execute('''
-        SELECT kernelName, 
-               SUM(duration) AS total_duration, 
-               COUNT(*) AS call_count,
-               AVG(duration) AS avg_duration
-        FROM kernel 
-        WHERE gpuId = ?
-        GROUP BY kernelName
-        ORDER BY total_duration DESC
-    ''', (gpu_id,))
-    rows = cursor.fetchall()
-    
+
+from kernel_summary import kernel_summary
+from kernel_categories import KernelClassifier, category_breakdown, category_percentages, load_op_phases
+from report_writer import FORMATS, ReportWriter, report_format
+from rpd_db import LOAD_BATCH_SIZE, connect_readonly, load_strings
+from straggler_analysis import load_straggler_tables
+
+KERNEL_INVOCATION_QUERY = ("SELECT B.gpuId, B.queueId, B.start, B.end, C.kernelName_id FROM rocpd_api_ops A "
+                           "JOIN rocpd_op B ON B.id = A.op_id JOIN rocpd_kernelapi C ON C.api_ptr_id = A.api_id")
+
+def load_kernel_stats(database_path, refresh=False):
+    """Per (gpuId, kernelName) totals for every GPU in the trace, from the cached kernel summary."""
+    return kernel_summary(database_path, refresh)[['gpuId', 'kernelName', 'total_duration', 'call_count', 'avg_duration']]
+
+def analyze_gpu_data(gpu_id, stats):
+    """Kernel statistics of one gpuId, taken from the (annotated) load_kernel_stats result."""
+    rows = stats[stats['gpuId'] == gpu_id]
+    total_duration = rows['total_duration'].sum()
+    df = rows.drop(columns='gpuId').sort_values('total_duration', ascending=False, kind='stable')
+    df.columns = ['Kernel Name', 'Total Duration', 'Call Count', 'Average Duration', 'Normalized Name', 'Category']
+    df['Percentage of Total Time'] = (df['Total Duration'] / total_duration * 100).round(2)
+    return (gpu_id, df.reset_index(drop=True), total_duration)
+
+def write_category_sheets(report, database_path, classifier):
+    """Time by kernel category per GPU and per UserMarker phase, as percentages of each row's total."""
+    conn = connect_readonly(database_path)
+    op_phases = load_op_phases(conn, load_strings(database_path, conn))
+    conn.close()
+    per_gpu, per_phase = category_breakdown(op_phases, classifier)
+    report.write_frame('Categories', category_percentages(per_gpu))
+    report.write_frame('Categories by Phase', category_percentages(per_phase))
+    print("Category breakdown written")
+
+def write_straggler_sheets(report, database_path, classifier):
+    """Arrival skew and collective waits per rank, per phase and per step, with collectives as sync points."""
+    steps, ranks, phases = load_straggler_tables(database_path, classifier)
+    if steps.empty:
+        print("No collective kernels found, skipping the straggler analysis")
+        return
+    report.write_frame('Stragglers', ranks)
+    report.write_frame('Straggler Phases', phases)
+    report.write_frame('Collective Steps', steps)
+    print("Straggler analysis written")
+
+def write_invocations(report, database_path, classifier):
+    """Every kernel invocation with its name and category, streamed from the database in batches."""
+    conn = connect_readonly(database_path)
+    strings = load_strings(database_path, conn)
+    rows = conn.execute("SELECT COUNT(*) FROM (%s)" % KERNEL_INVOCATION_QUERY).fetchone()[0]
+    table = report.table('Invocations', ['gpuId', 'queueId', 'Start', 'End', 'Duration', 'Kernel Name', 'Category'], rows)
+    cursor = conn.execute(KERNEL_INVOCATION_QUERY)
+    while True:
+        batch = cursor.fetchmany(LOAD_BATCH_SIZE)
+        if not batch:
+            break
+        table.write_rows((gpu_id, queue_id, start, end, end - start, strings[name_id], classifier.category(strings[name_id]))
+                         for gpu_id, queue_id, start, end, name_id in batch)
     conn.close()
+    print(f"{rows} kernel invocations written")
+
+def main(database_path, output_file, top_n=10, threshold=5, refresh_cache=False, categories=False, rule_files=(), stragglers=False,
+         invocations=False):
+    classifier = KernelClassifier(rule_files=rule_files)
+    stats = classifier.annotate(load_kernel_stats(database_path, refresh_cache))
+    gpu_ids = sorted(stats['gpuId'].unique().tolist())
+    print(f"Found {len(gpu_ids)} gpuIds: {gpu_ids}")
+    results = [analyze_gpu_data(gpu_id, stats) for gpu_id in gpu_ids]
 
-    if rows:
-        df = pd.DataFrame(rows, columns=['Kernel Name', 'Total Duration', 'Call Count', 'Average Duration'])
-        df['Percentage of Total Time'] = (df['Total Duration'] / total_duration * 100).round(2)
-        return (gpu_id, df, total_duration)
-    else:
-        return (gpu_id, None, 0)
-
-def main(database_path, output_file, top_n=10, threshold=5):
-    with ProcessPoolExecutor() as executor:
-        futures = {executor.submit(analyze_gpu_data, gpu_id, database_path): gpu_id for gpu_id in range(8)}
-        results = []
-        total_durations = {}
-
-        with tqdm(total=len(futures), desc="Processing gpuIds") as pbar:
-            for future in as_completed(futures):
-                gpu_id = futures[future]
-                result = future.result()
-                results.append(result)
-                total_durations[gpu_id] = result[2]
-                pbar.update(1)
-
-    results.sort(key=lambda x: x[0])
-
-    with pd.ExcelWriter(output_file) as writer:
+    with ReportWriter(output_file) as report:
         summary_data = []
 
         for gpu_id, df, total_duration in results:
-            if df is not None:
-                sheet_name = f'gpuId_{gpu_id}'
-                df.to_excel(writer, sheet_name=sheet_name, index=False)
-                print(f"{sheet_name} data written to Excel")
-                summary_data.append({'gpuId': gpu_id, 'Total Duration': total_duration})
-            else:
-                print(f"gpuId {gpu_id}: No data available")
+            sheet_name = f'gpuId_{gpu_id}'
+            report.write_frame(sheet_name, df)
+            print(f"{sheet_name} data written")
+            summary_data.append({'gpuId': gpu_id, 'Total Duration': total_duration})
+
+        if categories:
+            write_category_sheets(report, database_path, classifier)
+        if stragglers:
+            write_straggler_sheets(report, database_path, classifier)
+        if invocations:
+            write_invocations(report, database_path, classifier)
+
+        if not summary_data:
+            print("No kernel data available")
+            return
 
         summary_df = pd.DataFrame(summary_data)
         min_duration = summary_df['Total Duration'].min()
@@ -71,72 +94,55 @@ def main(database_path, output_file, top_n=10, threshold=5):
         print(f"Minimum gpuId: {min_gpu_id} with duration: {min_duration}")
 
         summary_df['Problematic'] = summary_df['Total Duration'].apply(lambda x: 'Yes' if (x - min_duration) / min_duration * 100 > threshold else 'No')
-        summary_df.to_excel(writer, sheet_name='Summary', index=False)
+        report.write_frame('Summary', summary_df)
 
-        start_row = len(summary_df) + 2
         problematic_gpu_ids = summary_df[summary_df['Problematic'] == 'Yes']['gpuId'].tolist()
         if problematic_gpu_ids:
             print(f"Reference gpuId: {min_gpu_id} with duration: {min_duration}")
 
-            conn = sqlite3.connect(database_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT kernelName, 
-                       SUM(duration) AS total_duration 
-                FROM kernel 
-                WHERE gpuId = ?
-                GROUP BY kernelName
-            ''', (min_gpu_id,))
-            min_kernel_data = cursor.fetchall()
-            conn.close()
-
-            if min_kernel_data:
-                min_kernel_df = pd.DataFrame(min_kernel_data, columns=['Kernel Name', 'Min Total Duration'])
-                comparison_data = []
-
-                for gpu_id in problematic_gpu_ids:
-                    conn = sqlite3.connect(database_path)
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        SELECT kernelName, 
-                               SUM(duration) AS total_duration 
-                        FROM kernel 
-                        WHERE gpuId = ?
-                        GROUP BY kernelName
-                    ''', (gpu_id,))
-                    kernel_data = cursor.fetchall()
-                    cursor.close()
-
-                    kernel_df = pd.DataFrame(kernel_data, columns=['Kernel Name', 'Problematic Total Duration'])
-                    comparison = min_kernel_df.merge(kernel_df, on='Kernel Name', how='outer').fillna(0)
-                    comparison['Difference'] = comparison['Problematic Total Duration'] - comparison['Min Total Duration']
-                    comparison['gpuId'] = gpu_id
-                    comparison_data.append(comparison)
-
-                all_comparisons = pd.concat(comparison_data)
-                top_diff_kernels = all_comparisons.sort_values(by='Difference', ascending=False).head(5)
-                top_diff_kernels.to_excel(writer, sheet_name='Summary', index=False, startrow=start_row)
-                print(f"Top differences written to {output_file}")
+            # Kernel x gpuId table of total durations; kernels a GPU never ran count as 0
+            totals = stats.pivot_table(index='kernelName', columns='gpuId', values='total_duration', aggfunc='sum', fill_value=0)
+            comparison_data = []
+            for gpu_id in problematic_gpu_ids:
+                comparison = pd.DataFrame({'Kernel Name': totals.index,
+                                           'Min Total Duration': totals[min_gpu_id].values,
+                                           'Problematic Total Duration': totals[gpu_id].values})
+                comparison['Difference'] = comparison['Problematic Total Duration'] - comparison['Min Total Duration']
+                comparison['gpuId'] = gpu_id
+                comparison_data.append(comparison)
+
+            all_comparisons = pd.concat(comparison_data)
+            top_diff_kernels = all_comparisons.sort_values(by='Difference', ascending=False).head(5)
+            table = report.write_frame('Top Differences', top_diff_kernels)
+            # A sheet of the workbook, or its own <stem>_Top_Differences file
+            print(f"Top differences written to {getattr(table, 'path', output_file)}")
 
 # Argument parsing
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Analyze kernel statistics for each gpuId from an SQLite database and export to an Excel file.")
+    parser = argparse.ArgumentParser(description="Analyze kernel statistics for each gpuId from an SQLite database and export to an Excel, CSV or Parquet report.")
     parser.add_argument("database_path", type=str, help="Path to the SQLite database file containing kernel data.")
-    parser.add_argument("output_file", type=str, help="Path for the output Excel file. Must have an .xlsx extension.")
+    parser.add_argument("output_file", type=str, help="Path for the report: .xlsx (one sheet per table), or .csv / .parquet (one <name>_<table> file per table).")
     parser.add_argument("--top_n", type=int, default=10, help="Number of top kernels to compare, default is 10.")
     parser.add_argument("--threshold", type=float, default=5, help="Percentage threshold to flag problematic kernel durations, default is 5.")
+    parser.add_argument("--refresh-cache", action="store_true", help="Rebuild the cached kernel summary of the database.")
+    parser.add_argument("--categories", action="store_true", help="Add sheets with the time by kernel category per GPU and per UserMarker phase.")
+    parser.add_argument("--stragglers", action="store_true", help="Add sheets lining up the collectives of all GPUs: arrival skew and time lost waiting per rank and step.")
+    parser.add_argument("--invocations", action="store_true", help="Also export every kernel invocation; in an .xlsx report this table goes to a columnar file if it exceeds a sheet.")
+    parser.add_argument("--rules", action="append", default=[], help="Kernel category rule file of 'category regex' lines, checked before the built-in rules (repeatable).")
     args = parser.parse_args()
 
-    # Check if output file extension is .xlsx; if not, prompt the user to correct it
-    if not args.output_file.endswith('.xlsx'):
-        print("Warning: Only .xlsx format is supported for output.")
+    # Check if the output file extension is a supported report format; if not, prompt the user to correct it
+    try:
+        report_format(args.output_file)
+    except ValueError:
+        print(f"Warning: Only {', '.join('.' + f for f in FORMATS)} formats are supported for output.")
         correct_extension = input(f"Do you want to change the output file extension to .xlsx? (y/n): ").strip().lower()
         if correct_extension == 'y':
             args.output_file = args.output_file.rsplit('.', 1)[0] + '.xlsx'
             print(f"Output file extension corrected to: {args.output_file}")
         else:
-            print("Error: Unsupported file extension. Please provide an output file with the .xlsx extension.")
+            print("Error: Unsupported file extension. Please provide an output file with a supported extension.")
             exit(1)
 
-    main(args.database_path, args.output_file, args.top_n, args.threshold)
+    main(args.database_path, args.output_file, args.top_n, args.threshold, args.refresh_cache, args.categories, args.rules, args.stragglers, args.invocations)
 
@@ -3,6 +3,8 @@ import subprocess
 import pandas as pd
 import argparse
 
+from kernel_summary import top_summary
+
 # Ensure the script exits on the first error encountered
 def run_command(command):
     result = subprocess.run(command, shell=True)
@@ -55,21 +57,11 @@ def run_benchmark(input_sizes, num_runs):
             trace_file = f"trace-{INPUT_SIZE}-run-{run+1}.rpd"
             os.rename("trace.rpd", trace_file)
 
-            # Define the sqlite command
-            SQLITE_CMD = (
-                f"sqlite3 {trace_file} '.mode csv' '.header on' '.output trace-{INPUT_SIZE}-run-{run+1}.csv' "
-                f"'select * from top;' '.output stdout'"
-            )
-
-            # Print the sqlite command to be executed
-            print(f"Executing: sqlite3 processing for {trace_file}")
-
-            # Execute the sqlite command
-            run_command(SQLITE_CMD)
-
-            # Load the generated CSV file to filter and extract the required data
+            # Summarize the top view once into the trace's summary cache and keep a CSV copy
+            print(f"Summarizing kernels of {trace_file}")
+            df = top_summary(trace_file)
             csv_file = f"trace-{INPUT_SIZE}-run-{run+1}.csv"
-            df = pd.read_csv(csv_file)
+            df.to_csv(csv_file, index=False)
 
             # Filter Name column containing keyword
             filtered_df = df[df['Name'].str.contains('FmhaBatchPrefillWithPagedKVCacheKernel', na=False)]
@@ -0,0 +1,342 @@
+#
+# Critical path and what-if speedup estimation for multi-GPU rpd traces
+#
+# The trace is modeled as one chain of ops per (gpuId, queueId).  On a chain an
+# op starts after the op before it, plus the idle gap seen in the trace (launch
+# overhead is kept as is).  The chain of each GPU that runs its collectives is
+# tied to the other GPUs at every collective: the k-th collective of all GPUs
+# completes its own transfer time after the last rank arrived, as in
+# straggler_analysis.py.  Between two sync points a chain is a cumulative sum,
+# so re-running the schedule is one loop over the sync points with numpy work
+# across ranks.
+#
+# The critical path through sync point k always comes from its last arrival,
+# so it is the last-arriving rank's ops between consecutive sync points plus
+# the transfer part of each collective; the time ranks spend waiting inside a
+# collective is never on it.  What-if queries scale the busy time of ops whose
+# kernel name or category matches a regex and re-run the schedule.
+#
+
+import re
+import argparse
+import numpy as np
+import pandas as pd
+
+from rpd_db import connect_readonly, load_strings
+from kernel_categories import KernelClassifier, NO_PHASE, load_ops
+from report_writer import ReportWriter
+
+
+def parse_scale(spec):
+    """(regex, factor) of a "REGEX=FACTOR" what-if argument."""
+    pattern, sep, factor = spec.rpartition("=")
+    if not sep or not pattern:
+        raise ValueError(f"expected REGEX=FACTOR, got {spec!r}")
+    return re.compile(pattern, re.IGNORECASE), float(factor)
+
+
+def scale_matches(pattern, name, kernel, category):
+    """Whether a what-if regex selects an op: found in its raw or normalized kernel name, or equal to its category."""
+    return bool(pattern.search(name) or pattern.search(kernel) or pattern.fullmatch(category))
+
+
+def unmatched_scales(ops, scales):
+    """The regexes of [(regex, factor)] that select none of ops."""
+    kinds = list(ops[["name", "normalizedName", "category"]].drop_duplicates().itertuples(index=False, name=None))
+    return [pattern.pattern for pattern, _ in scales if not any(scale_matches(pattern, *kind) for kind in kinds)]
+
+
+class ScheduleModel:
+    """
+    The ops of a trace as chains with the observed gaps and busy times, ready to
+    be re-scheduled with scaled kernels.  ops is a DataFrame with gpuId, queueId,
+    start, end, name and category (see load_schedule).
+    """
+
+    def __init__(self, ops):
+        ops = ops.sort_values(["gpuId", "queueId", "start"], kind="stable").reset_index(drop=True)
+        self.ops = ops
+        gpu, queue = ops["gpuId"].to_numpy(), ops["queueId"].to_numpy()
+        chain_keys, self.chain = np.unique(np.stack([gpu, queue], axis=1), axis=0, return_inverse=True)
+        self.chain = self.chain.reshape(-1)
+        self.chain_keys = [tuple(key) for key in chain_keys.tolist()]
+        chains = len(self.chain_keys)
+        first = np.r_[True, self.chain[1:] != self.chain[:-1]]
+
+        # Split the progress of each chain (running max of end) into an idle gap and busy time per op
+        start, end = ops["start"].to_numpy(np.int64), ops["end"].to_numpy(np.int64)
+        reach = pd.Series(end).groupby(self.chain).cummax().to_numpy()
+        previous = np.where(first, start, np.r_[0, reach[:-1]])
+        self.gap = np.maximum(start - previous, 0)
+        self.busy = reach - np.maximum(start, previous)
+        self.origin = start[first]
+
+        # Per GPU, the chain holding most of its collectives carries the sync points; without
+        # collectives the chain with most ops is the main one the other chains wait for
+        collective = (ops["category"] == "collective").to_numpy()
+        sync_chain_of_gpu = {}
+        for gpu_id in np.unique(gpu):
+            counts = np.bincount(self.chain[collective & (gpu == gpu_id)], minlength=chains)
+            if not counts.any():
+                counts = np.bincount(self.chain[gpu == gpu_id], minlength=chains)
+            sync_chain_of_gpu[gpu_id] = int(counts.argmax())
+        self.sync_chains = np.array(sorted(sync_chain_of_gpu.values()), dtype=np.int64)
+        self.on_sync_chain = np.isin(self.chain, self.sync_chains)
+        candidates = collective & self.on_sync_chain
+        # The k-th collective of every sync chain is sync point k; chains are cut to the common count
+        ordinal = pd.Series(candidates.astype(np.int64)).groupby(self.chain).cumsum().to_numpy() - 1
+        counts = np.bincount(self.chain[candidates], minlength=chains)[self.sync_chains]
+        self.syncs = int(counts.min()) if len(counts) > 1 else 0
+        if len(counts) > 1 and counts.max() != self.syncs:
+            print(f"Warning: collective counts differ between GPUs ({counts.tolist()}), syncing on the first {self.syncs}")
+        self.is_sync = candidates & (ordinal < self.syncs)
+        # Segment k of a sync chain holds its ops after sync point k-1 up to and including sync point k
+        self.segment = np.where(self.on_sync_chain, np.minimum(ordinal + 1, self.syncs), 0)
+        self.segment[self.is_sync] = ordinal[self.is_sync]
+        self.row = np.full(chains, -1, dtype=np.int64)
+        self.row[self.sync_chains] = np.arange(len(self.sync_chains))
+
+        # Transfer time of each sync point: its end after the last rank arrived
+        self.sync_index = np.flatnonzero(self.is_sync)
+        arrival = np.zeros((len(self.sync_chains), self.syncs), dtype=np.int64)
+        finish = np.zeros_like(arrival)
+        rows, columns = self.row[self.chain[self.sync_index]], self.segment[self.sync_index]
+        arrival[rows, columns] = start[self.sync_index]
+        finish[rows, columns] = reach[self.sync_index]
+        if self.syncs:
+            self.transfer = np.maximum(finish - arrival.max(axis=0), 0)
+        else:
+            # No sync points (single GPU, no collectives): the chains run on their own
+            self.transfer = np.zeros((len(self.sync_chains), 0), dtype=np.int64)
+
+        # The other chains of a GPU (copies, side streams) wait for the last op of its sync chain
+        # that had finished when they started, with the observed lag
+        self.anchor = np.full(len(ops), -1, dtype=np.int64)
+        for gpu_id, sync_chain in sync_chain_of_gpu.items():
+            sync_ops = np.flatnonzero(self.chain == sync_chain)
+            others = np.flatnonzero((gpu == gpu_id) & ~self.on_sync_chain)
+            before = np.searchsorted(reach[sync_ops], start[others], side="right") - 1
+            self.anchor[others[before >= 0]] = sync_ops[before[before >= 0]]
+        anchored = self.anchor >= 0
+        self.lag = np.zeros(len(ops), dtype=np.int64)
+        self.lag[anchored] = start[anchored] - reach[self.anchor[anchored]]
+        # Their idle gaps follow from the anchor, not from the previous op on the chain
+        self.gap[anchored] = 0
+
+    def factors(self, scales=()):
+        """Busy-time factor of every op for [(regex, factor)], the first matching regex wins (see scale_matches)."""
+        kinds = pd.MultiIndex.from_frame(self.ops[["name", "normalizedName", "category"]])
+        codes, uniques = pd.factorize(kinds)
+        factor = np.ones(len(uniques))
+        for i, kind in enumerate(uniques):
+            for pattern, scale in scales:
+                if scale_matches(pattern, *kind):
+                    factor[i] = scale
+                    break
+        return factor[codes]
+
+    def simulate(self, scales=()):
+        """
+        Re-run the schedule with scaled kernels.  Returns (start, end, critical)
+        per op, critical being the op's time (ns) on the critical path.
+        """
+        factor = self.factors(scales)
+        busy = self.busy * factor
+        step = self.gap + busy
+        chains = len(self.chain_keys)
+        segments = self.syncs + 1
+        sync = self.sync_index
+        sync_rows, sync_columns = self.row[self.chain[sync]], self.segment[sync]
+        # Time each (chain, segment) takes before its sync point, the sync point's own gap included
+        key = self.chain * segments + self.segment
+        lengths = np.bincount(key, weights=step - np.where(self.is_sync, busy, 0), minlength=chains * segments).reshape(chains, segments)
+        transfer = np.zeros(self.transfer.shape)
+        transfer[sync_rows, sync_columns] = self.transfer[sync_rows, sync_columns] * factor[sync]
+
+        base = np.zeros((chains, segments))
+        base[:, 0] = self.origin
+        arrival_rank = np.zeros(self.syncs, dtype=np.int64)
+        if self.syncs:
+            chain_end = self.origin[self.sync_chains].astype(np.float64)
+            for k in range(self.syncs):
+                ready = chain_end + lengths[self.sync_chains, k]
+                arrival_rank[k] = ready.argmax()
+                chain_end = ready.max() + transfer[:, k]
+                base[self.sync_chains, k + 1] = chain_end
+
+        # Op times from the segment base plus the running sum inside the segment
+        running = pd.Series(step).groupby(key).cumsum().to_numpy()
+        end = base[self.chain, self.segment] + running
+        end[sync] = base[self.chain[sync], sync_columns + 1]
+        # Anchored ops start at max(previous end + gap, anchor end + lag): with C the running
+        # sum of the chain, end - C is the running max of (anchor end + lag + busy - C)
+        anchored = self.anchor >= 0
+        free = ~self.on_sync_chain
+        slack = np.where(anchored, end[np.maximum(self.anchor, 0)] + self.lag + busy - running, -np.inf)
+        first = np.flatnonzero(np.r_[True, self.chain[1:] != self.chain[:-1]] & free & ~anchored)
+        slack[first] = self.origin[self.chain[first]]
+        shift = pd.Series(slack[free]).groupby(self.chain[free]).cummax().to_numpy()
+        end[free] = running[free] + shift
+        # The op where a chain last caught up with its anchor
+        binding = np.zeros(len(end), dtype=bool)
+        binding[free] = anchored[free] & (slack[free] >= shift)
+
+        start = end - busy
+        # A collective starts when its rank arrives; the rest of it is waiting and transfer
+        start[sync] = base[self.chain[sync], sync_columns] + lengths[self.chain[sync], sync_columns]
+        critical = self._critical_path(int(np.argmax(end)), step, busy, transfer, arrival_rank, binding)
+        return start, end, critical
+
+    def _critical_path(self, last, step, busy, transfer, arrival_rank, binding):
+        """Time (ns) of each op on the critical path ending at op last."""
+        critical = np.zeros(len(step))
+        index = np.arange(len(step))
+        chain = self.chain[last]
+        if not self.on_sync_chain[last]:
+            mine = (self.chain == chain) & (index <= last)
+            caught_up = np.flatnonzero(mine & binding)
+            if not len(caught_up):
+                critical[mine] = step[mine]
+                return critical
+            # Up to the op that waited for its anchor, then continue on the sync chain
+            catch = caught_up[-1]
+            critical[mine & (index > catch)] = step[mine & (index > catch)]
+            critical[catch] = self.lag[catch] + busy[catch]
+            last = self.anchor[catch]
+            chain = self.chain[last]
+        if not self.syncs:
+            mine = (self.chain == chain) & (index <= last)
+            critical[mine] = step[mine]
+            return critical
+
+        # Chain on the path in segment k: the arrival rank of sync point k, then the last op's chain
+        final = self.segment[last] + self.is_sync[last]
+        path = np.r_[self.sync_chains[arrival_rank[:final]], chain, -1]
+        segment = np.minimum(self.segment, final + 1)
+        on_path = self.on_sync_chain & (self.chain == path[segment]) & ((self.segment < final) | (index <= last))
+        regular = on_path & ~self.is_sync
+        critical[regular] = step[regular]
+        # A sync op contributes its gap on the arrival rank and its transfer on the chain after it
+        sync = self.sync_index
+        critical[sync] = np.where(on_path[sync], self.gap[sync], 0)
+        continues = self.chain[sync] == path[np.minimum(self.segment[sync] + 1, final + 1)]
+        critical[sync] += np.where(continues, transfer[self.row[self.chain[sync]], self.segment[sync]], 0)
+        return critical
+
+
+def load_schedule(rpd_path, classifier):
+    """The ops of an rpd file for ScheduleModel, with the forward step (UserMarker range) of each."""
+    connection = connect_readonly(rpd_path)
+    strings = load_strings(rpd_path, connection)
+    ops = load_ops(connection, strings, "o.queueId, o.start, o.end", keep_marker=True)
+    connection.close()
+    codes, name_ids = pd.factorize(ops["name_id"])
+    names = [strings[id] for id in name_ids.tolist()]
+    ops["name"] = np.array(names, dtype=object)[codes]
+    ops["normalizedName"] = np.array([classifier.normalize(name) for name in names], dtype=object)[codes]
+    ops["category"] = np.array([classifier.category(name) for name in names], dtype=object)[codes]
+    # Steps are numbered per GPU in marker order, so rank r's step s lines up with every other rank's
+    ops["step"] = -1
+    for gpu_id, group in ops[ops["marker"] >= 0].groupby("gpuId"):
+        ops.loc[group.index, "step"] = np.unique(group["marker"].to_numpy(), return_inverse=True)[1]
+    return ops.drop(columns=["name_id", "marker"])
+
+
+def step_table(ops, start, end, critical):
+    """
+    Per step: phase, wall time from the first start to the last end of the
+    step's ops on all GPUs, and the step's time on the critical path by category
+    (us).  The critical time includes the idle gap before the step's first op,
+    so it can exceed the wall time when the host launches steps late.
+    """
+    frame = pd.DataFrame({"step": ops["step"], "phase": ops["phase"], "start": start, "end": end, "critical": critical,
+                          "category": ops["category"], "kernel": ops["normalizedName"]})
+    frame = frame[frame["step"] >= 0]
+    grouped = frame.groupby("step")
+    steps = grouped.agg(phase=("phase", "first"), first=("start", "min"), last=("end", "max"), critical_us=("critical", "sum"))
+    steps["wall_us"] = (steps.pop("last") - steps.pop("first")) / 1000
+    steps["critical_us"] /= 1000
+    by_category = frame.pivot_table(index="step", columns="category", values="critical", aggfunc="sum", fill_value=0) / 1000
+    steps = steps.join(by_category.add_prefix("critical_").add_suffix("_us"))
+    kernels = frame.groupby(["step", "kernel"])["critical"].sum()
+    steps["top_critical_kernel"] = kernels.groupby(level="step").idxmax().map(lambda key: key[1])
+    return steps.reset_index()
+
+
+def critical_path_tables(ops, scales=()):
+    """
+    (summary, steps, kernels) of the baseline schedule and, when scales are
+    given, of the what-if schedule: makespan, per-step wall and critical time and
+    the kernels on the critical path ranked by their time on it.  Times in us.
+    """
+    model = ScheduleModel(ops)
+    observed_us = (ops["end"].max() - ops["start"].min()) / 1000
+    start, end, critical = model.simulate()
+    steps = step_table(model.ops, start, end, critical)
+    kernels = pd.DataFrame({"kernel": model.ops["normalizedName"], "category": model.ops["category"], "critical": critical})
+    kernels = kernels.groupby(["category", "kernel"])["critical"].sum()
+    kernels = (kernels[kernels > 0] / 1000).rename("critical_us").sort_values(ascending=False).reset_index()
+    kernels["critical_pct"] = (kernels["critical_us"] / kernels["critical_us"].sum() * 100).round(2)
+
+    makespan_us = (end.max() - start.min()) / 1000
+    summary = [{"schedule": "observed", "makespan_us": observed_us, "critical_us": None, "speedup": None},
+               {"schedule": "baseline", "makespan_us": makespan_us, "critical_us": critical.sum() / 1000, "speedup": 1.0}]
+    if scales:
+        what_start, what_end, what_critical = model.simulate(scales)
+        what_us = (what_end.max() - what_start.min()) / 1000
+        summary.append({"schedule": "what-if " + " ".join(f"{p.pattern}={f:g}" for p, f in scales), "makespan_us": what_us,
+                        "critical_us": what_critical.sum() / 1000, "speedup": round(makespan_us / what_us, 4)})
+        what_steps = step_table(model.ops, what_start, what_end, what_critical).set_index("step")
+        steps["whatif_wall_us"] = steps["step"].map(what_steps["wall_us"])
+        steps["whatif_critical_us"] = steps["step"].map(what_steps["critical_us"])
+        steps["speedup"] = (steps["wall_us"] / steps["whatif_wall_us"]).round(4)
+    return pd.DataFrame(summary), steps, kernels
+
+
+def phase_table(steps):
+    """Mean step wall and critical time per phase, with the what-if speedup when present."""
+    columns = [c for c in ("wall_us", "critical_us", "whatif_wall_us") if c in steps.columns]
+    phases = steps.groupby("phase")[columns].mean()
+    phases.insert(0, "steps", steps.groupby("phase").size())
+    if "whatif_wall_us" in phases.columns:
+        phases["speedup"] = (phases["wall_us"] / phases["whatif_wall_us"]).round(4)
+    return phases.reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute the critical path of each forward step of a multi-GPU rpd trace and estimate what-if speedups.")
+    parser.add_argument("input_rpd", help="The .rpd file to analyze.")
+    parser.add_argument("--scale", action="append", default=[], metavar="REGEX=FACTOR",
+                        help="Scale the busy time of ops whose raw or normalized kernel name matches REGEX, or whose category is REGEX, by FACTOR, "
+                             "e.g. 'gemm=0.8' (category) or 'Cijk_=0.8' (hipBLASLt kernels) (repeatable, first match wins).")
+    parser.add_argument("--rules", action="append", default=[], help="Kernel category rule file; 'collective' kernels are the sync points (repeatable).")
+    parser.add_argument("--top", type=int, default=15, help="Number of critical-path kernels to print (default: %(default)s).")
+    parser.add_argument("--output", type=str, help="Write the tables to this report (.xlsx, .csv or .parquet).")
+    args = parser.parse_args()
+
+    try:
+        scales = [parse_scale(spec) for spec in args.scale]
+    except (ValueError, re.error) as e:
+        parser.error(str(e))
+    ops = load_schedule(args.input_rpd, KernelClassifier(rule_files=args.rules))
+    if ops.empty:
+        raise SystemExit("The trace has no ops.")
+    unmatched = unmatched_scales(ops, scales)
+    if unmatched:
+        raise SystemExit(f"--scale pattern(s) match no kernel name or category: {', '.join(unmatched)}")
+    summary, steps, kernels = critical_path_tables(ops, scales)
+    phases = phase_table(steps[steps["phase"] != NO_PHASE]) if len(steps) else pd.DataFrame()
+    with pd.option_context("display.width", 220, "display.max_columns", 20, "display.max_colwidth", 60):
+        print(summary.to_string(index=False))
+        if len(phases):
+            print("\nPer phase (mean per step):")
+            print(phases.to_string(index=False))
+        print(f"\nTop {args.top} kernels on the critical path:")
+        print(kernels.head(args.top).to_string(index=False))
+    if args.output:
+        with ReportWriter(args.output) as report:
+            report.write_frame("Critical Summary", summary)
+            report.write_frame("Critical Phases", phases)
+            report.write_frame("Critical Steps", steps)
+            report.write_frame("Critical Kernels", kernels)
+        print(f"Critical path written to {args.output}")
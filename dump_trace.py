@@ -1,136 +1,102 @@
-import sys
 import os
-import re
-import sqlite3
 import json
 import argparse
-import tarfile
 from tqdm import tqdm
 
-def rpd_to_trace_events(rpd_filename, start_time=None, end_time=None):
-    """
-    Parses .rpd file and extracts trace events in a format suitable for JSON output.
-    """
-    connection = sqlite3.connect(rpd_filename)
-    trace_data = {"traceEvents": []}
+from rpd_db import connect_readonly, ensure_start_indexes, find_start_index, load_strings, parse_time
+from trace_archive import COMPRESSIONS, ChunkWriter, manifest_path, write_keyed_chunks, write_manifest, write_trace_chunks
 
-    rangeStringApi = ""
-    rangeStringOp = ""
-    rangeStringMonitor = ""
-    
-    min_time = connection.execute("SELECT MIN(start) FROM rocpd_api;").fetchall()[0][0]
-    max_time = connection.execute("SELECT MAX(end) FROM rocpd_api;").fetchall()[0][0]
-    if min_time is None:
-        raise Exception("Trace file is empty.")
+# Rows fetched per keyset page
+PAGE_SIZE = 100000
 
-    if start_time is not None:
-        rangeStringApi = f"WHERE rocpd_api.start >= {start_time * 1000}"
-        rangeStringOp = f"WHERE rocpd_op.start >= {start_time * 1000}"
-        rangeStringMonitor = f"WHERE start >= {start_time * 1000}"
-    if end_time is not None:
-        rangeStringApi += f" AND rocpd_api.start <= {end_time * 1000}"
-        rangeStringOp += f" AND rocpd_op.start <= {end_time * 1000}"
-        rangeStringMonitor += f" AND start <= {end_time * 1000}"
+# Default chunk budget in MB of JSON
+DEFAULT_CHUNK_MB = 2048
 
-    # Process GPU IDs
-    for row in connection.execute("SELECT DISTINCT gpuId FROM rocpd_op"):
-        trace_data["traceEvents"].append({
-            "name": "process_name", "ph": "M", "pid": row[0], "args": {"name": f"GPU{row[0]}"}
-        })
-        trace_data["traceEvents"].append({
-            "name": "process_sort_index", "ph": "M", "pid": row[0], "args": {"sort_index": row[0] + 1000000}
-        })
+OP_EVENT = '{"pid":%d,"tid":%d,"name":%s,"ts":%d,"dur":%d,"ph":"X","args":{"desc":%s}}'
 
-    # Process threads in rocpd_api
+def trace_headers(connection):
+    """
+    Metadata events naming the GPU processes and the host threads, as JSON strings.
+    They are repeated at the top of every chunk.
+    """
+    headers = []
+    for row in connection.execute("SELECT DISTINCT gpuId FROM rocpd_op"):
+        headers.append(json.dumps({"name": "process_name", "ph": "M", "pid": row[0], "args": {"name": f"GPU{row[0]}"}}, separators=(',', ':')))
+        headers.append(json.dumps({"name": "process_sort_index", "ph": "M", "pid": row[0], "args": {"sort_index": row[0] + 1000000}}, separators=(',', ':')))
     for row in connection.execute("SELECT DISTINCT pid, tid FROM rocpd_api"):
-        trace_data["traceEvents"].extend([
-            {"name": "thread_name", "ph": "M", "pid": row[0], "tid": row[1], "args": {"name": f"Hip {row[1]}"}},
-            {"name": "thread_sort_index", "ph": "M", "pid": row[0], "tid": row[1], "args": {"sort_index": row[1] * 2}}
-        ])
-
-    # Add rocpd_op data entries
-    for row in connection.execute(
-        f"SELECT A.string as optype, B.string as description, gpuId, queueId, rocpd_op.start/1000, (rocpd_op.end - rocpd_op.start) / 1000 "
-        f"FROM rocpd_op INNER JOIN rocpd_string A ON A.id = rocpd_op.opType_id INNER JOIN rocpd_string B ON B.id = rocpd_op.description_id {rangeStringOp}"
-    ):
-        name = row[0] if not row[1] else row[1]
-        trace_data["traceEvents"].append({
-            "pid": row[2], "tid": row[3], "name": name, "ts": row[4], "dur": row[5], "ph": "X", "args": {"desc": row[0]}
-        })
-
-    connection.close()
-    return trace_data
-
-def calculate_default_chunks(input_filename):
-    file_size = os.path.getsize(input_filename)
-    max_chunk_size = 2 * (1024 ** 3)  # 2 GB
-    num_chunks = max(1, (file_size // max_chunk_size) + (1 if file_size % max_chunk_size > 0 else 0))
-    return num_chunks
-
-def split_trace_events(trace_data, input_filename, num_chunks):
-    trace_events = trace_data['traceEvents']
-    headers = [event for event in trace_events if 'ts' not in event]
-    trace_events = [event for event in trace_events if 'ts' in event]
-    trace_events.sort(key=lambda x: x['ts'])
+        headers.append(json.dumps({"name": "thread_name", "ph": "M", "pid": row[0], "tid": row[1], "args": {"name": f"Hip {row[1]}"}}, separators=(',', ':')))
+        headers.append(json.dumps({"name": "thread_sort_index", "ph": "M", "pid": row[0], "tid": row[1], "args": {"sort_index": row[1] * 2}}, separators=(',', ':')))
+    return headers
 
-    total_events = len(trace_events)
-    chunk_size = total_events // num_chunks
-    remainder = total_events % num_chunks
-    chunks = []
-    start = 0
-
-    for i in tqdm(range(num_chunks), desc="Splitting traceEvents", unit="chunk"):
-        end = start + chunk_size + (1 if i < remainder else 0)
-        chunks.append(trace_events[start:end])
-        start = end
-
-    output_files = []
-    for i, chunk in enumerate(tqdm(chunks, desc="Writing JSON files", unit="file")):
-        output_filename = f"{input_filename.split('.')[0]}_split_{i+1}.json"
-        with open(output_filename, 'w') as outfile:
-            outfile.write('{"traceEvents":[\n')
-            for header in headers:
-                outfile.write(json.dumps(header, separators=(',', ':')) + ',\n')
-            for j, event in enumerate(chunk):
-                json_line = json.dumps(event, separators=(',', ':'))
-                if j < len(chunk) - 1:
-                    json_line += ','
-                outfile.write(json_line + '\n')
-            outfile.write(']}')
-        output_files.append(output_filename)
-
-    tar_filename = f"{input_filename.split('.')[0]}_split.tar.gz"
-    with tarfile.open(tar_filename, 'w:gz') as tar:
-        for output_file in tqdm(output_files, desc="Creating tar.gz", unit="file"):
-            tar.add(output_file)
-    for output_file in output_files:
-        os.remove(output_file)
-
-    print(f"Splitting completed. The traceEvents have been compressed into {tar_filename}.")
+def iter_op_events(connection, strings, start_ns=None, end_ns=None, page_size=PAGE_SIZE):
+    """
+    Yields (ts, end, gpuId, queueId, json) for every op in start order, one keyset page at a time.
+    Each page resumes after the (start, id) of the last row of the previous page,
+    so with an index on rocpd_op(start) every page is a short range scan and only
+    one page is ever held in memory.
+    """
+    names, text = strings.json, strings.strings
+    upper = f" AND start <= {end_ns}" if end_ns is not None else ""
+    query = ("SELECT id, start, opType_id, description_id, gpuId, queueId, end - start FROM rocpd_op "
+             f"WHERE (start, id) > (?, ?){upper} ORDER BY start, id LIMIT {page_size}")
+    # id is never negative, so (start_ns, -1) selects start >= start_ns
+    last = (start_ns if start_ns is not None else -(1 << 62), -1)
+    while True:
+        rows = connection.execute(query, last).fetchall()
+        if not rows:
+            break
+        for id, start, optype, description, gpuId, queueId, dur in rows:
+            ts = start // 1000
+            yield ts, ts + dur // 1000, gpuId, queueId, OP_EVENT % (gpuId, queueId, names[description] if text[description] else names[optype], ts, dur // 1000, names[optype])
+        last = (rows[-1][1], rows[-1][0])
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert .rpd to traceEvents, split into chunks, and compress output.")
     parser.add_argument("input_rpd", help="The .rpd file containing traceEvents to be split.")
-    parser.add_argument("--num-chunks", type=int, help="Number of chunks to split the traceEvents into.")
-    parser.add_argument("--start", type=str, help="Start time in us or as a percentage (e.g., 50%)")
-    parser.add_argument("--end", type=str, help="End time in us or as a percentage (e.g., 50%)")
+    parser.add_argument("--chunk-size", type=float, default=DEFAULT_CHUNK_MB, help="Start a new chunk once a chunk reaches this many MB of JSON (default: %(default)s).")
+    parser.add_argument("--shard-duration", type=float, help="Cut the trace into fixed-duration time shards of this many seconds instead of by size.")
+    parser.add_argument("--shard-by", choices=["gpu", "queue"], help="Write one trace per GPU (or per GPU queue) covering the whole run, optionally cut by --shard-duration.")
+    parser.add_argument("--start", type=str, help="Start time in us or as a percentage (e.g., 50%%)")
+    parser.add_argument("--end", type=str, help="End time in us or as a percentage (e.g., 50%%)")
+    parser.add_argument("--create-index", action="store_true", help="Create an index on rocpd_op(start) if there is none, so every page is a range scan. Writes to the input rpd.")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Rows fetched per query (default: %(default)s).")
+    parser.add_argument("--compression", choices=COMPRESSIONS, default="gzip", help="Compression of each chunk (default: %(default)s).")
+    parser.add_argument("--compress-level", type=int, help="Compression level (default: 6 for gzip, 3 for zstd).")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Compression threads (default: %(default)s).")
+    parser.add_argument("--no-archive", action="store_true", help="Write each chunk to its own compressed file instead of one tar archive.")
     args = parser.parse_args()
 
-    min_time, max_time = None, None
-    if args.start:
-        start_time = int(args.start.strip('%')) / 100 * (max_time - min_time) + min_time if "%" in args.start else int(args.start)
-    else:
-        start_time = None
+    if args.create_index:
+        ensure_start_indexes(args.input_rpd)
 
-    if args.end:
-        end_time = int(args.end.strip('%')) / 100 * (max_time - min_time) + min_time if "%" in args.end else int(args.end)
-    else:
-        end_time = None
+    connection = connect_readonly(args.input_rpd)
+    if find_start_index(connection, "rocpd_op") is None:
+        print("Warning: rocpd_op has no start index, every page is a full scan. Use --create-index.")
 
-    trace_data = rpd_to_trace_events(args.input_rpd, start_time=start_time, end_time=end_time)
-    
-    if args.num_chunks is None:
-        args.num_chunks = calculate_default_chunks(args.input_rpd)
-    
-    split_trace_events(trace_data, args.input_rpd, args.num_chunks)
+    min_time, max_time = connection.execute("SELECT MIN(start), MAX(end) FROM rocpd_api").fetchone()
+    if min_time is None:
+        raise Exception("Trace file is empty.")
+    start_ns = int(parse_time(args.start, min_time, max_time) * 1000) if args.start else None
+    end_ns = int(parse_time(args.end, min_time, max_time) * 1000) if args.end else None
+
+    strings = load_strings(args.input_rpd, connection)
+    events = tqdm(iter_op_events(connection, strings, start_ns, end_ns, args.page_size), desc="Writing chunks", unit=" events", mininterval=1)
+    output_prefix = os.path.splitext(args.input_rpd)[0]
+    tar_filename = None if args.no_archive else f"{output_prefix}_split.tar"
+    sink = ChunkWriter(args.compression, args.compress_level, args.jobs, tar_filename)
+    shard_us = int(args.shard_duration * 1000000) if args.shard_duration else None
+    if args.shard_by:
+        chunks = write_keyed_chunks(trace_headers(connection), events, output_prefix, sink, by_tid=args.shard_by == "queue",
+                                    labels=("gpu", "queue"), shard_us=shard_us)
+    else:
+        chunks = write_trace_chunks(trace_headers(connection), events, output_prefix, sink,
+                                    chunk_bytes=int(args.chunk_size * 1024 ** 2), shard_us=shard_us)
+    infos = sink.close()
+    connection.close()
+    write_manifest(manifest_path(output_prefix), sink, chunks, infos, source=os.path.basename(args.input_rpd), shard_duration_us=shard_us, shard_by=args.shard_by)
 
+    raw_bytes = sum(info.raw_bytes for info in infos)
+    size = sum(info.size for info in infos)
+    print(f"Splitting completed. {len(infos)} chunks, {raw_bytes / 1024 ** 2:.1f} MB of JSON compressed to {size / 1024 ** 2:.1f} MB "
+          + (f"in {tar_filename}." if tar_filename else f"in {output_prefix}_*.json{sink.suffix}.")
+          + f" Manifest: {manifest_path(output_prefix)}")
@@ -0,0 +1,166 @@
+#
+# GPU utilization and compute/communication overlap of an rpd file
+#
+# The ops of each GPU are reduced to unions of busy intervals with one sorted
+# sweep: after sorting by start, an op opens a new interval when it starts
+# after the running maximum end of everything before it.  Unions are built for
+# all ops, for compute ops and for collectives (classified by the kernel
+# category rules), so
+#   busy %      = |all| / wall time
+#   overlap     = |compute| + |collective| - |compute or collective|
+#   bubbles     = gaps between the busy intervals
+# Per-window series come from the cumulative busy time of each union evaluated
+# at the window edges with searchsorted, so nothing loops over ops in Python.
+#
+
+import argparse
+import numpy as np
+import pandas as pd
+
+from rpd_db import connect_readonly, load_strings
+from kernel_categories import KernelClassifier
+from report_writer import ReportWriter
+
+# Default window of the time series, in us
+DEFAULT_WINDOW_US = 1000
+
+OP_COLUMNS = "SELECT queueId, start, end, description_id, opType_id FROM rocpd_op WHERE gpuId = ? AND end > start"
+
+
+def union_intervals(starts, ends):
+    """Sorted, disjoint (starts, ends) covering the union of the given intervals."""
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    opens = np.empty(len(starts), dtype=bool)
+    opens[0] = True
+    opens[1:] = starts[1:] > reach[:-1]
+    first = np.flatnonzero(opens)
+    last = np.r_[first[1:] - 1, len(starts) - 1]
+    return starts[first], reach[last]
+
+
+def covered_until(starts, ends, times):
+    """Busy time of the disjoint intervals before each of times."""
+    if len(starts) == 0:
+        return np.zeros(len(times), dtype=np.int64)
+    lengths = ends - starts
+    before = np.r_[0, np.cumsum(lengths)]
+    index = np.searchsorted(starts, times, side="right") - 1
+    inside = np.clip(times - starts[np.maximum(index, 0)], 0, lengths[np.maximum(index, 0)])
+    return np.where(index >= 0, before[np.maximum(index, 0)] + inside, 0)
+
+
+def name_categories(strings, classifier):
+    """Category codes per string id: 0 compute, 1 collective, 2 memcpy."""
+    codes = {"collective": 1, "memcpy": 2}
+    return np.array([codes.get(classifier.category(name), 0) for name in strings.strings], dtype=np.int8)
+
+
+def load_gpu_ops(connection, gpu_id, empty, categories):
+    """queueId, start, end (ns) and category code of every op of one GPU."""
+    ops = pd.read_sql_query(OP_COLUMNS, connection, params=(gpu_id,))
+    description = ops["description_id"].fillna(0).to_numpy(np.int64)
+    names = np.where(empty[description], ops["opType_id"].fillna(0).to_numpy(np.int64), description)
+    return ops["queueId"].to_numpy(), ops["start"].to_numpy(np.int64), ops["end"].to_numpy(np.int64), categories[names]
+
+
+def gpu_utilization(connection, strings, classifier, window_us=DEFAULT_WINDOW_US):
+    """
+    (gpus, queues, bubbles, series) tables: busy %, compute/collective/overlap
+    time and idle bubbles per GPU, busy % per queue, the bubble length
+    distribution and the per-window series.  Wall time is the span of all ops of
+    all GPUs.  Times in us.
+    """
+    gpu_ids = [row[0] for row in connection.execute("SELECT DISTINCT gpuId FROM rocpd_op ORDER BY gpuId")]
+    first, last = connection.execute("SELECT MIN(start), MAX(end) FROM rocpd_op WHERE end > start").fetchone()
+    if first is None:
+        return (pd.DataFrame(),) * 4
+    wall = last - first
+    window = int(window_us * 1000)
+    edges = np.arange(first, last + window, window, dtype=np.int64)
+    empty = np.array([not name for name in strings.strings], dtype=bool)
+    categories = name_categories(strings, classifier)
+
+    gpus, queues, bubbles, series = [], [], [], []
+    for gpu_id in gpu_ids:
+        queue, start, end, category = load_gpu_ops(connection, gpu_id, empty, categories)
+        busy = union_intervals(start, end)
+        compute = union_intervals(start[category == 0], end[category == 0])
+        collective = union_intervals(start[category == 1], end[category == 1])
+        either = union_intervals(start[category != 2], end[category != 2])
+        busy_ns, compute_ns, collective_ns = [int((e - s).sum()) for s, e in (busy, compute, collective)]
+        overlap_ns = compute_ns + collective_ns - int((either[1] - either[0]).sum())
+        # Idle gaps between busy intervals, ignoring the idle time before the first and after the last op
+        gaps = busy[0][1:] - busy[1][:-1]
+        gpus.append({
+            "gpuId": gpu_id,
+            "ops": len(start),
+            "wall_us": wall / 1000,
+            "busy_us": busy_ns / 1000,
+            "busy_pct": round(busy_ns / wall * 100, 2),
+            "compute_us": compute_ns / 1000,
+            "collective_us": collective_ns / 1000,
+            "overlap_us": overlap_ns / 1000,
+            "overlap_pct_of_collective": round(overlap_ns / collective_ns * 100, 2) if collective_ns else None,
+            "exposed_collective_us": (collective_ns - overlap_ns) / 1000,
+            "bubbles": len(gaps),
+            "bubble_us": gaps.sum() / 1000,
+            "max_bubble_us": gaps.max() / 1000 if len(gaps) else 0,
+        })
+        if len(gaps):
+            p50, p90, p99 = np.percentile(gaps, [50, 90, 99]) / 1000
+            bubbles.append({"gpuId": gpu_id, "p50_us": p50, "p90_us": p90, "p99_us": p99,
+                            "under_10us": int((gaps < 10000).sum()),
+                            "10_100us": int(((gaps >= 10000) & (gaps < 100000)).sum()),
+                            "over_100us": int((gaps >= 100000).sum())})
+        for queue_id in np.unique(queue):
+            mask = queue == queue_id
+            queue_busy = union_intervals(start[mask], end[mask])
+            queue_ns = int((queue_busy[1] - queue_busy[0]).sum())
+            queues.append({"gpuId": gpu_id, "queueId": int(queue_id), "ops": int(mask.sum()), "busy_us": queue_ns / 1000,
+                           "busy_pct": round(queue_ns / wall * 100, 2)})
+
+        per_window = {}
+        for name, (s, e) in (("busy", busy), ("compute", compute), ("collective", collective), ("either", either)):
+            per_window[name] = np.diff(covered_until(s, e, edges))
+        widths = np.diff(np.minimum(edges, last))
+        widths = np.where(widths > 0, widths, 1)
+        overlap = per_window["compute"] + per_window["collective"] - per_window["either"]
+        series.append(pd.DataFrame({
+            "gpuId": gpu_id,
+            "window_start_us": edges[:-1] / 1000,
+            "busy_pct": np.round(per_window["busy"] / widths * 100, 2),
+            "compute_pct": np.round(per_window["compute"] / widths * 100, 2),
+            "collective_pct": np.round(per_window["collective"] / widths * 100, 2),
+            "overlap_pct": np.round(overlap / widths * 100, 2),
+        }))
+    return pd.DataFrame(gpus), pd.DataFrame(queues), pd.DataFrame(bubbles), pd.concat(series, ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report GPU busy time, idle bubbles and compute/collective overlap per GPU, queue and time window.")
+    parser.add_argument("input_rpd", help="The .rpd file to analyze.")
+    parser.add_argument("--window", type=float, default=DEFAULT_WINDOW_US, help="Window of the time series in us (default: %(default)s).")
+    parser.add_argument("--rules", action="append", default=[], help="Kernel category rule file; 'collective' kernels count as communication, 'memcpy' ops as neither (repeatable).")
+    parser.add_argument("--output", type=str, help="Write the tables to this report (.xlsx, .csv or .parquet).")
+    args = parser.parse_args()
+
+    connection = connect_readonly(args.input_rpd)
+    gpus, queues, bubbles, series = gpu_utilization(connection, load_strings(args.input_rpd, connection), KernelClassifier(rule_files=args.rules), args.window)
+    connection.close()
+    if gpus.empty:
+        raise SystemExit("The trace has no ops.")
+    with pd.option_context("display.width", 220, "display.max_columns", 20):
+        print(gpus.to_string(index=False))
+        print()
+        print(bubbles.to_string(index=False))
+    if args.output:
+        with ReportWriter(args.output) as report:
+            report.write_frame("Utilization", gpus)
+            report.write_frame("Queues", queues)
+            report.write_frame("Bubbles", bubbles)
+            report.write_frame("Windows", series)
+        print(f"Utilization written to {args.output}")
@@ -0,0 +1,178 @@
+#
+# HIP/CUDA graph replay analysis of an rpd file
+#
+# Each hipGraphLaunch in rocpd_graphLaunchapi is one replay of its graphExec,
+# and rocpd_api_ops links it to the kernels it ran.  A replay on one GPU spans
+# its first kernel start to its last kernel end; the time inside it not covered
+# by any kernel is the intra-graph gap.  Kernels of a graph are compared with
+# the same (normalized) kernels launched eagerly in the same UserMarker phase,
+# e.g. decode batches above --cuda-graph-max-bs, and whole graph steps with
+# eager steps of the same phase.
+#
+
+import argparse
+import numpy as np
+import pandas as pd
+
+from rpd_db import connect_readonly, load_strings
+from kernel_categories import KernelClassifier, load_ops
+from report_writer import ReportWriter
+
+GRAPH_LAUNCH_QUERY = "SELECT api_ptr_id AS api_id, graphExec FROM rocpd_graphLaunchapi"
+
+
+def load_graph_ops(rpd_path, classifier):
+    """
+    Every op with gpuId, queueId, start, end, phase, marker, api_id, kernel
+    (normalized name), category and the graphExec that launched it (None for
+    eager launches).
+    """
+    connection = connect_readonly(rpd_path)
+    strings = load_strings(rpd_path, connection)
+    ops = load_ops(connection, strings, "o.queueId, o.start, o.end, ao.api_id", keep_marker=True)
+    try:
+        launches = pd.read_sql_query(GRAPH_LAUNCH_QUERY, connection)
+    except pd.errors.DatabaseError:
+        # Traces recorded before graph launches were captured have no such table
+        launches = pd.DataFrame(columns=["api_id", "graphExec"])
+    connection.close()
+    codes, name_ids = pd.factorize(ops["name_id"])
+    names = [strings[id] for id in name_ids.tolist()]
+    ops["kernel"] = np.array([classifier.normalize(name) for name in names], dtype=object)[codes]
+    ops["category"] = np.array([classifier.category(name) for name in names], dtype=object)[codes]
+    graph_of_api = pd.Series(launches["graphExec"].to_numpy(), index=launches["api_id"].to_numpy())
+    ops["graphExec"] = ops["api_id"].map(graph_of_api)
+    return ops.drop(columns="name_id")
+
+
+def replay_table(graph_ops):
+    """
+    One row per replay (graph launch) and GPU: graphExec, phase, kernels, span,
+    start, kernel busy time (union) and intra-graph gap time, in us.
+    """
+    ops = graph_ops.sort_values(["api_id", "gpuId", "start"], kind="stable")
+    replay = ops.groupby(["api_id", "gpuId"], sort=False)
+    # Running max of end inside each replay; an idle gap opens where a kernel starts after it
+    reach = replay["end"].cummax().to_numpy()
+    same = np.r_[False, (ops["api_id"].to_numpy()[1:] == ops["api_id"].to_numpy()[:-1]) &
+                        (ops["gpuId"].to_numpy()[1:] == ops["gpuId"].to_numpy()[:-1])]
+    gap = np.where(same, np.maximum(ops["start"].to_numpy() - np.r_[0, reach[:-1]], 0), 0)
+    ops = ops.assign(gap=gap)
+    replays = ops.groupby(["api_id", "gpuId"], sort=False).agg(graphExec=("graphExec", "first"), phase=("phase", "first"),
+                                                                kernels=("start", "size"), first=("start", "min"),
+                                                                last=("end", "max"), gap=("gap", "sum"))
+    replays["span_us"] = (replays.pop("last") - replays["first"]) / 1000
+    replays["start_us"] = replays.pop("first") / 1000
+    replays["gap_us"] = replays.pop("gap") / 1000
+    replays["busy_us"] = replays["span_us"] - replays["gap_us"]
+    return replays.reset_index()
+
+
+def graph_summary(replays):
+    """Replay count and span distribution, kernels and intra-graph gap share per graphExec and GPU (us)."""
+    grouped = replays.groupby(["graphExec", "gpuId"])
+    summary = grouped.agg(replays=("span_us", "size"), kernels=("kernels", "median"), mean_us=("span_us", "mean"),
+                          std_us=("span_us", "std"), min_us=("span_us", "min"), max_us=("span_us", "max"),
+                          gap_us=("gap_us", "mean"))
+    spans = grouped["span_us"]
+    summary["p50_us"] = spans.quantile(0.5)
+    summary["p90_us"] = spans.quantile(0.9)
+    summary["p99_us"] = spans.quantile(0.99)
+    summary["gap_pct"] = (summary["gap_us"] / summary["mean_us"] * 100).round(2)
+    return summary.reset_index()
+
+
+def graph_composition(graph_ops, eager_ops, replays):
+    """
+    Per graphExec and kernel: calls per replay, time per replay and share of the
+    graph's kernel time, next to the mean duration of the same kernel launched
+    eagerly in the same phase (us).
+    """
+    graph = graph_ops.assign(duration=graph_ops["end"] - graph_ops["start"])
+    eager = eager_ops.assign(duration=eager_ops["end"] - eager_ops["start"])
+    composition = graph.groupby(["graphExec", "phase", "category", "kernel"])["duration"].agg(["size", "sum", "mean"])
+    composition.columns = ["calls", "total", "graph_mean"]
+    composition = composition.reset_index()
+    # Replays are counted per GPU, like the kernels
+    count = composition["graphExec"].map(replays.groupby("graphExec").size())
+    composition["calls_per_replay"] = composition["calls"] / count
+    composition["time_per_replay_us"] = composition["total"] / count / 1000
+    composition["pct_of_graph"] = (composition["total"] / composition.groupby("graphExec")["total"].transform("sum") * 100).round(2)
+    composition["graph_mean_us"] = composition.pop("graph_mean") / 1000
+
+    eager_stats = eager.groupby(["phase", "kernel"])["duration"].agg(["size", "mean"])
+    eager_stats.columns = ["eager_calls", "eager_mean"]
+    composition = composition.join(eager_stats, on=["phase", "kernel"])
+    composition["eager_calls"] = composition["eager_calls"].fillna(0).astype(np.int64)
+    composition["eager_mean_us"] = composition.pop("eager_mean") / 1000
+    composition["graph_vs_eager_pct"] = ((composition["graph_mean_us"] / composition["eager_mean_us"] - 1) * 100).round(2)
+    composition = composition.drop(columns="total").sort_values(["graphExec", "time_per_replay_us"], ascending=[True, False])
+    return composition.reset_index(drop=True)
+
+
+def step_comparison(ops):
+    """
+    Per phase, graph steps (UserMarker ranges that replayed a graph) against
+    eager steps: mean span, kernel busy time and idle time per step and GPU (us).
+    Copies and fills are left out, as graphs hold kernels only.
+    """
+    ops = ops[(ops["marker"] >= 0) & (ops["category"] != "memcpy")]
+    if ops.empty:
+        return pd.DataFrame()
+    ops = ops.sort_values(["gpuId", "marker", "start"], kind="stable")
+    key = ["gpuId", "marker"]
+    reach = ops.groupby(key, sort=False)["end"].cummax().to_numpy()
+    same = np.r_[False, (ops["gpuId"].to_numpy()[1:] == ops["gpuId"].to_numpy()[:-1]) &
+                        (ops["marker"].to_numpy()[1:] == ops["marker"].to_numpy()[:-1])]
+    ops = ops.assign(gap=np.where(same, np.maximum(ops["start"].to_numpy() - np.r_[0, reach[:-1]], 0), 0),
+                     graph=ops["graphExec"].notna())
+    steps = ops.groupby(key, sort=False).agg(phase=("phase", "first"), graph=("graph", "any"), kernels=("start", "size"),
+                                             first=("start", "min"), last=("end", "max"), gap=("gap", "sum"))
+    steps["span_us"] = (steps.pop("last") - steps.pop("first")) / 1000
+    steps["idle_us"] = steps.pop("gap") / 1000
+    steps["busy_us"] = steps["span_us"] - steps["idle_us"]
+    steps["mode"] = np.where(steps.pop("graph"), "graph", "eager")
+    comparison = steps.groupby(["phase", "mode"]).agg(steps=("span_us", "size"), kernels=("kernels", "mean"), span_us=("span_us", "mean"),
+                                                      busy_us=("busy_us", "mean"), idle_us=("idle_us", "mean"))
+    comparison["idle_pct"] = (comparison["idle_us"] / comparison["span_us"] * 100).round(2)
+    return comparison.reset_index()
+
+
+def graph_replay_tables(rpd_path, classifier=None):
+    """(replays, graphs, composition, steps) tables of an rpd file, or None without graph launches."""
+    ops = load_graph_ops(rpd_path, classifier or KernelClassifier())
+    in_graph = ops["graphExec"].notna()
+    if not in_graph.any():
+        return None
+    replays = replay_table(ops[in_graph])
+    eager = ops[~in_graph & (ops["category"] != "memcpy")]
+    return replays, graph_summary(replays), graph_composition(ops[in_graph], eager, replays), step_comparison(ops)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the replays of each HIP/CUDA graph: duration distribution, kernels, intra-graph gaps and the same kernels run eagerly.")
+    parser.add_argument("input_rpd", help="The .rpd file to analyze.")
+    parser.add_argument("--rules", action="append", default=[], help="Kernel category rule file, used for name normalization (repeatable).")
+    parser.add_argument("--top", type=int, default=10, help="Number of kernels to print per graph (default: %(default)s).")
+    parser.add_argument("--output", type=str, help="Write the tables, including every replay, to this report (.xlsx, .csv or .parquet).")
+    args = parser.parse_args()
+
+    tables = graph_replay_tables(args.input_rpd, KernelClassifier(rule_files=args.rules))
+    if tables is None:
+        raise SystemExit("No graph launches found (rocpd_graphLaunchapi is empty or missing).")
+    replays, graphs, composition, steps = tables
+    with pd.option_context("display.width", 220, "display.max_columns", 20, "display.max_colwidth", 50):
+        print("Replays per graph:")
+        print(graphs.to_string(index=False))
+        print("\nGraph vs eager steps:")
+        print(steps.to_string(index=False))
+        for graph_exec, kernels in composition.groupby("graphExec"):
+            print(f"\nGraph {graph_exec}, top {args.top} kernels:")
+            print(kernels.drop(columns="graphExec").head(args.top).to_string(index=False))
+    if args.output:
+        with ReportWriter(args.output) as report:
+            report.write_frame("Graphs", graphs)
+            report.write_frame("Graph Kernels", composition)
+            report.write_frame("Graph vs Eager Steps", steps)
+            report.write_frame("Graph Replays", replays)
+        print(f"Graph replays written to {args.output}")
@@ -0,0 +1,223 @@
+#
+# Kernel-name normalization and category breakdown of an rpd file
+#
+# Kernel names carry template arguments, tile configs and parameter lists, so
+# one logical op (an FMHA, a GEMM, an RCCL collective) is spread over many
+# distinct names.  Names are normalized and classified by an ordered list of
+# regex rules, first match wins.  Each distinct name is classified once, so a
+# trace with millions of ops costs one regex pass per unique string.
+#
+# Rule files hold one "category regex" pair per line ('#' starts a comment) and
+# take precedence over the built-in rules, in file order.  Matching is
+# case-insensitive and searches the raw (not normalized) name.
+#
+
+import re
+import argparse
+import numpy as np
+import pandas as pd
+
+from rpd_db import connect_readonly, load_strings
+
+CATEGORIES = ["attention", "gemm", "moe", "collective", "elementwise", "memcpy", "other"]
+
+# Ordered (category, regex) rules; more specific categories come first
+DEFAULT_RULES = [
+    ("collective", r"nccl|rccl|msccl|all_?reduce|all_?gather|reduce_?scatter|all_?to_?all|cross_device_reduce"),
+    ("memcpy", r"^Copy|memcpy|memset|^Fill|BufferCopy|CopyDeviceTo|CopyHostTo|Barrier"),
+    ("attention", r"fmha|flash|attention|attn|paged_?kv|mla_|decode_attention|prefill_attention"),
+    ("moe", r"moe|expert|topk|top_k_gating"),
+    ("gemm", r"gemm|Cijk_|matmul|wvSplitK|hipblaslt|rocblas|_mm_|bmm"),
+    ("elementwise", r"elementwise|vectorized|norm|act_and_mul|silu|gelu|rotary|rope|softmax|reduce_kernel|"
+                    r"copy_kernel|index|cat_|fill_kernel|quant|scatter|gather"),
+]
+
+UNCATEGORIZED = "other"
+NO_PHASE = "(none)"
+
+TEMPLATE_ARGS = re.compile(r"<[^<>]*>")
+TILE_CONFIG = re.compile(r"\d+(?:x\d+)+")
+
+
+def load_rules(path):
+    """(category, regex) rules from a rule file."""
+    rules = []
+    with open(path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                raise ValueError(f"{path}:{number}: expected 'category regex', got {line!r}")
+            rules.append((parts[0], parts[1]))
+    return rules
+
+
+def normalize_name(name):
+    """A kernel name without template arguments, parameter list and tile sizes."""
+    name = name.strip()
+    if name.startswith("void "):
+        name = name[5:]
+    while True:
+        stripped = TEMPLATE_ARGS.sub("", name)
+        if stripped == name:
+            break
+        name = stripped
+    name = name.split("(", 1)[0]
+    return TILE_CONFIG.sub("#", name).strip() or "(unnamed)"
+
+
+class KernelClassifier:
+    """Ordered regex rules mapping kernel names to categories, memoized per distinct name."""
+
+    def __init__(self, rules=None, rule_files=()):
+        rules = [rule for path in rule_files for rule in load_rules(path)] + list(rules if rules is not None else DEFAULT_RULES)
+        self.rules = [(category, re.compile(pattern, re.IGNORECASE)) for category, pattern in rules]
+        self._categories = {}
+        self._names = {}
+
+    def category(self, name):
+        category = self._categories.get(name)
+        if category is None:
+            category = next((category for category, pattern in self.rules if pattern.search(name)), UNCATEGORIZED)
+            self._categories[name] = category
+        return category
+
+    def normalize(self, name):
+        normalized = self._names.get(name)
+        if normalized is None:
+            normalized = self._names[name] = normalize_name(name)
+        return normalized
+
+    def annotate(self, df, column="kernelName"):
+        """Add 'normalizedName' and 'category' columns, classifying each distinct name once."""
+        codes, uniques = pd.factorize(df[column])
+        uniques = list(uniques)
+        df = df.copy()
+        df["normalizedName"] = np.array([self.normalize(name) for name in uniques], dtype=object)[codes]
+        df["category"] = np.array([self.category(name) for name in uniques], dtype=object)[codes]
+        return df
+
+
+def assign_phases(threads, times, markers):
+    """
+    Index into markers of the innermost UserMarker range enclosing each launch,
+    or -1.  threads are (pid, tid) codes shared with markers["thread"], times the
+    api start of each launch, markers a DataFrame with thread, start and end.
+    """
+    phases = np.full(len(times), -1, dtype=np.int64)
+    launches_by_thread = pd.Series(threads).groupby(threads).indices
+    for thread, group in markers.sort_values("start", kind="stable").groupby("thread"):
+        launches = launches_by_thread.get(thread)
+        if launches is None:
+            continue
+        index = group.index.to_numpy()
+        start, end = group["start"].to_numpy(), group["end"].to_numpy()
+        reach = np.maximum.accumulate(end)
+        t = times[launches]
+        candidate = np.searchsorted(start, t, side="right") - 1
+        valid = candidate >= 0
+        enclosed = valid.copy()
+        enclosed[valid] = end[candidate[valid]] >= t[valid]
+        phases[launches[enclosed]] = index[candidate[enclosed]]
+        # The latest marker ended before the launch, but an outer one may still be open
+        for i in np.nonzero(valid & ~enclosed)[0]:
+            j = candidate[i] - 1
+            while j >= 0 and reach[j] >= t[i]:
+                if end[j] >= t[i]:
+                    phases[launches[i]] = index[j]
+                    break
+                j -= 1
+    return phases
+
+
+def load_ops(connection, strings, columns="", keep_marker=False):
+    """
+    gpuId, name_id and phase of every op, plus the extra rocpd_op columns
+    ("o.start, o.end, ...").  The name is the op's description, or its op type
+    when that is empty (as in the top view); the phase is the label of the
+    innermost UserMarker range around the api call that launched it.  With
+    keep_marker, a marker column numbers that range (-1 outside any), in
+    UserMarker order.
+    """
+    ops = pd.read_sql_query("SELECT o.gpuId, o.description_id, o.opType_id, "
+                            f"{columns + ', ' if columns else ''}a.pid, a.tid, a.start AS launch FROM rocpd_op o "
+                            "LEFT JOIN rocpd_api_ops ao ON ao.op_id = o.id LEFT JOIN rocpd_api a ON a.id = ao.api_id", connection)
+    # Empty descriptions are resolved through the string table rather than a per-row join
+    empty = np.array([not name for name in strings.strings], dtype=bool)
+    description = ops.pop("description_id").fillna(0).to_numpy(np.int64)
+    op_type = ops.pop("opType_id").fillna(0).to_numpy(np.int64)
+    ops.insert(1, "name_id", np.where(empty[description], op_type, description))
+    markers = pd.read_sql_query("SELECT pid, tid, start, end, args_id FROM rocpd_api WHERE start != end AND "
+                                "apiName_id IN (SELECT id FROM rocpd_string WHERE string = 'UserMarker')", connection)
+    threads, thread_keys = pd.factorize(pd.MultiIndex.from_frame(pd.concat([ops[["pid", "tid"]], markers[["pid", "tid"]]]).fillna(-1)))
+    markers["thread"] = threads[len(ops):]
+    phases = assign_phases(threads[:len(ops)], ops["launch"].fillna(-1).to_numpy(), markers)
+    labels = np.array([strings[id] for id in markers["args_id"].tolist()] + [NO_PHASE], dtype=object)
+    ops["phase"] = labels[phases]
+    if keep_marker:
+        ops["marker"] = phases
+    return ops.drop(columns=["pid", "tid", "launch"])
+
+
+def load_op_phases(connection, strings):
+    """Per (gpuId, name, phase) total duration (ns) and count of every op, see load_ops."""
+    ops = load_ops(connection, strings, "o.end - o.start AS duration")
+    grouped = ops.groupby(["gpuId", "name_id", "phase"], sort=False)["duration"].agg(["sum", "count"]).reset_index()
+    grouped.columns = ["gpuId", "name_id", "phase", "total_duration", "call_count"]
+    grouped.insert(1, "kernelName", [strings[id] for id in grouped["name_id"].tolist()])
+    return grouped.drop(columns="name_id")
+
+
+def category_breakdown(op_phases, classifier):
+    """
+    Time by category per GPU and per (GPU, phase), from load_op_phases.
+    Returns (per_gpu, per_phase) DataFrames with one column per category plus
+    the total, in ns.
+    """
+    annotated = classifier.annotate(op_phases)
+    categories = [c for c in CATEGORIES if c in set(annotated["category"])]
+    categories += sorted(set(annotated["category"]) - set(categories))
+    per_phase = annotated.pivot_table(index=["gpuId", "phase"], columns="category", values="total_duration", aggfunc="sum", fill_value=0)
+    per_phase = per_phase.reindex(columns=categories, fill_value=0)
+    per_gpu = per_phase.groupby(level="gpuId").sum()
+    per_phase["total"] = per_phase.sum(axis=1)
+    per_gpu["total"] = per_gpu.sum(axis=1)
+    return per_gpu.reset_index(), per_phase.reset_index()
+
+
+def category_percentages(breakdown):
+    """The category columns of a category_breakdown table as a percentage of its total."""
+    result = breakdown.copy()
+    columns = [c for c in result.columns if c not in ("gpuId", "phase", "total")]
+    result[columns] = (result[columns].div(result["total"].where(result["total"] != 0), axis=0) * 100).round(2)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Break GPU time down by kernel category, per GPU and per UserMarker phase.")
+    parser.add_argument("input_rpd", help="The .rpd file to analyze.")
+    parser.add_argument("--rules", action="append", default=[], help="Rule file of 'category regex' lines, checked before the built-in rules (repeatable).")
+    parser.add_argument("--output", type=str, help="Write the per-phase breakdown (ns) to this CSV file.")
+    parser.add_argument("--names", action="store_true", help="Also list the normalized kernel names of each category.")
+    args = parser.parse_args()
+
+    classifier = KernelClassifier(rule_files=args.rules)
+    connection = connect_readonly(args.input_rpd)
+    op_phases = load_op_phases(connection, load_strings(args.input_rpd, connection))
+    connection.close()
+
+    per_gpu, per_phase = category_breakdown(op_phases, classifier)
+    with pd.option_context("display.width", 200, "display.max_columns", 20):
+        print("Time by category per GPU (%):")
+        print(category_percentages(per_gpu).to_string(index=False))
+        print("\nTime by category per GPU and phase (%):")
+        print(category_percentages(per_phase).to_string(index=False))
+        if args.names:
+            names = classifier.annotate(op_phases).groupby(["category", "normalizedName"])["total_duration"].sum()
+            print("\nNormalized names:")
+            print(names.sort_values(ascending=False).to_string())
+    if args.output:
+        per_phase.to_csv(args.output, index=False)
+        print(f"Per-phase breakdown written to {args.output}")
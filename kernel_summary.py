@@ -0,0 +1,194 @@
+#
+# Persisted kernel summaries of an rpd file
+#
+# Aggregating the kernel table of a multi-GB trace takes a full scan, and the
+# same immutable trace is usually analyzed many times.  The first call
+# for a summary materializes it into a sidecar sqlite file next to the trace
+# (<trace>.rpd.summary); later calls read it back as long as the trace's
+# size, mtime and sampled hash still match.  Each summary is built and cached
+# on its own, so a trace without a usable top view still gets kernel summaries.
+#
+
+import os
+import sys
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+from rpd_db import connect_readonly, load_strings
+
+# Bump when the summary tables change so old sidecars are rebuilt
+SUMMARY_VERSION = 1
+
+# Bytes hashed from the start and the end of the trace file
+HASH_SAMPLE_BYTES = 1024 ** 2
+
+PERCENTILES = (50, 90, 99)
+
+SUMMARY_COLUMNS = (["gpuId", "kernelName", "total_duration", "call_count", "avg_duration", "min_duration", "max_duration"]
+                   + [f"p{q}_duration" for q in PERCENTILES])
+
+# The kernel view without its string join; names are resolved from the StringTable
+KERNEL_QUERY = ("SELECT gpuId, kernelName_id, B.end - B.start FROM rocpd_api_ops A "
+                "JOIN rocpd_op B ON B.id = A.op_id JOIN rocpd_kernelapi C ON C.api_ptr_id = A.api_id")
+
+
+def summary_path(rpd_path):
+    return rpd_path + ".summary"
+
+
+def trace_key(rpd_path):
+    """(size, mtime_ns, hash) identifying the trace; the hash covers the size and the first and last MB."""
+    stat = os.stat(rpd_path)
+    digest = hashlib.sha1(str(stat.st_size).encode())
+    with open(rpd_path, 'rb') as f:
+        digest.update(f.read(HASH_SAMPLE_BYTES))
+        if stat.st_size > HASH_SAMPLE_BYTES:
+            f.seek(max(HASH_SAMPLE_BYTES, stat.st_size - HASH_SAMPLE_BYTES))
+            digest.update(f.read())
+    return {"version": str(SUMMARY_VERSION), "size": str(stat.st_size), "mtime_ns": str(stat.st_mtime_ns), "hash": digest.hexdigest()}
+
+
+def group_percentiles(groups, values, percentiles):
+    """
+    Per-group percentiles (numpy's linear interpolation) of values, in one sort.
+    groups are dense ids 0..n-1 and every group must be present.
+    Returns an array of shape (n, len(percentiles)).
+    """
+    order = np.lexsort((values, groups))
+    sorted_values = values[order].astype(np.float64)
+    counts = np.bincount(groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    result = np.empty((len(counts), len(percentiles)))
+    for i, q in enumerate(percentiles):
+        position = (counts - 1) * (q / 100.0)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        low, high = sorted_values[starts + lower], sorted_values[starts + upper]
+        result[:, i] = low + (high - low) * (position - lower)
+    return result
+
+
+def compute_kernel_summary(connection, strings):
+    """Per (gpuId, kernelName) sum/count/avg/min/max/percentiles of the kernel durations (ns)."""
+    rows = pd.read_sql_query(KERNEL_QUERY, connection)
+    if rows.empty:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+    rows.columns = ["gpuId", "name_id", "duration"]
+    # Group by name id first and merge ids that share a name afterwards
+    keys, groups = np.unique(rows["gpuId"].to_numpy() * len(strings) + rows["name_id"].to_numpy(), return_inverse=True)
+    groups = groups.reshape(-1)
+    durations = rows["duration"].to_numpy()
+    summary = pd.DataFrame({"gpuId": keys // len(strings), "kernelName": [strings[id] for id in (keys % len(strings)).tolist()]})
+    if summary.duplicated(["gpuId", "kernelName"]).any():
+        merged = summary.groupby(["gpuId", "kernelName"], sort=False).ngroup().to_numpy()
+        groups = merged[groups]
+        summary = summary.drop_duplicates(["gpuId", "kernelName"]).reset_index(drop=True)
+    summary["total_duration"] = np.bincount(groups, weights=durations).astype(np.int64)
+    summary["call_count"] = np.bincount(groups)
+    summary["avg_duration"] = summary["total_duration"] / summary["call_count"]
+    minimum = np.full(len(summary), np.iinfo(np.int64).max)
+    np.minimum.at(minimum, groups, durations)
+    maximum = np.full(len(summary), np.iinfo(np.int64).min)
+    np.maximum.at(maximum, groups, durations)
+    summary["min_duration"] = minimum
+    summary["max_duration"] = maximum
+    percentiles = group_percentiles(groups, durations, PERCENTILES)
+    for i, q in enumerate(PERCENTILES):
+        summary[f"p{q}_duration"] = percentiles[:, i]
+    return summary.sort_values(["gpuId", "total_duration"], ascending=[True, False], kind="stable").reset_index(drop=True)
+
+
+def compute_summary(rpd_path, table):
+    """One summary table ("kernel_summary" or "top_summary") of rpd_path."""
+    connection = connect_readonly(rpd_path)
+    try:
+        if table == "kernel_summary":
+            return compute_kernel_summary(connection, load_strings(rpd_path, connection))
+        return pd.read_sql_query("SELECT * FROM top", connection)
+    finally:
+        connection.close()
+
+
+def write_summaries(path, key, tables):
+    """Write the summary tables and the trace key to the sidecar at path."""
+    # Build next to the target and move it into place, so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        output = sqlite3.connect(tmp_path)
+        output.execute("CREATE TABLE meta(key TEXT PRIMARY KEY, value TEXT)")
+        output.executemany("INSERT INTO meta VALUES (?, ?)", key.items())
+        for name, table in tables.items():
+            table.to_sql(name, output, index=False)
+        output.commit()
+        output.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _read_cached(path, key):
+    """The cached tables by name if the sidecar matches the trace key, else {}."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        connection = connect_readonly(path)
+        try:
+            meta = dict(connection.execute("SELECT key, value FROM meta"))
+            if meta != key:
+                return {}
+            names = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'meta'")]
+            return {name: pd.read_sql_query(f"SELECT * FROM {name}", connection) for name in names}
+        finally:
+            connection.close()
+    except (sqlite3.DatabaseError, pd.errors.DatabaseError):
+        return {}
+
+
+def load_summary(rpd_path, table, refresh=False):
+    """
+    Read a summary table from the sidecar, building (or rebuilding) it when
+    missing or stale.  Other current tables of the sidecar are kept.
+    """
+    path = summary_path(rpd_path)
+    key = trace_key(rpd_path)
+    tables = {} if refresh else _read_cached(path, key)
+    if table in tables:
+        return tables[table]
+    tables[table] = compute_summary(rpd_path, table)
+    try:
+        write_summaries(path, key, tables)
+    except (OSError, sqlite3.OperationalError) as e:
+        # e.g. a read-only trace directory: the result is still returned, just not persisted
+        print(f"Warning: could not write {path} ({e}), kernel summaries are not cached.")
+    return tables[table]
+
+
+def kernel_summary(rpd_path, refresh=False):
+    """Per (gpuId, kernelName) duration statistics in ns, see SUMMARY_COLUMNS."""
+    return load_summary(rpd_path, "kernel_summary", refresh)
+
+
+def top_summary(rpd_path, refresh=False):
+    """The rows of the rpd's top view (Name, TotalCalls, TotalDuration_us, Ave_us, Percentage)."""
+    return load_summary(rpd_path, "top_summary", refresh)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build (or show) the cached kernel summaries of an rpd file.")
+    parser.add_argument("input_rpd", help="The .rpd file to summarize.")
+    parser.add_argument("--refresh", action="store_true", help="Rebuild the summaries even if the cache is current.")
+    parser.add_argument("--top", type=int, default=20, help="Number of kernels to print (default: %(default)s).")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input_rpd):
+        sys.exit(f"{args.input_rpd} not found")
+    summary = kernel_summary(args.input_rpd, args.refresh)
+    print(f"{len(summary)} (gpuId, kernelName) pairs cached in {summary_path(args.input_rpd)}")
+    with pd.option_context("display.width", 200, "display.max_colwidth", 60):
+        print(summary.sort_values("total_duration", ascending=False).head(args.top).to_string(index=False))
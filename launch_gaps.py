@@ -0,0 +1,117 @@
+#
+# Kernel launch-gap (GPU bubble) attribution per queue of an rpd file
+#
+# Ops of each (gpuId, queueId) run in order, so the idle gap before an op is
+# its start minus the latest end of everything before it on the queue.  Each
+# gap is linked through rocpd_api_ops to the host api call that launched the
+# op after it:
+#   host_us    part of the gap before that call returned, the GPU waited for the CPU
+#   device_us  the rest, the op was already enqueued (launch latency, dependencies)
+# Gaps are ranked by the (preceding, following) kernel pair, by UserMarker phase
+# and by launching api, all from one sort and a few vectorized group-bys.
+#
+
+import argparse
+import numpy as np
+import pandas as pd
+
+from rpd_db import connect_readonly, load_strings
+from kernel_categories import KernelClassifier, load_ops
+from report_writer import ReportWriter
+
+
+def load_queue_gaps(connection, strings, classifier, include_memcpy=False):
+    """
+    Every op that followed an idle gap on its queue: gpuId, queueId, phase, the
+    normalized names of the previous and next op, the launching api, and the gap
+    split into host and device time (ns).  Copies and fills ('memcpy' category)
+    are left out unless include_memcpy, as copy queues idle by design.
+    """
+    ops = load_ops(connection, strings, "o.queueId, o.start, o.end, a.end AS api_end, a.apiName_id")
+    codes, name_ids = pd.factorize(ops["name_id"])
+    if not include_memcpy:
+        copies = np.array([classifier.category(strings[id]) == "memcpy" for id in name_ids.tolist()], dtype=bool)
+        ops, codes = ops[~copies[codes]], codes[~copies[codes]]
+    order = np.lexsort((ops["start"].to_numpy(), ops["queueId"].to_numpy(), ops["gpuId"].to_numpy()))
+    ops, codes = ops.iloc[order].reset_index(drop=True), codes[order]
+    names = np.array([classifier.normalize(strings[id]) for id in name_ids.tolist()], dtype=object)[codes]
+
+    queue = ops.groupby(["gpuId", "queueId"], sort=False)
+    # Latest end on the queue before each op; overlapping ops on one queue do not leave a gap
+    reach = queue["end"].cummax().to_numpy()
+    # Position of the op that set that end, which is the one the gap follows
+    setter = np.where(ops["end"].to_numpy() == reach, np.arange(len(ops)), 0)
+    setter = pd.Series(setter).groupby([ops["gpuId"], ops["queueId"]], sort=False).cummax().to_numpy()
+    same_queue = np.r_[False, (ops["gpuId"].to_numpy()[1:] == ops["gpuId"].to_numpy()[:-1]) &
+                              (ops["queueId"].to_numpy()[1:] == ops["queueId"].to_numpy()[:-1])]
+    previous_reach = np.r_[0, reach[:-1]]
+    gap = np.where(same_queue, ops["start"].to_numpy() - previous_reach, 0)
+    api_end = ops["api_end"].fillna(0).to_numpy(np.int64)
+    host = np.clip(api_end - previous_reach, 0, np.maximum(gap, 0))
+
+    bubble = gap > 0
+    index = np.flatnonzero(bubble)
+    api_names = ops["apiName_id"].to_numpy()[index]
+    return pd.DataFrame({
+        "gpuId": ops["gpuId"].to_numpy()[index],
+        "queueId": ops["queueId"].to_numpy()[index],
+        "phase": ops["phase"].to_numpy()[index],
+        "previous": names[setter[index - 1]],
+        "next": names[index],
+        "api": [strings[int(id)] if id == id else "(no api)" for id in api_names.tolist()],
+        "gap": gap[index],
+        "host": host[index],
+    })
+
+
+def rank_gaps(gaps, keys):
+    """Gap count, total, mean, p90 and host share per keys, largest total first (us)."""
+    grouped = gaps.groupby(keys, sort=False)
+    table = grouped.agg(gaps=("gap", "size"), gap_us=("gap", "sum"), host_us=("host", "sum"))
+    table["mean_gap_us"] = table["gap_us"] / table["gaps"] / 1000
+    table["p90_gap_us"] = grouped["gap"].quantile(0.9) / 1000
+    table["gap_us"] /= 1000
+    table["host_us"] /= 1000
+    table["device_us"] = table["gap_us"] - table["host_us"]
+    table["host_pct"] = (table["host_us"] / table["gap_us"] * 100).round(2)
+    table["pct_of_all_gaps"] = (table["gap_us"] / table["gap_us"].sum() * 100).round(2)
+    return table.sort_values("gap_us", ascending=False).reset_index()
+
+
+def launch_gap_tables(rpd_path, classifier=None, include_memcpy=False):
+    """(queues, pairs, phases, apis) tables of the launch gaps of an rpd file."""
+    connection = connect_readonly(rpd_path)
+    gaps = load_queue_gaps(connection, load_strings(rpd_path, connection), classifier or KernelClassifier(), include_memcpy)
+    connection.close()
+    return (rank_gaps(gaps, ["gpuId", "queueId"]), rank_gaps(gaps, ["previous", "next"]),
+            rank_gaps(gaps, ["phase"]), rank_gaps(gaps, ["api"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Attribute the idle gaps between ops on each GPU queue to kernel pairs, phases and launching api calls.")
+    parser.add_argument("input_rpd", help="The .rpd file to analyze.")
+    parser.add_argument("--rules", action="append", default=[], help="Kernel category rule file, used for name normalization (repeatable).")
+    parser.add_argument("--include-memcpy", action="store_true", help="Also count the gaps between copies and fills.")
+    parser.add_argument("--top", type=int, default=20, help="Number of kernel pairs to print (default: %(default)s).")
+    parser.add_argument("--output", type=str, help="Write the tables to this report (.xlsx, .csv or .parquet).")
+    args = parser.parse_args()
+
+    queues, pairs, phases, apis = launch_gap_tables(args.input_rpd, KernelClassifier(rule_files=args.rules), args.include_memcpy)
+    if queues.empty:
+        raise SystemExit("No gaps between ops found.")
+    with pd.option_context("display.width", 220, "display.max_columns", 20, "display.max_colwidth", 40):
+        print("Per queue:")
+        print(queues.to_string(index=False))
+        print("\nPer phase:")
+        print(phases.to_string(index=False))
+        print("\nPer launching api:")
+        print(apis.to_string(index=False))
+        print(f"\nTop {args.top} kernel pairs:")
+        print(pairs.head(args.top).to_string(index=False))
+    if args.output:
+        with ReportWriter(args.output) as report:
+            report.write_frame("Gap Pairs", pairs)
+            report.write_frame("Gap Phases", phases)
+            report.write_frame("Gap Apis", apis)
+            report.write_frame("Gap Queues", queues)
+        print(f"Launch gaps written to {args.output}")
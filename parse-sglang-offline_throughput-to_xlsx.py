@@ -3,6 +3,8 @@ import re
 import pandas as pd
 import argparse
 
+from report_writer import ReportWriter
+
 def extract_log_data(log_file_path):
     """
     Extract benchmark result data from a log file.
@@ -67,7 +69,7 @@ def parse_filename(filename):
 
 def process_logs_to_excel(logs_directory, output_file):
     """
-    Process all log files in a directory and save the extracted data to an Excel file.
+    Process all log files in a directory and save the extracted data to an Excel (or CSV / Parquet) file.
     """
     log_files = [f for f in os.listdir(logs_directory) if f.endswith(".log")]
     all_data = []
@@ -94,8 +96,9 @@ def process_logs_to_excel(logs_directory, output_file):
     ]
     df = df[column_order]
     
-    # Save the DataFrame to an Excel file
-    df.to_excel(output_file, index=False)
+    # Save the DataFrame in the format of the output file's extension
+    with ReportWriter(output_file) as report:
+        report.write_frame(None, df)
     print(f"Data successfully saved to {output_file}")
 
 def main():
@@ -126,7 +129,7 @@ def main():
         "--output-file",
         type=str,
         required=True,
-        help="The name of the output Excel file (e.g., results.xlsx)."
+        help="The name of the output file (e.g., results.xlsx, results.csv or results.parquet)."
     )
     
     args = parser.parse_args()
@@ -1,9 +1,10 @@
 import re
 import os
-import csv
 import argparse
 from collections import defaultdict
 
+from report_writer import ReportWriter, dict_rows, report_format
+
 # Define regex patterns to match the required metrics
 prefill_pattern = r"Prefill\. latency:\s*([\d\.]+)\s*s,\s*throughput:\s*([\d\.]+)\s*token/s"
 decode_median_pattern = r"Decode\.  median latency:\s*([\d\.]+)\s*s,\s*median throughput:\s*([\d\.]+)\s*token/s"
@@ -98,7 +99,7 @@ def group_and_sort_data(data):
 
     return sorted_data
 
-# Save the extracted data to a CSV file
+# Save the extracted data to a CSV (or .xlsx / .parquet) file
 def save_to_csv(data, output_file):
     fieldnames = [
         'Company', 'GPU', 'Model', 'TP', 'Batch size', 'Input size', 'Output size', 'Benchmark number',
@@ -107,11 +108,9 @@ def save_to_csv(data, output_file):
         'Total latency (s)', 'Total throughput (token/s)'
     ]
 
-    with open(output_file, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.DictWriter(file, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in data:
-            writer.writerow({key: (value if value is not None else '') for key, value in row.items()})
+    with ReportWriter(output_file, report_format(output_file, default="csv")) as report:
+        table = report.table(None, fieldnames)
+        table.write_rows(dict_rows(data, fieldnames))
 
 # Main function to handle command-line arguments
 def main():
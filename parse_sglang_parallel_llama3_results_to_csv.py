@@ -1,10 +1,11 @@
 import os
-import csv
 import numpy as np
 from collections import defaultdict
 import re
 import sys
 
+from report_writer import ReportWriter, dict_rows, report_format
+
 # Calculate the Geometric Mean
 def geometric_mean(numbers):
     numbers = [x for x in numbers if x > 0]
@@ -63,7 +64,7 @@ def process_logs(log_folder):
 
     return results
 
-# Save to CSV, grouped by (Input size, Output size), then sorted by Batch size
+# Save to CSV (or .xlsx / .parquet), grouped by (Input size, Output size), then sorted by Batch size
 def save_to_csv(data, output_file):
     fieldnames = [
         'Batch size', 'Input size', 'Output size',
@@ -86,12 +87,10 @@ def save_to_csv(data, output_file):
         # Sort each group by Batch size in ascending order
         sorted_data.extend(sorted(grouped_data[key], key=lambda x: x['Batch size']))
 
-    # Write to CSV
-    with open(output_file, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.DictWriter(file, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in sorted_data:
-            writer.writerow({key: (value if value is not None else '') for key, value in row.items()})
+    # Write in the format of the output file's extension, CSV for any other extension
+    with ReportWriter(output_file, report_format(output_file, default="csv")) as report:
+        table = report.table(None, fieldnames)
+        table.write_rows(dict_rows(sorted_data, fieldnames))
 
     print(f"Final sorted results saved to {output_file}")
 
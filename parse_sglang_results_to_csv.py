@@ -1,9 +1,10 @@
 import re
 import os
-import csv
 import argparse
 from collections import defaultdict
 
+from report_writer import ReportWriter, dict_rows, report_format
+
 # Define regex patterns to match the required metrics
 prefill_pattern = r"Prefill\. latency:\s*([\d\.]+)\s*s,\s*throughput:\s*([\d\.]+)\s*token/s"
 decode_median_pattern = r"Decode\.  median latency:\s*([\d\.]+)\s*s,\s*median throughput:\s*([\d\.]+)\s*token/s"
@@ -97,7 +98,7 @@ def group_and_sort_data(data):
     
     return sorted_data
 
-# Save the extracted data to a CSV file
+# Save the extracted data to a CSV (or .xlsx / .parquet) file
 def save_to_csv(data, output_file):
     # Define the column headers for the CSV file
     fieldnames = [
@@ -107,11 +108,10 @@ def save_to_csv(data, output_file):
         'Total latency (s)', 'Total throughput (token/s)'
     ]
     
-    # Open the CSV file and write data to it
-    with open(output_file, mode='w', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=fieldnames)
-        writer.writeheader()  # Write the header row
-        writer.writerows(data)  # Write multiple rows of data
+    # Stream the rows to the output file in the format of its extension, CSV for any other extension
+    with ReportWriter(output_file, report_format(output_file, default="csv")) as report:
+        table = report.table(None, fieldnames)  # Write the header row
+        table.write_rows(dict_rows(data, fieldnames))  # Write multiple rows of data
 
 # Main function to handle command-line arguments
 def main():
@@ -0,0 +1,257 @@
+#
+# Minimal encoder for the Perfetto TrackEvent protobuf trace format
+#
+# Writes the same wire format as trace_packet.proto / track_event.proto without
+# depending on the protobuf package.  Only the handful of fields needed for
+# slices, counters and flows are implemented.
+#
+# Every track gets its own packet sequence.  That keeps interned strings and
+# timestamps local to the track:
+#   - event names, categories and debug annotation names are interned per
+#     sequence and referenced by iid
+#   - timestamps use an incremental clock, so each packet only stores the delta
+#     to the previous packet on the same track
+#   - the track_uuid is a sequence default and is omitted from every event
+#
+
+import struct
+
+# TrackEvent.Type
+SLICE_BEGIN = 1
+SLICE_END = 2
+INSTANT = 3
+COUNTER = 4
+
+# TracePacket.SequenceFlags
+SEQ_INCREMENTAL_STATE_CLEARED = 1
+SEQ_NEEDS_INCREMENTAL_STATE = 2
+
+BOOTTIME_CLOCK = 6
+# Sequence-scoped clock ids start at 64
+INCREMENTAL_CLOCK = 64
+
+
+def varint(value):
+    if value < 0x80:
+        return bytes((value,))
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def tag(field, wire_type):
+    return varint((field << 3) | wire_type)
+
+
+def field_varint(field, value):
+    return tag(field, 0) + varint(value)
+
+
+def field_bytes(field, value):
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return tag(field, 2) + varint(len(value)) + value
+
+
+def field_fixed64(field, value):
+    return tag(field, 1) + struct.pack("<Q", value)
+
+
+def field_double(field, value):
+    return tag(field, 1) + struct.pack("<d", value)
+
+
+# Tags of the fields written on the hot path
+_TIMESTAMP = tag(8, 0)
+_TRACK_EVENT = tag(11, 2)
+_INTERNED_DATA = tag(12, 2)
+_TIMESTAMP_CLOCK_ID = tag(58, 0)
+_TYPE = tag(9, 0)
+_NAME_IID = tag(10, 0)
+_CATEGORY_IIDS = tag(3, 0)
+_DEBUG_ANNOTATIONS = tag(4, 2)
+_COUNTER_VALUE = tag(30, 0)
+_DOUBLE_COUNTER_VALUE = tag(44, 1)
+_FLOW_IDS = 47
+_TERMINATING_FLOW_IDS = 48
+
+_END_EVENT = _TRACK_EVENT + varint(2) + _TYPE + varint(SLICE_END)
+
+
+class SliceLanes:
+    """
+    Greedy lane packing for tracks that may get overlapping slices (ops on
+    one hardware queue, frames of different markers).  A slice goes to the
+    first lane of its key whose last slice ended by its start; lane 0 is the
+    key's own track and the others are meant as sibling tracks.  Any slice
+    order gives lanes without partial overlaps; start order gives the fewest.
+    """
+
+    def __init__(self, max_lanes=4096):
+        self.ends = {}
+        self.max_lanes = max_lanes
+
+    def lane(self, key, ts, dur):
+        ends = self.ends.setdefault(key, [])
+        for lane, end in enumerate(ends):
+            if end <= ts:
+                break
+        else:
+            lane = len(ends)
+            if lane >= self.max_lanes:
+                # Out of lanes: the slice shares the busiest lane and may mis-nest
+                lane -= 1
+            else:
+                ends.append(ts)
+        ends[lane] = max(ends[lane], ts + dur)
+        return lane
+
+
+class _Sequence:
+    __slots__ = ("prefix", "last_ts", "names", "categories", "annotations")
+
+    def __init__(self, sequence_id):
+        self.prefix = field_varint(10, sequence_id) + field_varint(13, SEQ_NEEDS_INCREMENTAL_STATE)
+        self.last_ts = 0
+        self.names = {}
+        self.categories = {}
+        self.annotations = {}
+
+
+class TrackEventWriter:
+    """Serialize TrackEvent packets into an in-memory buffer.
+
+    Callers emit events and periodically take() the encoded bytes.  The bytes of
+    several writers can be concatenated into one trace as long as their
+    sequence_base values keep their packet sequence ids apart.
+    """
+
+    def __init__(self, sequence_base=1):
+        self.buffer = bytearray()
+        self.next_sequence = sequence_base
+        self.sequences = {}      # track uuid -> _Sequence
+        self.described = set()  # track uuids with a TrackDescriptor already written
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+    def _packet(self, body):
+        self.buffer += b"\x0a" + varint(len(body)) + body
+
+    # Tracks
+
+    def describe_track(self, uuid, name=None, parent_uuid=None, process=None, thread=None, counter=False):
+        """Write a TrackDescriptor once per uuid.
+
+        process is a (pid, name) pair, thread a (pid, tid, name) triple.
+        """
+        if uuid in self.described:
+            return
+        self.described.add(uuid)
+        body = field_varint(1, uuid)
+        if name is not None:
+            body += field_bytes(2, name)
+        if process is not None:
+            body += field_bytes(3, field_varint(1, process[0]) + field_bytes(6, process[1]))
+        if thread is not None:
+            body += field_bytes(4, field_varint(1, thread[0]) + field_varint(2, thread[1]) + field_bytes(5, thread[2]))
+        if parent_uuid is not None:
+            body += field_varint(5, parent_uuid)
+        if counter:
+            body += field_bytes(8, b"")
+        self._packet(field_bytes(60, body))
+
+    def _sequence(self, track_uuid):
+        sequence = self.sequences.get(track_uuid)
+        if sequence is None:
+            sequence = self.sequences[track_uuid] = _Sequence(self.next_sequence)
+            clocks = (field_bytes(1, field_varint(1, INCREMENTAL_CLOCK) + field_varint(2, 0) + field_varint(3, 1)) +
+                      field_bytes(1, field_varint(1, BOOTTIME_CLOCK) + field_varint(2, 0)))
+            defaults = field_varint(58, INCREMENTAL_CLOCK) + field_bytes(11, field_varint(11, track_uuid))
+            self._packet(field_varint(10, self.next_sequence) +
+                         field_varint(13, SEQ_INCREMENTAL_STATE_CLEARED) +
+                         field_bytes(6, clocks) +
+                         field_bytes(59, defaults))
+            self.next_sequence += 1
+        return sequence
+
+    def _timestamp(self, sequence, ts):
+        """Encode ts as a delta on the incremental clock, or absolute if it goes backwards."""
+        if ts >= sequence.last_ts:
+            delta = ts - sequence.last_ts
+            sequence.last_ts = ts
+            return _TIMESTAMP + varint(delta)
+        return _TIMESTAMP + varint(ts) + _TIMESTAMP_CLOCK_ID + varint(BOOTTIME_CLOCK)
+
+    @staticmethod
+    def _intern(table, value, field, interned):
+        iid = table.get(value)
+        if iid is None:
+            iid = table[value] = len(table) + 1
+            interned.append(field_bytes(field, field_varint(1, iid) + field_bytes(2, value)))
+        return iid
+
+    def _annotations(self, sequence, args, interned):
+        body = b""
+        for key, value in args.items():
+            entry = field_varint(1, self._intern(sequence.annotations, key, 3, interned))
+            if isinstance(value, bool):
+                entry += field_varint(2, int(value))
+            elif isinstance(value, int):
+                entry += field_varint(4, value & 0xffffffffffffffff)
+            elif isinstance(value, float):
+                entry += field_double(5, value)
+            else:
+                entry += field_bytes(6, str(value))
+            body += _DEBUG_ANNOTATIONS + varint(len(entry)) + entry
+        return body
+
+    def _event(self, track_uuid, ts, event_type, name=None, category=None, args=None, extra=b""):
+        sequence = self._sequence(track_uuid)
+        interned = []
+        event = _TYPE + varint(event_type)
+        if name is not None:
+            event += _NAME_IID + varint(self._intern(sequence.names, name, 2, interned))
+        if category is not None:
+            event += _CATEGORY_IIDS + varint(self._intern(sequence.categories, category, 1, interned))
+        if args:
+            event += self._annotations(sequence, args, interned)
+        event += extra
+        body = self._timestamp(sequence, ts) + sequence.prefix + _TRACK_EVENT + varint(len(event)) + event
+        if interned:
+            data = b"".join(interned)
+            body += _INTERNED_DATA + varint(len(data)) + data
+        self._packet(body)
+        return sequence
+
+    # Events
+
+    def slice(self, track_uuid, ts, dur, name, category=None, args=None, flow_ids=(), terminating_flow_ids=()):
+        """
+        A complete slice [ts, ts + dur] in ns, written as a BEGIN/END pair.
+        Slices of one track must nest: an END closes the innermost open slice,
+        so two partly overlapping slices on a track are shown wrong.  Spread
+        slices that may overlap over sibling tracks (see SliceLanes).
+        """
+        extra = b"".join([field_fixed64(_FLOW_IDS, flow) for flow in flow_ids] +
+                         [field_fixed64(_TERMINATING_FLOW_IDS, flow) for flow in terminating_flow_ids])
+        sequence = self._event(track_uuid, ts, SLICE_BEGIN, name, category, args, extra)
+        self._packet(self._timestamp(sequence, ts + dur) + sequence.prefix + _END_EVENT)
+
+    def instant(self, track_uuid, ts, name, category=None, args=None, flow_ids=(), terminating_flow_ids=()):
+        extra = b"".join([field_fixed64(_FLOW_IDS, flow) for flow in flow_ids] +
+                         [field_fixed64(_TERMINATING_FLOW_IDS, flow) for flow in terminating_flow_ids])
+        self._event(track_uuid, ts, INSTANT, name, category, args, extra)
+
+    def counter(self, track_uuid, ts, value):
+        """A counter sample.  The track must be described with counter=True."""
+        if isinstance(value, float):
+            value_field = _DOUBLE_COUNTER_VALUE + struct.pack("<d", value)
+        else:
+            value_field = _COUNTER_VALUE + varint(value & 0xffffffffffffffff)
+        self._event(track_uuid, ts, COUNTER, extra=value_field)
@@ -0,0 +1,48 @@
+import os
+import sys
+import argparse
+
+from rpd_db import parse_time
+from trace_archive import extract_shard, read_manifest, select_shards
+
+# Extract the shards of a split trace archive that overlap a time window, using
+# the manifest written by dump_trace.py / split_json.py.  Only the selected
+# shards are read from the archive; nothing else is decompressed.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the shards of a split trace that overlap a time window.")
+    parser.add_argument("manifest", help="The <prefix>_split.manifest.json written next to the split output.")
+    parser.add_argument("--start", type=str, help="Window start in us or as a percentage of the trace (e.g., 50%%)")
+    parser.add_argument("--end", type=str, help="Window end in us or as a percentage of the trace (e.g., 55%%)")
+    parser.add_argument("--pid", type=str, help="Only shards with events of this pid (the GPU id for dump_trace output).")
+    parser.add_argument("--output-dir", type=str, default=".", help="Where to write the extracted shards (default: current directory).")
+    parser.add_argument("--decompress", action="store_true", help="Write the shards as plain JSON.")
+    parser.add_argument("--list", action="store_true", help="Only list the matching shards.")
+    args = parser.parse_args()
+
+    manifest = read_manifest(args.manifest)
+    timed = [shard for shard in manifest["shards"] if shard["events"]]
+    if not timed:
+        sys.exit("The trace has no timed events.")
+    # parse_time takes the trace bounds in ns and returns us
+    first = min(shard["first_ts"] for shard in timed) * 1000
+    last = max(shard["max_end"] for shard in timed) * 1000
+    start = parse_time(args.start, first, last) if args.start else None
+    end = parse_time(args.end, first, last) if args.end else None
+
+    shards = select_shards(manifest, start, end, args.pid)
+    print(f"{len(shards)} of {len(manifest['shards'])} shards overlap the window")
+    for shard in shards:
+        print(f"\t{shard['name']}: {shard['first_ts']} - {shard['max_end']} us, {shard['events']} events, pids {shard['pids']}, {shard['size'] / 1024 ** 2:.1f} MB")
+    if args.list:
+        sys.exit(0)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_dir = os.path.dirname(os.path.abspath(args.manifest))
+    for shard in shards:
+        name = os.path.basename(shard["name"])
+        if args.decompress and manifest["compression"] != "none":
+            name = os.path.splitext(name)[0]
+        with open(os.path.join(args.output_dir, name), 'wb') as outfile:
+            extract_shard(manifest, manifest_dir, shard, outfile, args.decompress)
+        print(f"Wrote {os.path.join(args.output_dir, name)}")
@@ -0,0 +1,242 @@
+#
+# Streaming report writers shared by the analysis and parse scripts
+#
+# A report is one or more named tables.  Rows are streamed to the output as
+# they are produced, so a table never has to exist as a whole DataFrame:
+#   - csv: written row by row
+#   - parquet: buffered into row groups of ROW_GROUP_SIZE rows (needs pyarrow)
+#   - xlsx: an openpyxl write-only workbook, one sheet per table
+# The format follows the output extension.  For csv and parquet every named
+# table goes to its own <stem>_<table>.<ext> file; the unnamed table (None) is
+# written to the output path itself.
+#
+# Excel caps a sheet at XLSX_MAX_ROWS rows.  Tables announced as larger, such as
+# per-invocation kernel dumps, are diverted to a columnar file next to the
+# workbook (parquet, or csv without pyarrow); a table that outgrows a sheet
+# while streaming continues on "<table> (2)", "<table> (3)", ...
+#
+
+import os
+import csv
+import math
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ("csv", "parquet", "xlsx")
+
+# Rows per parquet row group
+ROW_GROUP_SIZE = 65536
+
+# Data rows per xlsx sheet, below Excel's 1048576 including the header
+XLSX_MAX_ROWS = 1048575
+
+# Longest sheet name Excel accepts
+XLSX_MAX_SHEET_NAME = 31
+
+
+def report_format(path, default=None):
+    """
+    The report format of an output path, from its extension.  An unknown or
+    missing extension gives default, or raises ValueError without one.
+    """
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    if extension == "pq":
+        extension = "parquet"
+    if extension not in FORMATS:
+        if default is not None:
+            return default
+        raise ValueError(f"Unsupported report format {extension!r} of {path}, expected one of {', '.join(FORMATS)}")
+    return extension
+
+
+def columnar_format():
+    """The format used for tables too large for a sheet."""
+    return "parquet" if pyarrow is not None else "csv"
+
+
+def dict_rows(rows, fieldnames):
+    """
+    Dict rows as lists in fieldnames order, for write_rows.  Like csv.DictWriter,
+    missing keys are written empty and keys not in fieldnames raise ValueError.
+    """
+    known = set(fieldnames)
+    for row in rows:
+        extra = [key for key in row if key not in known]
+        if extra:
+            raise ValueError("dict contains fields not in fieldnames: " + ", ".join(repr(key) for key in extra))
+        yield [row.get(key) for key in fieldnames]
+
+
+class CsvTable:
+    def __init__(self, path, columns):
+        self.path = path
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+        self.rows = 0
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.writer.writerow(['' if value is None or (isinstance(value, float) and math.isnan(value)) else value for value in row])
+            self.rows += 1
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetTable:
+    def __init__(self, path, columns):
+        if pyarrow is None:
+            raise ImportError("parquet output needs the pyarrow package (pip install pyarrow)")
+        self.path = path
+        self.columns = list(columns)
+        self.buffer = []
+        self.writer = None
+        self.rows = 0
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        table = pyarrow.Table.from_pylist([dict(zip(self.columns, row)) for row in self.buffer])
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+        self.buffer = []
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.buffer.append(tuple(row))
+            self.rows += 1
+            if len(self.buffer) >= ROW_GROUP_SIZE:
+                self._flush()
+
+    def write_frame(self, df):
+        self._flush()
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+        self.rows += len(df)
+
+    def close(self):
+        self._flush()
+        if self.writer is None:
+            # No rows: still leave a file with the columns
+            pyarrow.parquet.write_table(pyarrow.table({column: [] for column in self.columns}), self.path)
+        else:
+            self.writer.close()
+
+
+class SheetTable:
+    """Rows of one table in a write-only workbook, continued on a new sheet when one is full."""
+
+    def __init__(self, workbook, name, columns, sheet_names):
+        self.workbook = workbook
+        self.name = name
+        self.columns = list(columns)
+        self.sheet_names = sheet_names
+        self.sheets = 0
+        self.rows = 0
+        self._new_sheet()
+
+    def _new_sheet(self):
+        self.sheets += 1
+        title = self.name if self.sheets == 1 else f"{self.name} ({self.sheets})"
+        title = title[:XLSX_MAX_SHEET_NAME]
+        while title in self.sheet_names:
+            title = title[:XLSX_MAX_SHEET_NAME - 1] + "_"
+        self.sheet_names.add(title)
+        self.sheet = self.workbook.create_sheet(title)
+        self.sheet.append(self.columns)
+        self.sheet_rows = 0
+
+    def write_rows(self, rows):
+        for row in rows:
+            if self.sheet_rows >= XLSX_MAX_ROWS:
+                print(f"Warning: table {self.name} exceeds the Excel row limit, continuing on another sheet")
+                self._new_sheet()
+            self.sheet.append([None if isinstance(value, float) and math.isnan(value) else value for value in row])
+            self.sheet_rows += 1
+            self.rows += 1
+
+    def close(self):
+        pass
+
+
+class ReportWriter:
+    """
+    Streams named tables to a csv, parquet or xlsx report.
+
+        with ReportWriter("out.xlsx") as report:
+            table = report.table("Summary", ["gpuId", "Total Duration"])
+            table.write_rows(rows)
+            report.write_frame("gpuId_0", df)
+    """
+
+    def __init__(self, path, format=None):
+        self.path = path
+        self.format = format or report_format(path)
+        self.stem = os.path.splitext(path)[0]
+        self.tables = []
+        self.files = []
+        self.workbook = None
+        self.sheet_names = set()
+        if self.format == "xlsx":
+            try:
+                import openpyxl
+            except ImportError:
+                raise ImportError("xlsx output needs the openpyxl package (pip install openpyxl)")
+            self.workbook = openpyxl.Workbook(write_only=True)
+
+    def _table_path(self, name, format):
+        if name is None and format == self.format:
+            return self.path
+        safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in name or "table")
+        return f"{self.stem}_{safe}.{format}"
+
+    def table(self, name, columns, rows=None):
+        """
+        Start a table; rows is an optional hint of its length.  In an xlsx report
+        a table announced with more rows than fit on a sheet is written to a
+        columnar file next to the workbook instead.
+        """
+        if self.format == "xlsx" and not (rows is not None and rows > XLSX_MAX_ROWS):
+            table = SheetTable(self.workbook, name or "Sheet1", columns, self.sheet_names)
+        else:
+            format = self.format if self.format != "xlsx" else columnar_format()
+            path = self._table_path(name, format)
+            if self.format == "xlsx":
+                print(f"Table {name} has {rows} rows, more than an Excel sheet holds; writing it to {path}")
+            table = ParquetTable(path, columns) if format == "parquet" else CsvTable(path, columns)
+            self.files.append(path)
+        self.tables.append(table)
+        return table
+
+    def write_frame(self, name, df):
+        """Write a whole DataFrame as one table."""
+        table = self.table(name, [str(column) for column in df.columns], len(df))
+        if isinstance(table, ParquetTable):
+            table.write_frame(df)
+        else:
+            table.write_rows(df.itertuples(index=False, name=None))
+        return table
+
+    def close(self):
+        for table in self.tables:
+            table.close()
+        if self.workbook is not None:
+            if not self.sheet_names:
+                self.workbook.create_sheet("Sheet1")
+            self.workbook.save(self.path)
+            self.files.insert(0, self.path)
+        return self.files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -24,314 +24,988 @@
 # Format sqlite trace data as json for chrome:tracing
 #
 
-import sys
 import os
 import csv
-import re
+import gzip
+import heapq
+import json
+import time
+import shutil
 import sqlite3
-from collections import defaultdict
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict, namedtuple
 from datetime import datetime
+from functools import lru_cache
+from json.encoder import encode_basestring
 import argparse
 
-parser = argparse.ArgumentParser(description='convert RPD to json for chrome tracing')
-parser.add_argument('input_rpd', type=str, help="input rpd db")
-parser.add_argument('output_json', type=str, help="chrome tracing json output")
-parser.add_argument('--start', type=str, help="start time - default us or percentage %%. Number only is interpreted as us. Number with %% is interpreted as percentage")
-parser.add_argument('--end', type=str, help="end time - default us or percentage %%. See help for --start")
-parser.add_argument('--format', type=str, default="object", help="chome trace format, array or object")
-args = parser.parse_args()
+import numpy as np
 
-#print(args)
+from perfetto_trace import SliceLanes, TrackEventWriter
+from rpd_db import connect_readonly, ensure_start_indexes, load_strings, parse_time
 
-connection = sqlite3.connect(args.input_rpd)
+# Rows pulled per fetchmany() call.  Each batch is formatted into a single string
+# and handed to one write() call.
+DEFAULT_BATCH_SIZE = 100000
 
-outfile = open(args.output_json, 'w', encoding="utf-8")
+# JSON-quote a string.  Kernel names repeat millions of times in a large trace,
+# so every distinct name is escaped only once.
+quote = lru_cache(maxsize=None)(encode_basestring)
 
-if args.format == "object":
-    outfile.write("{\"traceEvents\": ")
+# Tables whose max id is recorded in a --watermark sidecar
+WATERMARK_TABLES = ("rocpd_op", "rocpd_api", "rocpd_api_ops", "rocpd_monitor")
 
-outfile.write("[ {}\n");
+OP_EVENT = ',{"pid":%d,"tid":%d,"name":%s,"ts":%d,"dur":%d,"ph":"X","args":{"desc":%s}}\n'
+GRAPH_EVENT = ',{"pid":%d,"tid":%d,"name":%s,"ts":%d,"dur":%d,"ph":"X","args":{"kernels":%d}}\n'
+COUNTER_EVENT = ',{"pid":%d,"name":%s,"ph":"C","ts":%d,"args":{%s:%s}}\n'
+MARK_EVENT = ',{"pid":%d,"tid":%d,"name":%s,"ts":%d,"ph":"i","s":"p","args":{"desc":%s}}\n'
+FLOW_START = ',{"pid":%d,"tid":%d,"cat":"api_op","name":"api_op","ts":%d,"id":%d,"ph":"s"}\n'
+FLOW_END = ',{"pid":%d,"tid":%d,"cat":"api_op","name":"api_op","ts":%d,"id":%d,"ph":"f","bp":"e"}\n'
 
-for row in connection.execute("select distinct gpuId from rocpd_op"):
+# Perfetto track uuids: the kind of track in the top byte, its ids below
+GPU_TRACK = 1 << 56
+QUEUE_TRACK = 2 << 56
+GRAPH_TRACK = 3 << 56
+THREAD_TRACK = 4 << 56
+# Counter tracks are keyed by name, COUNTER_TRACK | pid << 24 | crc32(name) & 0xffffff,
+# so every writer (--jobs fragments, appended segments) gives a counter the same uuid
+COUNTER_TRACK = 5 << 56
+FRAME_TRACK = 6 << 56
+# Sibling tracks of a queue, graph or frame track for overlapping slices:
+# LANE_TRACK | kind << 52 | lane << 40 | gpuId << 24 | queueId
+LANE_TRACK = 7 << 56
+
+SUMMARY_EVENT = ',{"pid":%d,"tid":%d,"name":%s,"ts":%d,"dur":%d,"ph":"X","args":{"count":%d,"busy_us":%.3f,"top":%s}}\n'
+
+# Level of detail: ops shorter than threshold ns collapse into summary slices,
+# except inside the (start, end) ns detail windows.  gpu_budget, when set,
+# raises the threshold per GPU until its event count fits.
+LodConfig = namedtuple("LodConfig", ["threshold", "gpu_budget", "windows"])
+
+# Thresholds (us) tried in turn to fit a --target-events budget
+LOD_THRESHOLDS_US = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000)
+
+# Kernel names listed in the args of a summary slice
+LOD_TOP_NAMES = 3
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='convert RPD to json for chrome tracing, or to a perfetto protobuf trace')
+    parser.add_argument('input_rpd', type=str, help="input rpd db")
+    parser.add_argument('output_json', type=str, help="chrome tracing json output (or .pftrace with --format perfetto). A .gz suffix writes gzip-compressed output directly")
+    parser.add_argument('--start', type=str, help="start time - default us or percentage %%. Number only is interpreted as us. Number with %% is interpreted as percentage")
+    parser.add_argument('--end', type=str, help="end time - default us or percentage %%. See help for --start")
+    parser.add_argument('--format', type=str, default="object", choices=["object", "array", "perfetto"], help="chome trace format, array or object, or perfetto for the TrackEvent protobuf format")
+    parser.add_argument('--create-index', action='store_true', help="create (or reuse) start-time indexes on rocpd_op, rocpd_api and rocpd_monitor so --start/--end windows are index range scans. Writes to the input rpd")
+    parser.add_argument('--jobs', type=int, default=1, help="convert with N worker processes, one GPU per fragment, default %(default)s")
+    parser.add_argument('--counters', action='store_true', help="add per-GPU QueueDepth and Idle counters and rocpd_monitor (SMI) counters")
+    parser.add_argument('--counter-resolution', type=float, default=1, help="QueueDepth/Idle sample resolution in us. Each bucket reports its peak depth, default %(default)s")
+    parser.add_argument('--apis', action='store_true', help="add the HIP API calls (and UserMarker ranges) on the host thread lanes")
+    parser.add_argument('--flows', action='store_true', help="add api->op flow arrows and report the launch latency distribution")
+    parser.add_argument('--latency-csv', type=str, help="with --flows, write the launch latency histogram to this csv file")
+    parser.add_argument('--frames', action='store_true', help="project UserMarker ranges onto the GPU queues that ran their ops as 'frames'")
+    parser.add_argument('--frame-gap', type=float, default=200, help="ops of the same marker closer than this many us are merged into one frame, default %(default)s")
+    parser.add_argument('--lod-threshold', type=float, help="collapse runs of consecutive ops shorter than this many us on a GPU queue into summary slices (count, busy time, top names)")
+    parser.add_argument('--target-events', type=int, help="collapse short ops, raising the threshold per GPU until the trace stays under about this many op events")
+    parser.add_argument('--detail', type=str, action='append', default=[], help="START:END window (us or %%, like --start/--end) kept at full detail by --lod-threshold/--target-events. Can be repeated")
+    parser.add_argument('--watermark', type=str, help="sidecar json recording the last exported op/api ids. When it exists only newer rows are exported, then it is advanced")
+    parser.add_argument('--append', action='store_true', help="append to output_json instead of overwriting it (perfetto format only), e.g. to add a --watermark segment")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="rows fetched and written per batch, default %(default)s")
+    parser.add_argument('--compress-level', type=int, default=6, help="gzip level (1-9) used for .gz output, default %(default)s")
+    args = parser.parse_args()
+    if args.append and args.format != "perfetto":
+        parser.error("--append needs --format perfetto; json segments are written as separate files")
+    return args
+
+
+def time_window_filters(start_ns=None, end_ns=None):
+    """Build the rocpd_api, rocpd_op and rocpd_monitor WHERE clauses for a time window.
+
+    The bounds are plain nanosecond comparisons on the raw start column so that
+    sqlite can satisfy them with a range scan over a start index.
+    """
+    filters = []
+    for column in ("rocpd_api.start", "rocpd_op.start", "start"):
+        predicates = []
+        if start_ns is not None:
+            predicates.append("%s >= %d" % (column, start_ns))
+        if end_ns is not None:
+            predicates.append("%s <= %d" % (column, end_ns))
+        filters.append("where " + " and ".join(predicates) if predicates else "")
+    return tuple(filters)
+
+
+def add_predicate(rangeString, predicate):
+    """AND a predicate onto a (possibly empty) WHERE clause."""
+    return rangeString + " and " + predicate if rangeString else "where " + predicate
+
+
+def table_high_marks(connection):
+    """Max id of each watermarked table, 0 for tables that are empty or missing."""
+    marks = {}
+    for table in WATERMARK_TABLES:
+        try:
+            marks[table] = connection.execute("select max(id) from %s" % table).fetchone()[0] or 0
+        except sqlite3.OperationalError:
+            marks[table] = 0
+    return marks
+
+
+def read_watermark(path, rpd_path):
+    """Load a watermark sidecar, or start from scratch if there is none yet."""
+    if not os.path.exists(path):
+        return {"rpd": os.path.abspath(rpd_path), "segments": [], "marks": {table: 0 for table in WATERMARK_TABLES}}
+    with open(path) as f:
+        watermark = json.load(f)
+    if watermark["rpd"] != os.path.abspath(rpd_path):
+        raise Exception(f"Watermark {path} belongs to {watermark['rpd']}")
+    return watermark
+
+
+def write_watermark(path, watermark):
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(watermark, f, indent=2)
+    os.replace(tmp, path)
+
+
+def watermark_filters(previous, current):
+    """rowid range predicates selecting the rows added since the previous marks.
+
+    The upper bound is the max id at the start of this run, so rows a live
+    server appends while we convert are left for the next segment.
+    """
+    for table in WATERMARK_TABLES:
+        if current[table] < previous.get(table, 0):
+            raise Exception(f"{table} shrank below the watermark; the rpd was recreated, delete the watermark to start over")
+    return {table: "%s.id > %d and %s.id <= %d" % (table, previous.get(table, 0), table, current[table])
+            for table in WATERMARK_TABLES}
+
+
+def open_output(path, compress_level=6, mode='w', binary=False):
+    """Open the trace output for writing, gzip-compressed when path ends in .gz.
+
+    mode 'a' appends; for .gz output that starts a new gzip member, so a file can
+    be assembled from separately compressed pieces.
+    """
+    if binary:
+        if path.endswith(".gz"):
+            return gzip.open(path, mode + 'b', compresslevel=compress_level)
+        return open(path, mode + 'b', buffering=1 << 20)
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + 't', encoding="utf-8", compresslevel=compress_level)
+    return open(path, mode, encoding="utf-8", buffering=1 << 20)
+
+
+def write_batches(cursor, outfile, format_rows, batch_size=DEFAULT_BATCH_SIZE):
+    """Pull cursor rows with fetchmany() and write each batch with one write() call.
+
+    Returns the number of rows written.
+    """
+    count = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        outfile.write(format_rows(rows))
+        count += len(rows)
+    return count
+
+
+class JsonTraceWriter:
+    """Chrome trace json.  Each format_* method turns one batch of rows into one string.
+
+    Op rows carry rocpd_string ids, resolved through the pre-escaped strings
+    of a StringTable.
+    """
+
+    binary = False
+
+    def __init__(self, strings, format="object"):
+        self.strings = strings
+        self.format = format
+
+    def header(self):
+        return ("{\"traceEvents\": " if self.format == "object" else "") + "[ {}\n"
+
+    def trailer(self):
+        return "]\n" + ("} \n" if self.format == "object" else "")
+
+    def format_metadata(self, gpuIds, threads, hsaThreads):
+        out = []
+        for gpuId in gpuIds:
+            out.append(',{"name":"process_name","ph":"M","pid":%d,"args":{"name":"%s"}}\n' % (gpuId, "GPU" + str(gpuId)))
+            out.append(',{"name":"process_sort_index","ph":"M","pid":%d,"args":{"sort_index":%d}}\n' % (gpuId, gpuId + 1000000))
+        for pid, tid in threads:
+            out.append(',{"name":"thread_name","ph":"M","pid":%d,"tid":%d,"args":{"name":"%s"}}\n' % (pid, tid, "Hip " + str(tid)))
+            out.append(',{"name":"thread_sort_index","ph":"M","pid":%d,"tid":%d,"args":{"sort_index":%d}}\n' % (pid, tid, tid * 2))
+        # FIXME - these aren't rendering correctly in chrome://tracing
+        for pid, tid in hsaThreads:
+            out.append(',{"name":"thread_name","ph":"M","pid":%d,"tid":%d,"args":{"name":"%s"}}\n' % (pid, tid, "HSA " + str(tid)))
+            out.append(',{"name":"thread_sort_index","ph":"M","pid":%d,"tid":%d,"args":{"sort_index":%d}}\n' % (pid, tid, tid * 2 - 1))
+        return "".join(out)
+
+    def format_ops(self, rows):
+        text, names = self.strings.strings, self.strings.json
+        return "".join([OP_EVENT % (gpuId, queueId, names[description] if text[description] else names[optype], start // 1000, dur // 1000, names[optype])
+                        for optype, description, gpuId, queueId, start, dur in rows])
+
+    def format_graphs(self, rows):
+        return "".join([GRAPH_EVENT % (gpuId, queueId, quote(f'Graph {graphExec}'), start // 1000, dur // 1000, kernels)
+                        for graphExec, gpuId, queueId, start, dur, kernels in rows])
+
+    def format_apis(self, rows):
+        text, names = self.strings.strings, self.strings.json
+        return "".join([(MARK_EVENT % (pid, tid, names[args], start // 1000, names[args]) if mark else
+                         OP_EVENT % (pid, tid, names[name], start // 1000, dur // 1000, names[args]))
+                        for name, args, pid, tid, start, dur, mark in rows])
+
+    def format_flows(self, rows):
+        return "".join([FLOW_START % (pid, tid, source // 1000, id) + FLOW_END % (gpuId, queueId, target // 1000, id)
+                        for id, pid, tid, source, gpuId, queueId, target in rows])
+
+    def format_frames(self, rows):
+        return "".join([OP_EVENT % (gpuId, queueId, quote(label), start // 1000, dur // 1000, quote(f"UserMarker frame: {ops} ops"))
+                        for label, gpuId, queueId, start, dur, ops in rows])
+
+    def format_summaries(self, rows):
+        return "".join([SUMMARY_EVENT % (gpuId, queueId, quote(f"{count} ops < {threshold / 1000:g}us"), start // 1000, dur // 1000, count, busy / 1000, quote(top))
+                        for gpuId, queueId, start, dur, count, busy, top, threshold in rows])
+
+    def format_counter(self, pid, name, key, ts, values):
+        name, key = quote(name), quote(key)
+        return "".join([COUNTER_EVENT % (pid, name, t, key, value)
+                        for t, value in zip((np.asarray(ts) // 1000).tolist(), np.asarray(values).tolist())])
+
+
+class PerfettoTraceWriter:
+    """Perfetto TrackEvent protobuf.  Each format_* method turns one batch of rows into bytes.
+
+    Every GPU is a track group with a child track per queue (and per queue
+    that runs graphs, a graph track).  Slices that partly overlap others on
+    their track move to sibling "Queue N (2)", ... lanes, as TrackEvent slices
+    of one track must nest.  Host threads are thread tracks.
+    Timestamps stay in ns.
+    """
+
+    binary = True
+
+    def __init__(self, strings, sequence_base=1):
+        self.strings = strings.strings
+        self.events = TrackEventWriter(sequence_base)
+        self.tracks = {}
+        self.lanes = SliceLanes()
+
+    def header(self):
+        return b""
+
+    def trailer(self):
+        return b""
+
+    def gpu_track(self, gpuId):
+        uuid = GPU_TRACK | gpuId
+        self.events.describe_track(uuid, name="GPU%d" % gpuId)
+        return uuid
+
+    def queue_track(self, gpuId, queueId):
+        key = (QUEUE_TRACK, gpuId, queueId)
+        uuid = self.tracks.get(key)
+        if uuid is None:
+            uuid = self.tracks[key] = QUEUE_TRACK | (gpuId << 24) | queueId
+            self.events.describe_track(uuid, name="Queue %d" % queueId, parent_uuid=self.gpu_track(gpuId))
+        return uuid
+
+    def graph_track(self, gpuId, queueId):
+        key = (GRAPH_TRACK, gpuId, queueId)
+        uuid = self.tracks.get(key)
+        if uuid is None:
+            uuid = self.tracks[key] = GRAPH_TRACK | (gpuId << 24) | queueId
+            self.events.describe_track(uuid, name="Graphs %d" % queueId, parent_uuid=self.gpu_track(gpuId))
+        return uuid
+
+    def lane_track(self, track, kind, label, gpuId, queueId, start, dur):
+        """track(gpuId, queueId), or a sibling of it when the slice overlaps the slices already there."""
+        lane = self.lanes.lane((kind, gpuId, queueId), start, dur)
+        if lane == 0:
+            return track(gpuId, queueId)
+        key = (kind, gpuId, queueId, lane)
+        uuid = self.tracks.get(key)
+        if uuid is None:
+            uuid = self.tracks[key] = LANE_TRACK | ((kind >> 56) << 52) | (lane << 40) | (gpuId << 24) | queueId
+            self.events.describe_track(uuid, name="%s %d (%d)" % (label, queueId, lane + 1), parent_uuid=self.gpu_track(gpuId))
+        return uuid
+
+    def thread_track(self, pid, tid, label="Hip"):
+        key = (THREAD_TRACK, pid, tid)
+        uuid = self.tracks.get(key)
+        if uuid is None:
+            uuid = self.tracks[key] = THREAD_TRACK | (pid << 24) | (tid & 0xffffff)
+            self.events.describe_track(uuid, thread=(pid, tid, "%s %d" % (label, tid)))
+        return uuid
+
+    def format_metadata(self, gpuIds, threads, hsaThreads):
+        for gpuId in gpuIds:
+            self.gpu_track(gpuId)
+        for pid, tid in threads:
+            self.thread_track(pid, tid)
+        return self.events.take()
+
+    def format_ops(self, rows):
+        # Ops of one hardware queue can overlap; those spill to sibling lanes
+        lane_track = self.lane_track
+        queue_track = self.queue_track
+        add_slice = self.events.slice
+        text = self.strings
+        for optype, description, gpuId, queueId, start, dur in rows:
+            add_slice(lane_track(queue_track, QUEUE_TRACK, "Queue", gpuId, queueId, start, dur), start, dur,
+                      text[description] or text[optype], text[optype])
+        return self.events.take()
+
+    def format_graphs(self, rows):
+        for graphExec, gpuId, queueId, start, dur, kernels in rows:
+            self.events.slice(self.lane_track(self.graph_track, GRAPH_TRACK, "Graphs", gpuId, queueId, start, dur), start, dur,
+                              f'Graph {graphExec}', args={"kernels": kernels})
+        return self.events.take()
+
+    def format_apis(self, rows):
+        track = self.thread_track
+        text = self.strings
+        for name, args, pid, tid, start, dur, mark in rows:
+            if mark:
+                self.events.instant(track(pid, tid), start, text[args], "UserMarker")
+            else:
+                self.events.slice(track(pid, tid), start, dur, text[name], "api", {"desc": text[args]} if text[args] else None)
+        return self.events.take()
+
+    def format_flows(self, rows):
+        # Slices are written before their flows are known, so each flow runs
+        # between two instants: one inside the api call, one at the op start
+        for id, pid, tid, source, gpuId, queueId, target in rows:
+            self.events.instant(self.thread_track(pid, tid), source, "api_op", "api_op", flow_ids=(id,))
+            self.events.instant(self.queue_track(gpuId, queueId), target, "api_op", "api_op", terminating_flow_ids=(id,))
+        return self.events.take()
+
+    def format_summaries(self, rows):
+        for gpuId, queueId, start, dur, count, busy, top, threshold in rows:
+            self.events.slice(self.lane_track(self.queue_track, QUEUE_TRACK, "Queue", gpuId, queueId, start, dur), start, dur, f"{count} ops < {threshold / 1000:g}us", "lod",
+                              {"count": count, "busy_us": busy / 1000, "top": top})
+        return self.events.take()
+
+    def frame_track(self, gpuId, queueId):
+        key = (FRAME_TRACK, gpuId, queueId)
+        uuid = self.tracks.get(key)
+        if uuid is None:
+            uuid = self.tracks[key] = FRAME_TRACK | (gpuId << 24) | queueId
+            self.events.describe_track(uuid, name="Frames %d" % queueId, parent_uuid=self.gpu_track(gpuId))
+        return uuid
+
+    def format_frames(self, rows):
+        # Frames of different markers can overlap on a queue, so they get their own
+        # track, and frames that overlap each other go to its sibling lanes
+        for label, gpuId, queueId, start, dur, ops in rows:
+            self.events.slice(self.lane_track(self.frame_track, FRAME_TRACK, "Frames", gpuId, queueId, start, dur), start, dur,
+                              label, "UserMarker", args={"ops": ops})
+        return self.events.take()
+
+    def counter_track(self, pid, name):
+        key = (COUNTER_TRACK, pid, name)
+        uuid = self.tracks.get(key)
+        if uuid is None:
+            uuid = self.tracks[key] = COUNTER_TRACK | (pid << 24) | (zlib.crc32(name.encode()) & 0xffffff)
+            self.events.describe_track(uuid, name=name, parent_uuid=self.gpu_track(pid), counter=True)
+        return uuid
+
+    def format_counter(self, pid, name, key, ts, values):
+        track = self.counter_track(pid, name)
+        for t, value in zip(np.asarray(ts).tolist(), np.asarray(values).tolist()):
+            self.events.counter(track, t, value)
+        return self.events.take()
+
+
+def make_writer(format, strings, sequence_base=1):
+    if format == "perfetto":
+        return PerfettoTraceWriter(strings, sequence_base)
+    return JsonTraceWriter(strings, format)
+
+
+def write_metadata(connection, outfile, writer, gpuIds):
+    threads = connection.execute("select distinct pid, tid from rocpd_api").fetchall()
     try:
-        outfile.write(",{\"name\": \"process_name\", \"ph\": \"M\", \"pid\":\"%s\",\"args\":{\"name\":\"%s\"}}\n"%(row[0], "GPU"+str(row[0])))
-        outfile.write(",{\"name\": \"process_sort_index\", \"ph\": \"M\", \"pid\":\"%s\",\"args\":{\"sort_index\":\"%s\"}}\n"%(row[0], row[0] + 1000000))
-    except ValueError:
-        outfile.write("")
+        hsaThreads = connection.execute("select distinct pid, tid from rocpd_hsaApi").fetchall()
+    except sqlite3.OperationalError:
+        hsaThreads = []
+    outfile.write(writer.format_metadata(gpuIds, threads, hsaThreads))
 
-for row in connection.execute("select distinct pid, tid from rocpd_api"):
+
+def export_ops(connection, outfile, writer, rangeStringOp, batch_size=DEFAULT_BATCH_SIZE):
+    cursor = connection.execute("select opType_id, description_id, gpuId, queueId, rocpd_op.start, (rocpd_op.end-rocpd_op.start) from rocpd_op %s"%(rangeStringOp))
+    return write_batches(cursor, outfile, writer.format_ops, batch_size)
+
+
+def export_graphs(connection, outfile, writer, rangeStringOp, batch_size=DEFAULT_BATCH_SIZE):
+    """Output Graph executions on GPU"""
     try:
-        outfile.write(',{"name":"thread_name","ph":"M","pid":"%s","tid":"%s","args":{"name":"%s"}}\n'%(row[0], row[1], "Hip " + str(row[1])))
-        outfile.write(',{"name":"thread_sort_index","ph":"M","pid":"%s","tid":"%s","args":{"sort_index":"%s"}}\n'%(row[0], row[1], row[1] * 2))
-    except ValueError:
-        outfile.write("")
-
-try:
-    # FIXME - these aren't rendering correctly in chrome://tracing
-    for row in connection.execute("select distinct pid, tid from rocpd_hsaApi"):
-        try:
-            outfile.write(',{"name":"thread_name","ph":"M","pid":"%s","tid":"%s","args":{"name":"%s"}}\n'%(row[0], row[1], "HSA " + str(row[1])))
-            outfile.write(',{"name":"thread_sort_index","ph":"M","pid":"%s","tid":"%s","args":{"sort_index":"%s"}}\n'%(row[0], row[1], row[1] * 2 - 1))
-        except ValueError:
-            outfile.write("")
-except:
-    pass
-
-rangeStringApi = ""
-rangeStringOp = ""
-rangeStringMonitor = ""
-min_time = connection.execute("select MIN(start) from rocpd_api;").fetchall()[0][0]
-max_time = connection.execute("select MAX(end) from rocpd_api;").fetchall()[0][0]
-if (min_time == None):
-    raise Exception("Trace file is empty.")
-
-print("Timestamps:")
-print(f"\t    first: \t{min_time/1000} us")
-print(f"\t     last: \t{max_time/1000} us")
-print(f"\t duration: \t{(max_time-min_time) / 1000000000} seconds")
-
-start_time = min_time/1000
-end_time = max_time/1000
-
-if args.start:
-    if "%" in args.start:
-        start_time = ( (max_time - min_time) * ( int( args.start.replace("%","") )/100 ) + min_time )/1000
-    else:
-        start_time = int(args.start)
-    rangeStringApi = "where rocpd_api.start/1000 >= %s"%(start_time)
-    rangeStringOp = "where rocpd_op.start/1000 >= %s"%(start_time)
-    rangeStringMonitor = "where start/1000 >= %s"%(start_time)
-if args.end:
-    if "%" in args.end:
-        end_time = ( (max_time - min_time) * ( int( args.end.replace("%","") )/100 ) + min_time )/1000
-    else:
-        end_time = int(args.end)
+        cursor = connection.execute('select graphExec, gpuId, queueId, min(rocpd_op.start), (max(rocpd_op.end)-min(rocpd_op.start)), count(*) from rocpd_graphLaunchapi A join rocpd_api_ops B on B.api_id = A.api_ptr_id join rocpd_op on rocpd_op.id = B.op_id %s group by api_ptr_id'%(rangeStringOp))
+    except sqlite3.OperationalError:
+        return 0
+    return write_batches(cursor, outfile, writer.format_graphs, batch_size)
+
+
+def load_op_columns(connection, columns, rangeStringOp, batch_size=DEFAULT_BATCH_SIZE):
+    """Load integer rocpd_op columns into one int64 array per column."""
+    cursor = connection.execute("select %s from rocpd_op %s" % (", ".join(columns), rangeStringOp))
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.int64))
+    if not chunks:
+        return tuple(np.empty(0, dtype=np.int64) for column in columns)
+    table = np.concatenate(chunks)
+    return tuple(table[:, i] for i in range(len(columns)))
+
+
+def load_op_times(connection, rangeStringOp, batch_size=DEFAULT_BATCH_SIZE):
+    """Load op start and end times (ns) into two int64 arrays."""
+    return load_op_columns(connection, ("rocpd_op.start", "rocpd_op.end"), rangeStringOp, batch_size)
+
 
-    rangeStringApi = rangeStringApi + " and rocpd_api.start/1000 <= %s"%(end_time) if args.start != None else "where rocpd_api.start/1000 <= %s"%(end_time)
-    rangeStringOp = rangeStringOp + " and rocpd_op.start/1000 <= %s"%(end_time) if args.start != None else "where rocpd_op.start/1000 <= %s"%(end_time)
-    rangeStringMonitor = rangeStringMonitor + " and start/1000 <= %s"%(end_time) if args.start != None else "where start/1000 <= %s"%(end_time)
+def queue_depth_samples(starts, ends, resolution=1000):
+    """Sweep op start/end times into a queue depth step function in one vectorized pass.
 
-print("\nFilter: %s"%(rangeStringApi))
-print(f"Output duration: {(end_time-start_time)/1000000} seconds")
+    Every start is +1 and every end -1.  Ends sort before starts at the same
+    timestamp, so back to back ops do not produce a spurious idle sample.
+    Samples are bucketed to resolution ns.  Each bucket reports its peak depth,
+    followed by its closing depth one bucket later when that differs and nothing
+    else is sampled there.  Returns (ts, depth) with repeated values removed.
+    """
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    times = np.concatenate((starts, ends))
+    steps = np.concatenate((np.ones(len(starts), dtype=np.int64), np.full(len(ends), -1, dtype=np.int64)))
+    order = np.lexsort((steps, times))
+    times = times[order]
+    depth = np.cumsum(steps[order])
+    # Settled depth after all steps at the same timestamp
+    settled = np.r_[times[1:] != times[:-1], True]
+    times, depth = times[settled], depth[settled]
 
-# Output Ops
-'''
-# Hack for busted rocprofiler that can't populate kernel names
-for row in connection.execute("select A.string as optype, B.string as description, C.string as arg, gpuId, queueId, rocpd_op.start/1000, (rocpd_op.end-rocpd_op.start) / 1000 from rocpd_op LEFT JOIN rocpd_api_ops on op_id = rocpd_op.id INNER JOIN rocpd_api on api_id = rocpd_api.id INNER JOIN rocpd_string A on A.id = rocpd_op.opType_id INNER Join rocpd_string B on B.id = rocpd_op.description_id INNER JOIN rocpd_string C on C.id = rocpd_api.args_id %s"%(rangeString)):
+    buckets = times - times % resolution
+    first = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    last = np.r_[first[1:] - 1, len(times) - 1]
+    bucket_ts = buckets[first]
+    close = depth[last]
+    # The depth carried into a bucket counts towards its peak until its first event
+    carried = np.r_[0, close[:-1]] * (times[first] > bucket_ts)
+    peak = np.maximum(np.maximum.reduceat(depth, first), carried)
+    reopen = (close != peak) & np.r_[bucket_ts[1:] > bucket_ts[:-1] + resolution, True]
+
+    ts = np.concatenate((bucket_ts, bucket_ts[reopen] + resolution))
+    values = np.concatenate((peak, close[reopen]))
+    order = np.argsort(ts, kind="stable")
+    ts, values = ts[order], values[order]
+    keep = np.r_[True, values[1:] != values[:-1]]
+    return ts[keep], values[keep]
+
+
+def export_queue_counters(connection, outfile, writer, gpuId, rangeStringOp, t_end, resolution=1000, batch_size=DEFAULT_BATCH_SIZE):
+    """Create the QueueDepth and Idle counters for one GPU"""
+    starts, ends = load_op_times(connection, add_predicate(rangeStringOp, "rocpd_op.gpuId = %d" % gpuId), batch_size)
+    ts, depth = queue_depth_samples(starts, ends, resolution)
+    if len(ts) == 0:
+        return 0
+    idle = (depth == 0).astype(np.int64)
+    changed = np.r_[True, idle[1:] != idle[:-1]]
+    idle_ts, idle = ts[changed], idle[changed]
+
+    # Counters should extend to the last event in the trace.  This means they need to have a value at Tend.
+    if t_end > ts[-1]:
+        ts, depth = np.r_[ts, t_end], np.r_[depth, depth[-1]]
+        idle_ts, idle = np.r_[idle_ts, t_end], np.r_[idle, idle[-1]]
+
+    outfile.write(writer.format_counter(gpuId, "Idle", "idle", idle_ts, idle))
+    outfile.write(writer.format_counter(gpuId, "QueueDepth", "depth", ts, depth))
+    return len(ts) + len(idle_ts)
+
+
+def export_monitor(connection, outfile, writer, rangeStringMonitor, batch_size=DEFAULT_BATCH_SIZE):
+    """Create SMI counters from rocpd_monitor"""
     try:
-        name = row[0] if len(row[2])==0 else row[2]
-        outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\",\"args\":{\"desc\":\"%s\"}}\n"%(row[3], row[4], name, row[5], row[6], row[0]))
-    except ValueError:
-        outfile.write("")
-'''
+        cursor = connection.execute("select deviceId, monitorType, start, value from rocpd_monitor %s" % rangeStringMonitor)
+        endpoints = "select distinct deviceId, monitorType, max(end), value from rocpd_monitor %s group by deviceId, monitorType" % rangeStringMonitor
+    except sqlite3.OperationalError:
+        print("Did not find SMI data")
+        return 0
+
+    empty = b"" if writer.binary else ""
+
+    def format_rows(rows):
+        series = defaultdict(lambda: ([], []))
+        for deviceId, monitorType, start, value in rows:
+            samples = series[(deviceId, monitorType)]
+            samples[0].append(start)
+            samples[1].append(float(value))
+        return empty.join([writer.format_counter(deviceId, monitorType, monitorType, ts, values)
+                           for (deviceId, monitorType), (ts, values) in series.items()])
+
+    count = write_batches(cursor, outfile, format_rows, batch_size)
+    # Output the endpoints of the last range
+    return count + write_batches(connection.execute(endpoints), outfile, format_rows, batch_size)
+
 
-for row in connection.execute("select A.string as optype, B.string as description, gpuId, queueId, rocpd_op.start/1000, (rocpd_op.end-rocpd_op.start) / 1000 from rocpd_op INNER JOIN rocpd_string A on A.id = rocpd_op.opType_id INNER Join rocpd_string B on B.id = rocpd_op.description_id %s"%(rangeStringOp)):
+class GpuFrame:
+    """The ops one UserMarker launched back to back, and the GPU queues they ran on."""
+
+    __slots__ = ("marker", "name", "start", "end", "queues", "totalOps")
+
+    def __init__(self, marker, name, gpuId, queueId, start, end):
+        self.marker = marker
+        self.name = name
+        self.start = start
+        self.end = end
+        self.queues = {(gpuId, queueId): None}
+        self.totalOps = 1
+
+    def rows(self):
+        # Start 1us early so the frame encloses its first op on the queue lane
+        return [(self.name, gpuId, queueId, self.start - 1000, self.end - self.start + 1000, self.totalOps)
+                for gpuId, queueId in self.queues]
+
+
+def export_frames(connection, outfile, writer, strings, rangeStringApi, gap_ns=200000, batch_size=DEFAULT_BATCH_SIZE):
+    """Create "faux calling stack frames" on the GPU queues from UserMarker ranges.
+
+    Markers and op launches are read as two cursors ordered by api start and
+    merged in a single pass.  Each host thread keeps a stack of its open
+    markers and one frame under construction; an op launched under the same
+    innermost marker within gap_ns of the frame extends it, anything else
+    starts a new frame.  Memory is bounded by the number of open markers.
+    """
+    markerFilter = add_predicate(rangeStringApi, "rocpd_api.apiName_id in (select id from rocpd_string where string = 'UserMarker') and rocpd_api.start != rocpd_api.end")
+    threads = connection.execute("select distinct pid, tid from rocpd_api %s" % markerFilter).fetchall()
+    if not threads:
+        return 0
+    threadFilter = add_predicate(rangeStringApi, "(rocpd_api.pid, rocpd_api.tid) in (values %s)" % ",".join("(%d,%d)" % thread for thread in threads))
+
+    markers = connection.execute("select rocpd_api.start, 0, pid, tid, rocpd_api.id, args_id, rocpd_api.end from rocpd_api %s order by rocpd_api.start" % markerFilter)
+    launches = connection.execute("select rocpd_api.start, 1, pid, tid, gpuId, queueId, rocpd_op.start, rocpd_op.end from rocpd_api_ops INNER JOIN rocpd_api on rocpd_api_ops.api_id = rocpd_api.id INNER JOIN rocpd_op on rocpd_api_ops.op_id = rocpd_op.id %s order by rocpd_api.start" % threadFilter)
+
+    stacks = defaultdict(list)   # (pid, tid) -> open markers, innermost last, as (id, label)
+    current = {}                 # (pid, tid) -> GpuFrame under construction
+    ending = []                  # heap of (end, pid, tid, marker id) for open markers
+    pending = []
+    count = 0
+
+    def flush(frame):
+        nonlocal count
+        pending.extend(frame.rows())
+        if len(pending) >= batch_size:
+            outfile.write(writer.format_frames(pending))
+            count += len(pending)
+            pending.clear()
+
+    def close_markers(ts):
+        # A marker ending at ts still owns the ops launched at ts
+        while ending and ending[0][0] < ts:
+            end, pid, tid, marker = heapq.heappop(ending)
+            key = (pid, tid)
+            stack = stacks[key]
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == marker:
+                    del stack[i]
+                    break
+            frame = current.get(key)
+            if frame is not None and frame.marker == marker:
+                flush(current.pop(key))
+
+    for row in heapq.merge(markers, launches):
+        ts, kind, pid, tid = row[0], row[1], row[2], row[3]
+        key = (pid, tid)
+        if kind == 0:
+            close_markers(ts + 1)
+            stacks[key].append((row[4], strings[row[5]]))
+            heapq.heappush(ending, (row[6], pid, tid, row[4]))
+            continue
+
+        close_markers(ts)
+        stack = stacks.get(key)
+        if not stack:
+            continue
+        marker, label = stack[-1]
+        gpuId, queueId, start, end = row[4], row[5], row[6], row[7]
+        frame = current.get(key)
+        if frame is not None and frame.marker == marker and start <= frame.end + gap_ns and end >= frame.start - gap_ns:
+            frame.start = min(frame.start, start)
+            frame.end = max(frame.end, end)
+            frame.queues[(gpuId, queueId)] = None
+            frame.totalOps += 1
+        else:
+            if frame is not None:
+                flush(frame)
+            current[key] = GpuFrame(marker, label, gpuId, queueId, start, end)
+
+    for frame in current.values():
+        pending.extend(frame.rows())
+    if pending:
+        outfile.write(writer.format_frames(pending))
+        count += len(pending)
+    return count
+
+
+def export_apis(connection, outfile, writer, rangeStringApi, batch_size=DEFAULT_BATCH_SIZE):
+    """Output apis on the host threads.  UserMarker ranges are named by their label,
+    instantaneous UserMarkers become "mark" instants."""
+    row = connection.execute("select id from rocpd_string where string = 'UserMarker'").fetchone()
+    marker = row[0] if row else -1
+    cursor = connection.execute("select case when apiName_id = %d then args_id else apiName_id end, args_id, pid, tid, rocpd_api.start, (rocpd_api.end-rocpd_api.start), (apiName_id = %d and rocpd_api.start = rocpd_api.end) from rocpd_api %s order by rocpd_api.id" % (marker, marker, rangeStringApi))
+    return write_batches(cursor, outfile, writer.format_apis, batch_size)
+
+
+class LatencyHistogram:
+    """Launch latency (op start - api start) counted in log-spaced buckets.
+
+    Memory stays constant however many ops are added; percentiles are
+    reported as the upper edge of the bucket they fall in.
+    """
+
+    # ns: [0, 100ns), then 20 buckets per decade up to 100s
+    EDGES = np.r_[0, np.logspace(2, 11, 9 * 20 + 1)]
+
+    def __init__(self):
+        self.counts = np.zeros(len(self.EDGES), dtype=np.int64)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, latency):
+        if len(latency) == 0:
+            return
+        bucket = np.clip(np.searchsorted(self.EDGES, latency, side="right") - 1, 0, len(self.EDGES) - 1)
+        self.counts += np.bincount(bucket, minlength=len(self.EDGES))
+        self.count += len(latency)
+        self.total += int(latency.sum())
+        self.min = int(latency.min()) if self.min is None else min(self.min, int(latency.min()))
+        self.max = int(latency.max()) if self.max is None else max(self.max, int(latency.max()))
+
+    def percentile(self, q):
+        # Upper edge of the bucket, kept inside the observed range
+        bucket = int(np.searchsorted(np.cumsum(self.counts), q / 100 * self.count))
+        return min(max(int(self.EDGES[min(bucket + 1, len(self.EDGES) - 1)]), self.min), self.max)
+
+    def summary(self):
+        if not self.count:
+            return "Launch latency: no api->op links"
+        return ("Launch latency (us): " +
+                f"min {self.min / 1000:.1f}  avg {self.total / self.count / 1000:.1f}  " +
+                "  ".join(f"p{q} {self.percentile(q) / 1000:.1f}" for q in (50, 90, 99)) +
+                f"  max {self.max / 1000:.1f}  ({self.count} ops)")
+
+    def write_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            out = csv.writer(f)
+            out.writerow(["from_us", "to_us", "count"])
+            upper = np.r_[self.EDGES[1:], np.inf]
+            for low, high, count in zip(self.EDGES, upper, self.counts.tolist()):
+                if count:
+                    out.writerow([f"{low / 1000:g}", f"{high / 1000:g}", count])
+
+
+def export_flows(connection, outfile, writer, rangeStringApi, latency=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Output api->op linkage as flow arrows.
+
+    rocpd_api_ops is scanned in id order and its api and op are looked up by
+    primary key (CROSS JOIN keeps sqlite from reordering the loops), so rows
+    stream out without sorting or holding the join.  The arrow leaves the
+    api 2us before it returns, or at the op start if that is earlier.
+    """
+    cursor = connection.execute("select rocpd_api_ops.id, pid, tid, rocpd_api.start, rocpd_api.end, gpuId, queueId, rocpd_op.start from rocpd_api_ops CROSS JOIN rocpd_api on rocpd_api_ops.api_id = rocpd_api.id CROSS JOIN rocpd_op on rocpd_api_ops.op_id = rocpd_op.id %s order by rocpd_api_ops.id" % rangeStringApi)
+
+    def format_rows(rows):
+        if latency is not None:
+            times = np.array([(row[3], row[7]) for row in rows], dtype=np.int64)
+            latency.add(times[:, 1] - times[:, 0])
+        return writer.format_flows([(id, pid, tid, min(api_end - 2000, op_start), gpuId, queueId, op_start)
+                                    for id, pid, tid, api_start, api_end, gpuId, queueId, op_start in rows])
+
+    return write_batches(cursor, outfile, format_rows, batch_size)
+
+
+def collapse_runs(queues, starts, ends, keep, threshold):
+    """Find the runs of consecutive short ops on each queue.
+
+    The arrays are sorted by (queue, start).  An op is short when it is not in
+    keep and runs for less than threshold ns.  A run ends at a long op, a
+    queue change or an idle gap of threshold or more, so a summary never
+    hides a visible gap.  Returns the short and run-start masks.
+    """
+    short = ~keep & (ends - starts < threshold)
+    new_queue = np.r_[True, queues[1:] != queues[:-1]]
+    gap = starts - np.r_[0, ends[:-1]]
+    run_start = short & (new_queue | np.r_[True, ~short[:-1]] | (gap >= threshold))
+    return short, run_start
+
+
+def choose_threshold(queues, starts, ends, keep, budget, minimum=0):
+    """The smallest threshold (ns, at least minimum) whose collapsed event count fits budget."""
+    candidates = [minimum] + [t * 1000 for t in LOD_THRESHOLDS_US if t * 1000 > minimum]
+    for threshold in candidates:
+        short, run_start = collapse_runs(queues, starts, ends, keep, threshold)
+        if len(starts) - short.sum() + run_start.sum() <= budget:
+            break
+    return threshold
+
+
+def top_names(runs, names, count):
+    """The count most frequent names of every run, as (run, name, occurrences) arrays."""
+    base = int(names.max()) + 1
+    keys, occurrences = np.unique(runs * base + names, return_counts=True)
+    runs, names = keys // base, keys % base
+    order = np.lexsort((-occurrences, runs))
+    runs, names, occurrences = runs[order], names[order], occurrences[order]
+    first = np.r_[0, np.flatnonzero(runs[1:] != runs[:-1]) + 1]
+    rank = np.arange(len(runs)) - np.repeat(first, np.diff(np.r_[first, len(runs)]))
+    top = rank < count
+    return runs[top], names[top], occurrences[top]
+
+
+def export_lod_ops(connection, outfile, writer, strings, gpuId, rangeStringOp, lod, batch_size=DEFAULT_BATCH_SIZE):
+    """Write one GPU's ops with runs of short ops collapsed into summary slices.
+
+    The GPU's ops are loaded into arrays and sorted by queue and start.  Ops
+    that stay (long ops, ops in a detail window, runs of one) are written as
+    usual; every other run becomes one slice spanning it, with the op count,
+    the busy time and the most frequent names in its args.
+    Returns the number of ops read and events written.
+    """
+    queues, starts, ends, optypes, descriptions = load_op_columns(
+        connection, ("queueId", "rocpd_op.start", "rocpd_op.end", "opType_id", "description_id"),
+        add_predicate(rangeStringOp, "rocpd_op.gpuId = %d" % gpuId), batch_size)
+    if len(starts) == 0:
+        return 0, 0
+    order = np.lexsort((starts, queues))
+    queues, starts, ends, optypes, descriptions = queues[order], starts[order], ends[order], optypes[order], descriptions[order]
+
+    keep = np.zeros(len(starts), dtype=bool)
+    for window_start, window_end in lod.windows:
+        keep |= (starts <= window_end) & (ends >= window_start)
+    threshold = lod.threshold
+    if lod.gpu_budget:
+        threshold = choose_threshold(queues, starts, ends, keep, lod.gpu_budget, threshold)
+    short, run_start = collapse_runs(queues, starts, ends, keep, threshold)
+
+    members = np.flatnonzero(short)
+    first = np.flatnonzero(run_start[members])
+    sizes = np.diff(np.r_[first, len(members)])
+    detail = ~short
+    detail[members[first[sizes == 1]]] = True
+
+    event_count = 0
+    for chunk in range(0, len(detail), batch_size):
+        rows = np.flatnonzero(detail[chunk:chunk + batch_size]) + chunk
+        if len(rows):
+            outfile.write(writer.format_ops(zip(optypes[rows].tolist(), descriptions[rows].tolist(), [gpuId] * len(rows),
+                                                queues[rows].tolist(), starts[rows].tolist(), (ends[rows] - starts[rows]).tolist())))
+            event_count += len(rows)
+
+    if len(first):
+        # Ops without a description are named by their op type
+        names = descriptions[members]
+        unique = np.unique(names)
+        unnamed = unique[[not strings[name] for name in unique.tolist()]]
+        names = np.where(np.isin(names, unnamed), optypes[members], names)
+        top = defaultdict(list)
+        for run, name, occurrences in zip(*(column.tolist() for column in top_names(np.repeat(np.arange(len(first)), sizes), names, LOD_TOP_NAMES))):
+            top[run].append(f"{strings[name]} ({occurrences})")
+
+        multiple = np.flatnonzero(sizes > 1)
+        run_starts = starts[members[first]]
+        run_ends = np.maximum.reduceat(ends[members], first)
+        busy = np.add.reduceat(ends[members] - starts[members], first)
+        for chunk in range(0, len(multiple), batch_size):
+            runs = multiple[chunk:chunk + batch_size].tolist()
+            outfile.write(writer.format_summaries([(gpuId, int(queues[members[first[run]]]), int(run_starts[run]), int(run_ends[run] - run_starts[run]),
+                                                    int(sizes[run]), int(busy[run]), ", ".join(top[run]), threshold) for run in runs]))
+            event_count += len(runs)
+    print(f"\tGPU{gpuId}: {len(starts)} ops -> {event_count} events ({len(starts) - int(detail.sum())} ops below {threshold / 1000:g} us collapsed)", flush=True)
+    return len(starts), event_count
+
+
+def export_gpu_events(connection, outfile, writer, args, rangeStringOp, gpuIds, t_end, lod=None):
+    """Everything that splits by GPU: ops, graph launches and the per-GPU counters."""
+    if lod is None:
+        op_count = export_ops(connection, outfile, writer, rangeStringOp, args.batch_size)
+    else:
+        strings = load_strings(args.input_rpd, connection)
+        op_count = sum(export_lod_ops(connection, outfile, writer, strings, gpuId, rangeStringOp, lod, args.batch_size)[0]
+                       for gpuId in gpuIds)
+    graph_count = export_graphs(connection, outfile, writer, rangeStringOp, args.batch_size)
+    if args.counters:
+        for gpuId in gpuIds:
+            export_queue_counters(connection, outfile, writer, gpuId, rangeStringOp, t_end,
+                                  max(1, int(args.counter_resolution * 1000)), args.batch_size)
+    return op_count, graph_count
+
+
+def export_gpu_fragment(args, fragment_path, gpuId, rangeStringOp, t_end, sequence_base=0, lod=None):
+    """Worker for --jobs: write one GPU's events to a fragment file.
+
+    Each worker opens its own read-only connection.  Fragments carry the same
+    event records as the single process path, so they can be spliced between
+    the trace header and trailer byte for byte.  Perfetto fragments get their
+    own range of packet sequence ids, offset by sequence_base.
+    """
+    connection = connect_readonly(args.input_rpd)
+    writer = make_writer(args.format, load_strings(args.input_rpd, connection), sequence_base=sequence_base + ((gpuId + 1) << 16))
+    rangeStringGpu = add_predicate(rangeStringOp, "rocpd_op.gpuId = %d" % gpuId)
+    outfile = open_output(fragment_path, args.compress_level, binary=writer.binary)
+    op_count, graph_count = export_gpu_events(connection, outfile, writer, args, rangeStringGpu, [gpuId], t_end, lod)
+    outfile.close()
+    connection.close()
+    return op_count, graph_count
+
+
+def export_parallel(args, gpuIds, rangeStringOp, t_end, sequence_base=0, lod=None):
+    """Export every GPU into its own fragment in a process pool and append them to the output.
+
+    The fragments use the output's compression, and gzip members concatenate
+    into a valid gzip stream, so stitching is a plain byte copy.
+    """
+    output_path = args.output_json
+    suffix = ".frag.gz" if output_path.endswith(".gz") else ".frag"
+    fragment_dir = tempfile.mkdtemp(prefix="rpd2tracing_", dir=os.path.dirname(os.path.abspath(output_path)))
+    fragments = [os.path.join(fragment_dir, "gpu%d%s" % (gpuId, suffix)) for gpuId in gpuIds]
+    op_count = graph_count = 0
     try:
-        name =  row[0] if len(row[1])==0 else row[1]
-        outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\",\"args\":{\"desc\":\"%s\"}}\n"%(row[2], row[3], name, row[4], row[5], row[0]))
-    except ValueError:
-        outfile.write("")
-
-#Output Graph executions on GPU
-try:
-    for row in connection.execute('select graphExec, gpuId, queueId, min(start)/1000, (max(end)-min(start))/1000, count(*) from rocpd_graphLaunchapi A join rocpd_api_ops B on B.api_id = A.api_ptr_id join rocpd_op C on C.id = B.op_id %s group by api_ptr_id'%(rangeStringMonitor)):
-        try:
-            outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\",\"args\":{\"kernels\":\"%s\"}}\n"%(row[1], row[2], f'Graph {row[0]}', row[3], row[4], row[5]))
-        except ValueError:
-            outfile.write("")
-except:
-    pass
-
-##Output apis
-#for row in connection.execute("select A.string as apiName, B.string as args, pid, tid, rocpd_api.start/1000, (rocpd_api.end-rocpd_api.start) / 1000, (rocpd_api.end != rocpd_api.start) as has_duration from rocpd_api INNER JOIN rocpd_string A on A.id = rocpd_api.apiName_id INNER Join rocpd_string B on B.id = rocpd_api.args_id %s order by rocpd_api.id"%(rangeStringApi)):
-#    try:
-#        if row[0]=="UserMarker":
-#            if row[6] == 0:	# instantanuous "mark" messages
-#                outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"ph\":\"i\",\"s\":\"p\",\"args\":{\"desc\":\"%s\"}}\n"%(row[2], row[3], row[1].replace('"',''), row[4], row[1].replace('"','')))
-#            else:
-#                outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\",\"args\":{\"desc\":\"%s\"}}\n"%(row[2], row[3], row[1].replace('"',''), row[4], row[5], row[1].replace('"','')))
-#        else:
-#          outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\",\"args\":{\"desc\":\"%s\"}}\n"%(row[2], row[3], row[0], row[4], row[5], row[1].replace('"','').replace('\t','')))
-#    except ValueError:
-#        outfile.write("")
-#
-##Output api->op linkage
-#for row in connection.execute("select rocpd_api_ops.id, pid, tid, gpuId, queueId, rocpd_api.end/1000 - 2, rocpd_op.start/1000 from rocpd_api_ops INNER JOIN rocpd_api on rocpd_api_ops.api_id = rocpd_api.id INNER JOIN rocpd_op on rocpd_api_ops.op_id = rocpd_op.id %s"%(rangeStringApi)):
-#    try:
-#        fromtime = row[5] if row[5] < row[6] else row[6]
-#        outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"cat\":\"api_op\",\"name\":\"api_op\",\"ts\":\"%s\",\"id\":\"%s\",\"ph\":\"s\"}\n"%(row[1], row[2], fromtime, row[0]))
-#        outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"cat\":\"api_op\",\"name\":\"api_op\",\"ts\":\"%s\",\"id\":\"%s\",\"ph\":\"f\", \"bp\":\"e\"}\n"%(row[3], row[4], row[6], row[0]))
-#    except ValueError:
-#        outfile.write("")
-#
-#try:
-#    for row in connection.execute("select A.string as apiName, B.string as args, pid, tid, rocpd_hsaApi.start/1000, (rocpd_hsaApi.end-rocpd_hsaApi.start) / 1000 from rocpd_hsaApi INNER JOIN rocpd_string A on A.id = rocpd_hsaApi.apiName_id INNER Join rocpd_string B on B.id = rocpd_hsaApi.args_id %s order by rocpd_hsaApi.id"%(rangeStringApi)):
-#        try:
-#            outfile.write(",{\"pid\":\"%s\",\"tid\":\"%s\",\"name\":\"%s\",\"ts\":\"%s\",\"dur\":\"%s\",\"ph\":\"X\",\"args\":{\"desc\":\"%s\"}}\n"%(row[2], row[3]+1, row[0], row[4], row[5], row[1].replace('"','')))
-#        except ValueError:
-#            outfile.write("")
-#except:
-#    pass
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(export_gpu_fragment, args, fragment, gpuId, rangeStringOp, t_end, sequence_base, lod)
+                       for gpuId, fragment in zip(gpuIds, fragments)]
+            for gpuId, future in zip(gpuIds, futures):
+                ops, graphs = future.result()
+                print(f"\tGPU{gpuId}: {ops} ops, {graphs} graph launches")
+                op_count += ops
+                graph_count += graphs
+        with open(output_path, 'ab') as outfile:
+            for fragment in fragments:
+                with open(fragment, 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile, 16 << 20)
+    finally:
+        shutil.rmtree(fragment_dir, ignore_errors=True)
+    return op_count, graph_count
 
 
-#
-# Counters
-#
+def main():
+    args = parse_args()
 
-# Counters should extend to the last event in the trace.  This means they need to have a value at Tend.
-# Figure out when that is
+    if args.create_index:
+        ensure_start_indexes(args.input_rpd, by_gpu=args.jobs > 1)
 
-#T_end = 0
-#for row in connection.execute("SELECT max(end)/1000 from (SELECT end from rocpd_api UNION ALL SELECT end from rocpd_op)"):
-#    T_end = int(row[0])
-#if args.end:
-#    T_end = end_time
-#
-## Loop over GPU for per-gpu counters
-#gpuIdsPresent = []
-#for row in connection.execute("SELECT DISTINCT gpuId FROM rocpd_op"):
-#    gpuIdsPresent.append(row[0])
-#
-#for gpuId in gpuIdsPresent:
-#    #print(f"Creating counters for: {gpuId}")
-#
-#    #Create the queue depth counter
-#    depth = 0
-#    idle = 1
-#    for row in connection.execute("select * from (select rocpd_api.start/1000 as ts, \"1\" from rocpd_api_ops INNER JOIN rocpd_api on rocpd_api_ops.api_id = rocpd_api.id INNER JOIN rocpd_op on rocpd_api_ops.op_id = rocpd_op.id AND rocpd_op.gpuId = %s %s UNION ALL select rocpd_op.end/1000, \"-1\" from rocpd_api_ops INNER JOIN rocpd_api on rocpd_api_ops.api_id = rocpd_api.id INNER JOIN rocpd_op on rocpd_api_ops.op_id = rocpd_op.id AND rocpd_op.gpuId = %s %s) order by ts"%(gpuId, rangeStringOp, gpuId, rangeStringOp)):
-#        try:
-#           if idle and int(row[1]) > 0:
-#               idle = 0
-#               outfile.write(',{"pid":"%s","name":"Idle","ph":"C","ts":%s,"args":{"idle":%s}}\n'%(gpuId, row[0], idle))
-#           if depth == 1 and int(row[1]) < 0:
-#               idle = 1
-#               outfile.write(',{"pid":"%s","name":"Idle","ph":"C","ts":%s,"args":{"idle":%s}}\n'%(gpuId, row[0], idle))
-#           depth = depth + int(row[1])
-#           outfile.write(',{"pid":"%s","name":"QueueDepth","ph":"C","ts":%s,"args":{"depth":%s}}\n'%(gpuId, row[0], depth))
-#        except ValueError:
-#            outfile.write("")
-#    if T_end > 0:
-#            outfile.write(',{"pid":"%s","name":"Idle","ph":"C","ts":%s,"args":{"idle":%s}}\n'%(gpuId, T_end, idle))
-#            outfile.write(',{"pid":"%s","name":"QueueDepth","ph":"C","ts":%s,"args":{"depth":%s}}\n'%(gpuId, T_end, depth))
-#
-## Create SMI counters
-#try:
-#    for row in connection.execute("select deviceId, monitorType, start/1000, value from rocpd_monitor %s"%(rangeStringMonitor)):
-#        outfile.write(',{"pid":"%s","name":"%s","ph":"C","ts":%s,"args":{"%s":%s}}\n'%(row[0], row[1], row[2], row[1], row[3]))
-#    # Output the endpoints of the last range
-#    for row in connection.execute("select distinct deviceId, monitorType, max(end)/1000, value from rocpd_monitor %s group by deviceId, monitorType"%(rangeStringMonitor)):
-#        outfile.write(',{"pid":"%s","name":"%s","ph":"C","ts":%s,"args":{"%s":%s}}\n'%(row[0], row[1], row[2], row[1], row[3]))
-#except:
-#    print("Did not find SMI data")
-#
-##Create the (global) memory counter
-#sizes = {}    # address -> size
-#totalSize = 0
-#exp = re.compile("^ptr\((.*)\)\s+size\((.*)\)$")
-#exp2 = re.compile("^ptr\((.*)\)$")
-#for row in connection.execute("SELECT rocpd_api.end/1000 as ts, B.string, '1'  FROM rocpd_api INNER JOIN rocpd_string A ON A.id=rocpd_api.apiName_id INNER JOIN rocpd_string B ON B.id=rocpd_api.args_id WHERE A.string='hipFree' UNION ALL SELECT rocpd_api.start/1000, B.string, '0' FROM rocpd_api INNER JOIN rocpd_string A ON A.id=rocpd_api.apiName_id INNER JOIN rocpd_string B ON B.id=rocpd_api.args_id WHERE A.string='hipMalloc' ORDER BY ts asc"):
-#    try:
-#        if row[2] == '0':  #malloc
-#            m = exp.match(row[1])
-#            if m:
-#                size = int(m.group(2), 16)
-#                totalSize = totalSize + size
-#                sizes[m.group(1)] = size
-#                outfile.write(',{"pid":"0","name":"Allocated Memory","ph":"C","ts":%s,"args":{"depth":%s}}\n'%(row[0],totalSize))
-#        else:              #free
-#            m = exp2.match(row[1])
-#            if m:
-#                try:    # Sometimes free addresses are not valid or listed
-#                    size = sizes[m.group(1)]
-#                    sizes[m.group(1)] = 0
-#                    totalSize = totalSize - size;
-#                    outfile.write(',{"pid":"0","name":"Allocated Memory","ph":"C","ts":%s,"args":{"depth":%s}}\n'%(row[0],totalSize))
-#                except KeyError:
-#                    pass
-#    except ValueError:
-#        outfile.write("")
-#if T_end > 0:
-#    outfile.write(',{"pid":"0","name":"Allocated Memory","ph":"C","ts":%s,"args":{"depth":%s}}\n'%(T_end,totalSize))
-#
-##Create "faux calling stack frame" on gpu ops traceS
-#stacks = {}          # Call stacks built from UserMarker entres.     Key is 'pid,tid'
-#currentFrame = {}    #"Current GPU frame" (id, name, start, end).    Key is 'pid,tid'
-#
-#class GpuFrame:
-#    def __init__(self):
-#        self.id = 0
-#        self.name = ''
-#        self.start = 0
-#        self.end = 0
-#        self.gpus = []
-#        self.totalOps = 0
-#
-## FIXME: include 'start' (in ns) so we can ORDER BY it and break ties?
-#for row in connection.execute("SELECT '0', start/1000, pid, tid, B.string as label, '','','', '' from rocpd_api INNER JOIN rocpd_string A on A.id = rocpd_api.apiName_id AND A.string = 'UserMarker' INNER JOIN rocpd_string B on B.id = rocpd_api.args_id AND rocpd_api.start/1000 != rocpd_api.end/1000 %s UNION ALL SELECT '1', end/1000, pid, tid, B.string as label, '','','', '' from rocpd_api INNER JOIN rocpd_string A on A.id = rocpd_api.apiName_id AND A.string = 'UserMarker' INNER JOIN rocpd_string B on B.id = rocpd_api.args_id AND rocpd_api.start/1000 != rocpd_api.end/1000 %s UNION ALL SELECT '2', rocpd_api.start/1000, pid, tid, '' as label, gpuId, queueId, rocpd_op.start/1000, rocpd_op.end/1000 from rocpd_api_ops INNER JOIN rocpd_api ON rocpd_api_ops.api_id = rocpd_api.id INNER JOIN rocpd_op ON rocpd_api_ops.op_id = rocpd_op.id %s ORDER BY start/1000 asc"%(rangeStringApi, rangeStringApi, rangeStringApi)):
-#    try:
-#        key = (row[2], row[3])    # Key is 'pid,tid'
-#        if row[0] == '0':  # Frame start
-#            if key not in stacks:
-#                stacks[key] = []
-#            stack = stacks[key].append((row[1], row[4]))
-#            #print(f"0: new api frame: pid_tid={key} -> stack={stacks}")
-#
-#        elif row[0] == '1':  #Frame end
-#            completed = stacks[key].pop()
-#            #print(f"1: end api frame: pid_tid={key} -> stack={stacks}")
-#
-#        elif row[0] == '2':  # API + Op
-#            if key in stacks and len(stacks[key]) > 0:
-#                frame = stacks[key][-1]
-#                #print(f"2: Op on {frame} ({len(stacks[key])})")
-#                gpuFrame = None
-#                if key not in currentFrame:    # First op under the current api frame
-#                    gpuFrame = GpuFrame()
-#                    gpuFrame.id = frame[0]
-#                    gpuFrame.name = frame[1]
-#                    gpuFrame.start = row[7]
-#                    gpuFrame.end = row[8]
-#                    gpuFrame.gpus.append((row[5], row[6]))
-#                    gpuFrame.totalOps = 1
-#                    #print(f"2a: new frame: {gpuFrame.gpus} {gpuFrame.start} {gpuFrame.end} {gpuFrame.end - gpuFrame.start}")
-#                else:
-#                    gpuFrame = currentFrame[key]
-#                    # Another op under the same frame -> union them (but only if they are butt together)
-#                    if gpuFrame.id == frame[0] and gpuFrame.name == frame[1] and (abs(row[7] - gpuFrame.end) < 200 or abs(gpuFrame.start - row[8]) < 200): 
-#                    #if gpuFrame.id == frame[0] and gpuFrame.name == frame[1]:    # Another op under the same frame -> union them
-#                    #if False:   # Turn off frame joining
-#                        if row[7] < gpuFrame.start: gpuFrame.start = row[7]
-#                        if row[8] > gpuFrame.end: gpuFrame.end = row[8] 
-#                        if (row[5], row[6]) not in gpuFrame.gpus: gpuFrame.gpus.append((row[5], row[6]))
-#                        gpuFrame.totalOps = gpuFrame.totalOps + 1
-#                        #print(f"2c: union frame: {gpuFrame.gpus} {gpuFrame.start} {gpuFrame.end} {gpuFrame.end - gpuFrame.start}")
-#
-#                    else:    #This is a new frame - dump the last and make new
-#                        gpuFrame = currentFrame[key]
-#                        for dest in gpuFrame.gpus:
-#                            #print(f"2: OUTPUT: dest={dest} time={gpuFrame.start} -> {gpuFrame.end} Duration={gpuFrame.end - gpuFrame.start} TotalOps={gpuFrame.totalOps}")
-#                            outfile.write(',{"pid":"%s","tid":"%s","name":"%s","ts":"%s","dur":"%s","ph":"X","args":{"desc":"%s"}}\n'%(dest[0], dest[1], gpuFrame.name.replace('"',''), gpuFrame.start - 1, gpuFrame.end - gpuFrame.start + 1, f"UserMarker frame: {gpuFrame.totalOps} ops"))
-#                        currentFrame.pop(key)
-#
-#                        # make the first op under the new frame
-#                        gpuFrame = GpuFrame()
-#                        gpuFrame.id = frame[0]
-#                        gpuFrame.name = frame[1]
-#                        gpuFrame.start = row[7]
-#                        gpuFrame.end = row[8]
-#                        gpuFrame.gpus.append((row[5], row[6]))
-#                        gpuFrame.totalOps = 1
-#                        #print(f"2b: new frame: {gpuFrame.gpus} {gpuFrame.start} {gpuFrame.end} {gpuFrame.end - gpuFrame.start}")
-#
-#                currentFrame[key] = gpuFrame
-#
-#    except ValueError:
-#        outfile.write("")
+    connection = sqlite3.connect(args.input_rpd)
+
+    min_time = connection.execute("select MIN(start) from rocpd_api;").fetchall()[0][0]
+    max_time = connection.execute("select MAX(end) from rocpd_api;").fetchall()[0][0]
+    if (min_time == None):
+        raise Exception("Trace file is empty.")
+
+    print("Timestamps:")
+    print(f"\t    first: \t{min_time/1000} us")
+    print(f"\t     last: \t{max_time/1000} us")
+    print(f"\t duration: \t{(max_time-min_time) / 1000000000} seconds")
+
+    start_time = min_time/1000
+    end_time = max_time/1000
+
+    if args.start:
+        start_time = parse_time(args.start, min_time, max_time)
+    if args.end:
+        end_time = parse_time(args.end, min_time, max_time)
+
+    rangeStringApi, rangeStringOp, rangeStringMonitor = time_window_filters(
+        int(start_time * 1000) if args.start else None,
+        int(end_time * 1000) if args.end else None)
+
+    rangeStringFlow = rangeStringApi
+    sequence_base = 0
+    if args.watermark:
+        watermark = read_watermark(args.watermark, args.input_rpd)
+        marks = table_high_marks(connection)
+        since = watermark_filters(watermark["marks"], marks)
+        rangeStringApi = add_predicate(rangeStringApi, since["rocpd_api"])
+        rangeStringOp = add_predicate(rangeStringOp, since["rocpd_op"])
+        rangeStringMonitor = add_predicate(rangeStringMonitor, since["rocpd_monitor"])
+        rangeStringFlow = add_predicate(rangeStringApi, since["rocpd_api_ops"])
+        # Segments appended to one perfetto trace need their own packet sequence ids
+        sequence_base = (len(watermark["segments"]) % 256) << 24
+        print(f"\nSegment {len(watermark['segments']) + 1}: {marks['rocpd_op'] - watermark['marks']['rocpd_op']} new ops, {marks['rocpd_api'] - watermark['marks']['rocpd_api']} new apis")
+
+    print("\nFilter: %s"%(rangeStringApi))
+    print(f"Output duration: {(end_time-start_time)/1000000} seconds")
+
+    strings = load_strings(args.input_rpd, connection)
+    writer = make_writer(args.format, strings, sequence_base + 1)
+    outfile = open_output(args.output_json, args.compress_level, mode='a' if args.append else 'w', binary=writer.binary)
+
+    outfile.write(writer.header())
+
+    gpuIds = [row[0] for row in connection.execute("select distinct gpuId from rocpd_op")]
+    write_metadata(connection, outfile, writer, gpuIds)
+
+    lod = None
+    if args.lod_threshold is not None or args.target_events:
+        windows = []
+        for window in args.detail:
+            window_start, window_end = window.split(":")
+            windows.append((int(parse_time(window_start, min_time, max_time) * 1000), int(parse_time(window_end, min_time, max_time) * 1000)))
+        lod = LodConfig(int((args.lod_threshold or 0) * 1000),
+                        args.target_events // max(1, len(gpuIds)) if args.target_events else None, windows)
+
+    # Counters should extend to the last event in the trace
+    t_end = int(end_time * 1000)
+    if args.counters and not args.end:
+        t_end = max(max_time, connection.execute("select MAX(end) from rocpd_op").fetchall()[0][0] or 0)
+
+    tic = time.perf_counter()
+    if args.jobs > 1:
+        outfile.close()
+        op_count, graph_count = export_parallel(args, gpuIds, rangeStringOp, t_end, sequence_base, lod)
+        outfile = open_output(args.output_json, args.compress_level, mode='a', binary=writer.binary)
+    else:
+        op_count, graph_count = export_gpu_events(connection, outfile, writer, args, rangeStringOp, gpuIds, t_end, lod)
+    if args.counters:
+        export_monitor(connection, outfile, writer, rangeStringMonitor, args.batch_size)
+    if args.apis:
+        api_count = export_apis(connection, outfile, writer, rangeStringApi, args.batch_size)
+        print(f"Exported {api_count} apis")
+    if args.flows:
+        latency = LatencyHistogram()
+        flow_count = export_flows(connection, outfile, writer, rangeStringFlow, latency, args.batch_size)
+        print(f"Exported {flow_count} api->op flows")
+        print(latency.summary())
+        if args.latency_csv:
+            latency.write_csv(args.latency_csv)
+    if args.frames:
+        frame_count = export_frames(connection, outfile, writer, strings, rangeStringApi, int(args.frame_gap * 1000), args.batch_size)
+        print(f"Exported {frame_count} UserMarker frames")
+    elapsed = time.perf_counter() - tic
+
+    outfile.write(writer.trailer())
+
+    outfile.close()
+    connection.close()
+
+    if args.watermark:
+        watermark["marks"] = marks
+        watermark["segments"].append({"output": os.path.abspath(args.output_json), "time": datetime.now().isoformat(timespec="seconds"), "marks": marks})
+        write_watermark(args.watermark, watermark)
+        print(f"Watermark {args.watermark}: op id {marks['rocpd_op']}, api id {marks['rocpd_api']}")
 
-outfile.write("]\n")
+    rows = op_count + graph_count
+    print(f"\nExported {op_count} ops and {graph_count} graph launches in {elapsed:.2f} seconds ({rows / max(elapsed, 1e-9):.0f} rows/sec)")
+    print(f"Wrote {args.output_json} ({os.path.getsize(args.output_json) / 1024**2:.1f} MB)")
 
-if args.format == "object":
-    outfile.write("} \n")
 
-outfile.close()
-connection.close()
+if __name__ == "__main__":
+    main()
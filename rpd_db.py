@@ -0,0 +1,123 @@
+#
+# Shared helpers for reading rpd (rocpd sqlite) files
+#
+
+import os
+import time
+import pathlib
+import sqlite3
+from json.encoder import encode_basestring
+
+# Rows pulled per fetchmany() call when loading tables into memory
+LOAD_BATCH_SIZE = 100000
+
+# Tables that get a start-time index with --create-index
+START_INDEX_TABLES = ("rocpd_op", "rocpd_api", "rocpd_monitor")
+
+
+def connect_readonly(rpd_path):
+    """Open an rpd file read-only, so concurrent readers never take a write lock."""
+    return sqlite3.connect(pathlib.Path(rpd_path).resolve().as_uri() + "?mode=ro", uri=True)
+
+
+def parse_time(value, min_time, max_time):
+    """A --start/--end style time in us, either absolute or a percentage of the trace."""
+    if "%" in value:
+        return ( (max_time - min_time) * ( int( value.replace("%","") )/100 ) + min_time )/1000
+    return int(value)
+
+
+def find_start_index(connection, table):
+    """Return the name of an existing index whose leading column is start, or None."""
+    for row in connection.execute("PRAGMA index_list(%s)" % table):
+        columns = [info[2] for info in connection.execute("PRAGMA index_info(%s)" % row[1])]
+        if columns and columns[0] == "start":
+            return row[1]
+    return None
+
+
+def ensure_start_indexes(rpd_path, by_gpu=False):
+    """Create start-time indexes on the op, api and monitor tables unless one is already there.
+
+    With by_gpu an extra (gpuId, start) index lets each --jobs worker read only
+    its own GPU's rows.
+    """
+    connection = sqlite3.connect(rpd_path)
+    tables = [row[0] for row in connection.execute("select name from sqlite_master where type='table'")]
+    for table in START_INDEX_TABLES:
+        if table not in tables:
+            continue
+        index = find_start_index(connection, table)
+        if index:
+            print(f"Using index {index} on {table}(start)")
+            continue
+        tic = time.perf_counter()
+        connection.execute("CREATE INDEX IF NOT EXISTS %s_start_idx ON %s(start)" % (table, table))
+        connection.commit()
+        print(f"Created index {table}_start_idx in {time.perf_counter() - tic:.1f} seconds")
+    if by_gpu:
+        connection.execute("CREATE INDEX IF NOT EXISTS rocpd_op_gpu_start_idx ON rocpd_op(gpuId, start)")
+        connection.commit()
+    connection.close()
+
+
+class StringTable:
+    """rocpd_string loaded once into a list indexed by id.
+
+    strings[id] is the text and json[id] the same text JSON-quoted, so scans can
+    select the raw *_id columns and resolve them by index instead of joining
+    rocpd_string.  Missing ids and NULL strings resolve to "".
+    """
+
+    def __init__(self, connection):
+        max_id = connection.execute("select max(id) from rocpd_string").fetchone()[0] or 0
+        strings = [""] * (max_id + 1)
+        cursor = connection.execute("select id, string from rocpd_string")
+        while True:
+            rows = cursor.fetchmany(LOAD_BATCH_SIZE)
+            if not rows:
+                break
+            for id, string in rows:
+                if string is not None:
+                    strings[id] = string
+        self.strings = strings
+        self._json = None
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, id):
+        return self.strings[id]
+
+    @property
+    def json(self):
+        """The JSON-quoted strings, escaped on first use."""
+        if self._json is None:
+            self._json = list(map(encode_basestring, self.strings))
+        return self._json
+
+
+# (path, size, mtime) -> StringTable
+_string_tables = {}
+
+
+def load_strings(rpd_path, connection=None):
+    """Return the StringTable of an rpd file, reading rocpd_string only once per file.
+
+    Tables are cached for the life of the process, keyed by the file's path,
+    size and mtime, so exporting several windows of the same trace reuses
+    one load.  Worker processes forked after the first load inherit it.
+    """
+    path = os.path.realpath(rpd_path)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    table = _string_tables.get(key)
+    if table is None:
+        if connection is None:
+            connection = connect_readonly(path)
+            table = StringTable(connection)
+            connection.close()
+        else:
+            table = StringTable(connection)
+        _string_tables[key] = table
+    return table
@@ -1,9 +1,30 @@
 import json
 import argparse
-import tarfile
 import os
+import re
+import gzip
+import time
+import heapq
+import shutil
+import tempfile
 from tqdm import tqdm  # Importing tqdm for the progress bar
 
+from trace_archive import COMPRESSIONS, ChunkWriter, manifest_path, write_keyed_chunks, write_manifest, write_trace_chunks
+
+# Characters read from the input per block
+BLOCK_SIZE = 16 * 1024 ** 2
+
+# Default memory budget for buffered events, in MB
+DEFAULT_MEMORY_MB = 1024
+
+# Most spilled runs merged at once, so the open files stay bounded however many runs there are
+MERGE_FAN_IN = 64
+
+# Rough per-event overhead of a buffered (ts, end, pid, tid, json) tuple, on top of the json itself
+EVENT_OVERHEAD = 160
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
 # Function to calculate the number of chunks based on the input file size
 def calculate_default_chunks(input_filename):
     # Get the size of the input file in bytes
@@ -14,77 +35,226 @@ def calculate_default_chunks(input_filename):
     num_chunks = max(1, (file_size // max_chunk_size) + (1 if file_size % max_chunk_size > 0 else 0))
     return num_chunks
 
+# Incremental reader for the traceEvents of a (possibly huge) trace file
+class TraceEventReader:
+    """
+    Yields the traceEvents of a chrome trace one event at a time.
+    The input is read in blocks and each event is decoded with raw_decode as soon
+    as it is complete, so memory stays at about one block however big the file is.
+    Accepts both the object format ({"traceEvents": [...], ...}) and the bare
+    array format.  Other top level keys of the object are kept in self.other.
+    """
+
+    def __init__(self, infile, block_size=BLOCK_SIZE):
+        self.infile = infile
+        self.block_size = block_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.other = {}
+
+    # Append the next block to the unread part of the buffer
+    def _fill(self):
+        data = self.infile.read(self.block_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    # Next non-whitespace character, or '' at the end of the input
+    def _peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"Expected {char!r} in trace at {self.buffer[self.pos:self.pos + 40]!r}")
+        self.pos += 1
+
+    # Decode one JSON value, reading more input until it is complete
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the very end of the buffer may continue in the next block
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _array(self):
+        self._expect("[")
+        if self._peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self._value()
+            separator = self._peek()
+            self.pos += 1
+            if separator == "]":
+                return
+            if separator != ",":
+                raise ValueError(f"Expected ',' or ']' in traceEvents, got {separator!r}")
+
+    def __iter__(self):
+        if self._peek() == "[":
+            yield from self._array()
+            return
+        self._expect("{")
+        while self._peek() != "}":
+            key = self._value()
+            self._expect(":")
+            if key == "traceEvents":
+                yield from self._array()
+            else:
+                self.other[key] = self._value()
+            if self._peek() == ",":
+                self.pos += 1
+        self.pos += 1
+
+# Open a trace for reading, decompressing .gz input on the fly
+def open_trace(input_filename):
+    if input_filename.endswith(".gz"):
+        return gzip.open(input_filename, 'rt', encoding='utf-8')
+    return open(input_filename, 'r', encoding='utf-8')
+
+# Write one sorted run to a temporary file, one "[ts,end,pid,tid]<TAB>event" line per event
+def spill_run(run, tmp_dir):
+    fd, path = tempfile.mkstemp(suffix=".run", dir=tmp_dir)
+    with os.fdopen(fd, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.writelines(f"{json.dumps([ts, end, pid, tid])}\t{line}\n" for ts, end, pid, tid, line in run)
+    return path
+
+# Stream a spilled run back as (ts, end, pid, tid, event) records
+def read_run(path):
+    with open(path, 'r', encoding='utf-8', buffering=1 << 20) as f:
+        for row in f:
+            key, line = row.rstrip("\n").split("\t", 1)
+            ts, end, pid, tid = json.loads(key)
+            yield ts, end, pid, tid, line
+
+# Merge spilled runs in passes of at most MERGE_FAN_IN until the final merge fits the limit
+def merge_runs(runs, tmp_dir, fan_in=MERGE_FAN_IN):
+    """
+    Reduce runs to fewer than fan_in (leaving room for the in-memory run).
+    Consecutive runs are merged in order, so ties keep the order of the input.
+    """
+    while len(runs) >= fan_in:
+        merged = []
+        for i in range(0, len(runs), fan_in):
+            group = runs[i:i + fan_in]
+            if len(group) == 1:
+                merged.extend(group)
+                continue
+            merged.append(spill_run(heapq.merge(*[read_run(path) for path in group], key=lambda x: x[0]), tmp_dir))
+            for path in group:
+                os.unlink(path)
+        runs = merged
+    return runs
+
+# Parse the input once, keeping header events and spilling sorted runs of timed events
+def sort_trace_events(input_filename, memory_bytes, tmp_dir):
+    """
+    External merge sort of the timed events by ts.
+    Events are buffered until the memory budget is reached, then the buffer
+    is sorted and spilled as a run.  Returns the header events, the number of
+    timed events, the number of runs and an iterator k-way merging the runs in
+    ts order, after merge_runs has cut them down to the fan-in.  The sort is
+    stable like list.sort: heapq.merge prefers earlier runs on ties.
+    """
+    headers = []
+    runs = []
+    run = []
+    run_bytes = 0
+    total_events = 0
+    with open_trace(input_filename) as infile:
+        for event in tqdm(TraceEventReader(infile), desc="Parsing traceEvents", unit=" events", mininterval=1):
+            line = json.dumps(event, separators=(',', ':'))
+            if 'ts' not in event:
+                headers.append(line)
+                continue
+            ts = event['ts']
+            dur = event.get('dur')
+            run.append((ts, ts + dur if isinstance(dur, (int, float)) else ts, event.get('pid'), event.get('tid'), line))
+            run_bytes += len(line) + EVENT_OVERHEAD
+            total_events += 1
+            if run_bytes >= memory_bytes:
+                run.sort(key=lambda x: x[0])
+                runs.append(spill_run(run, tmp_dir))
+                run = []
+                run_bytes = 0
+    run.sort(key=lambda x: x[0])
+    num_runs = len(runs) + 1
+    sources = [read_run(path) for path in merge_runs(runs, tmp_dir)] + [iter(run)]
+    return headers, total_events, num_runs, heapq.merge(*sources, key=lambda x: x[0])
+
 # Function to split the trace events from a given JSON file
-def split_trace_events(input_filename, num_chunks):
-    # Read the JSON file
-    with open(input_filename, 'r') as f:
-        data = json.load(f)
-
-    # Get the total number of traceEvents
-    trace_events = data['traceEvents']
-
-    # Separate header information (entries without 'ts' field) from regular traceEvents
-    headers = [event for event in trace_events if 'ts' not in event]
-    trace_events = [event for event in trace_events if 'ts' in event]
-
-    # Sort traceEvents by the 'ts' field in ascending order
-    trace_events.sort(key=lambda x: x['ts'])
-
-    total_events = len(trace_events)
-
-    # Calculate the number of events per chunk
-    chunk_size = total_events // num_chunks
-    remainder = total_events % num_chunks
-
-    # Split traceEvents into the specified number of chunks with a progress bar
-    chunks = []
-    start = 0
-
-    for i in tqdm(range(num_chunks), desc="Splitting traceEvents", unit="chunk"):
-        # If there is a remainder, the first few chunks get an extra event
-        end = start + chunk_size + (1 if i < remainder else 0)
-        chunks.append(trace_events[start:end])
-        start = end
-
-    # Save the chunks into temporary files with a progress bar
-    output_files = []
-    for i, chunk in enumerate(tqdm(chunks, desc="Writing JSON files", unit="file")):
-        output_filename = f"{input_filename.split('.')[0]}_split_{i+1}.json"
-        with open(output_filename, 'w') as outfile:
-            outfile.write('{"traceEvents":[\n')
-
-            # Write header information first
-            for header in headers:
-                json_line = json.dumps(header, separators=(',', ':'))
-                outfile.write(json_line + ',\n')  # Headers get a comma after each entry
-
-            # Write each traceEvent on its own line without extra spaces
-            for j, event in enumerate(chunk):
-                json_line = json.dumps(event, separators=(',', ':'))
-                if j < len(chunk) - 1:
-                    json_line += ','  # Add a comma after each event except the last
-                outfile.write(json_line + '\n')
-
-            outfile.write(']}')
-        output_files.append(output_filename)
-
-    # Create a tar.gz archive of the output files
-    tar_filename = f"{input_filename.split('.')[0]}_split.tar.gz"
-    with tarfile.open(tar_filename, 'w:gz') as tar:
-        for output_file in tqdm(output_files, desc="Creating tar.gz", unit="file"):
-            tar.add(output_file)
-    # Remove the individual JSON files after compression
-    for output_file in output_files:
-        os.remove(output_file)
-
-    print(f"Splitting completed. The traceEvents have been compressed into {tar_filename}.")
+def split_trace_events(input_filename, num_chunks, memory_mb=DEFAULT_MEMORY_MB, tmp_dir=None,
+                       compression="gzip", compress_level=None, jobs=None, archive=True, shard_duration=None, shard_by=None):
+    input_size = os.path.getsize(input_filename)
+    output_prefix = os.path.splitext(input_filename[:-3] if input_filename.endswith(".gz") else input_filename)[0]
+    tmp_dir = tempfile.mkdtemp(prefix="split_json_", dir=tmp_dir or os.path.dirname(os.path.abspath(input_filename)))
+    try:
+        tic = time.perf_counter()
+        headers, total_events, num_runs, events = sort_trace_events(input_filename, memory_mb * 1024 ** 2, tmp_dir)
+        parse_time = time.perf_counter() - tic
+        print(f"Parsed {input_size / 1024 ** 2:.1f} MB in {parse_time:.1f} seconds ({input_size / 1024 ** 2 / max(parse_time, 1e-9):.1f} MB/s), {total_events} events in {num_runs} sorted runs")
+
+        # Calculate the number of events per chunk; the first few chunks get an extra event
+        chunk_size = total_events // num_chunks
+        remainder = total_events % num_chunks
+        chunk_counts = [chunk_size + (1 if i < remainder else 0) for i in range(num_chunks)]
+        shard_us = int(shard_duration * 1000000) if shard_duration else None
+
+        # Merge the runs straight into the chunks, which are compressed in parallel as they are written.
+        # Each chunk gets the header information first, then each traceEvent on its own line
+        tic = time.perf_counter()
+        tar_filename = f"{output_prefix}_split.tar" if archive else None
+        sink = ChunkWriter(compression, compress_level, jobs, tar_filename)
+        records = tqdm(events, total=total_events, desc="Writing JSON files", unit=" events", mininterval=1)
+        if shard_by:
+            trace_chunks = write_keyed_chunks(headers, records, output_prefix, sink, by_tid=shard_by == "tid", shard_us=shard_us)
+        else:
+            trace_chunks = write_trace_chunks(headers, records, output_prefix, sink, chunk_counts=None if shard_us else chunk_counts, shard_us=shard_us)
+        chunks = sink.close()
+        write_manifest(manifest_path(output_prefix), sink, trace_chunks, chunks, source=os.path.basename(input_filename), shard_duration_us=shard_us, shard_by=shard_by)
+        write_time = time.perf_counter() - tic
+        output_bytes = sum(chunk.raw_bytes for chunk in chunks)
+        print(f"Merged, compressed and wrote {output_bytes / 1024 ** 2:.1f} MB in {write_time:.1f} seconds ({output_bytes / 1024 ** 2 / max(write_time, 1e-9):.1f} MB/s)")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    size = sum(chunk.size for chunk in chunks)
+    print(f"Splitting completed. The traceEvents have been compressed to {size / 1024 ** 2:.1f} MB "
+          + (f"in {tar_filename}." if tar_filename else f"in {output_prefix}_*.json{sink.suffix}.")
+          + f" Manifest: {manifest_path(output_prefix)}")
 
 # Main execution block
 if __name__ == "__main__":
     # Set up argument parser
     parser = argparse.ArgumentParser(description="Split traceEvents from a JSON file into a specified number of parts and compress the output.")
-    parser.add_argument("input_filename", help="The JSON file containing traceEvents to be split.")
+    parser.add_argument("input_filename", help="The JSON file containing traceEvents to be split (.json or .json.gz).")
     parser.add_argument("--num-chunks", type=int, help="Number of chunks to split the traceEvents into.")
+    parser.add_argument("--shard-by", choices=["pid", "tid"], help="Write one trace per pid (or per pid and tid) covering the whole run, optionally cut by --shard-duration.")
+    parser.add_argument("--shard-duration", type=float, help="Split into fixed-duration time shards of this many seconds instead of a number of chunks.")
+    parser.add_argument("--memory-mb", type=int, default=DEFAULT_MEMORY_MB, help="Memory budget for buffered events; larger traces are sorted in spilled runs (default: %(default)s).")
+    parser.add_argument("--tmp-dir", type=str, help="Directory for the spilled runs (default: next to the input).")
+    parser.add_argument("--compression", choices=COMPRESSIONS, default="gzip", help="Compression of each chunk (default: %(default)s).")
+    parser.add_argument("--compress-level", type=int, help="Compression level (default: 6 for gzip, 3 for zstd).")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Compression threads (default: %(default)s).")
+    parser.add_argument("--no-archive", action="store_true", help="Write each chunk to its own compressed file instead of one tar archive.")
 
     # Parse arguments
     args = parser.parse_args()
@@ -94,5 +264,5 @@ if __name__ == "__main__":
         args.num_chunks = calculate_default_chunks(args.input_filename)
 
     # Call the split function with the provided input filename and number of chunks
-    split_trace_events(args.input_filename, args.num_chunks)
-
+    split_trace_events(args.input_filename, args.num_chunks, args.memory_mb, args.tmp_dir,
+                       args.compression, args.compress_level, args.jobs, not args.no_archive, args.shard_duration, args.shard_by)
@@ -0,0 +1,162 @@
+#
+# Cross-GPU straggler and collective-wait analysis of an rpd file
+#
+# Every rank of a tensor-parallel job runs the same sequence of collectives, so
+# the k-th collective kernel on each GPU is the same sync point.  A collective
+# cannot complete before its last rank arrives, so the time an early rank spends
+# inside it up to the last arrival is waiting, not communication.  Lining the
+# sync points up tells a slow rank (the one that keeps arriving last) apart
+# from the ranks that only look slow because they wait for it.
+#
+
+import argparse
+import numpy as np
+import pandas as pd
+
+from rpd_db import connect_readonly, load_strings
+from kernel_categories import KernelClassifier, load_ops
+
+
+def load_timed_ops(connection, strings, classifier):
+    """
+    Every op with its gpuId, start, end (ns), name, whether it is a collective
+    and the UserMarker phase it was launched in, sorted by gpuId and start.
+    """
+    ops = load_ops(connection, strings, "o.start, o.end")
+    codes, name_ids = pd.factorize(ops["name_id"])
+    names = np.array([strings[id] for id in name_ids.tolist()], dtype=object)
+    ops["name"] = names[codes]
+    ops["collective"] = np.array([classifier.category(name) == "collective" for name in names], dtype=bool)[codes]
+    return ops.sort_values(["gpuId", "start"], kind="stable").reset_index(drop=True)[["gpuId", "start", "end", "collective", "phase", "name"]]
+
+
+def align_collectives(ops):
+    """
+    (gpu_ids, starts, ends, names, phases) of the collectives of every GPU lined up
+    as sync points: starts/ends have shape (gpus, steps), the k-th collective of
+    each GPU in column k.  GPUs with more collectives than the others are cut to
+    the common count.
+    """
+    collectives = ops[ops["collective"]]
+    gpu_ids = sorted(ops["gpuId"].unique().tolist())
+    groups = [collectives[collectives["gpuId"] == gpu_id] for gpu_id in gpu_ids]
+    counts = [len(group) for group in groups]
+    steps = min(counts) if counts else 0
+    if counts and max(counts) != steps:
+        print(f"Warning: collective counts differ between GPUs ({dict(zip(gpu_ids, counts))}), aligning the first {steps}")
+    starts = np.array([group["start"].to_numpy()[:steps] for group in groups], dtype=np.int64).reshape(len(gpu_ids), steps)
+    ends = np.array([group["end"].to_numpy()[:steps] for group in groups], dtype=np.int64).reshape(len(gpu_ids), steps)
+    reference = groups[0] if groups else collectives
+    return gpu_ids, starts, ends, reference["name"].to_numpy()[:steps], reference["phase"].to_numpy()[:steps]
+
+
+def segment_busy_time(ops, gpu_ids, ends):
+    """
+    Busy time (ns) of the non-collective ops of each GPU in each step, shape
+    (gpus, steps).  Step k holds the ops starting after collective k-1 ended, up
+    to the end of collective k; ops after the last collective are left out.
+    """
+    steps = ends.shape[1]
+    busy = np.zeros((len(gpu_ids), steps), dtype=np.int64)
+    compute = ops[~ops["collective"]]
+    for row, gpu_id in enumerate(gpu_ids):
+        gpu = compute[compute["gpuId"] == gpu_id]
+        step = np.searchsorted(ends[row], gpu["start"].to_numpy(), side="left")
+        inside = step < steps
+        busy[row] = np.bincount(step[inside], weights=(gpu["end"] - gpu["start"]).to_numpy()[inside], minlength=steps)[:steps]
+    return busy
+
+
+def straggler_analysis(ops):
+    """
+    Per-step and per-rank tables of the collective sync points in ops (see load_timed_ops).
+
+    Per step: the collective, its phase, when the first and last rank arrived,
+    the arrival skew, the last rank (the straggler) and the longest wait.
+    Per rank: time in collectives, the part of it spent waiting for the last
+    arrival, how often the rank arrived last and by how much it trailed the
+    first arrival on average, and its non-collective busy time.
+    All times in us.
+    """
+    gpu_ids, starts, ends, names, phases = align_collectives(ops)
+    if starts.shape[1] == 0:
+        return pd.DataFrame(), pd.DataFrame()
+
+    first = starts.min(axis=0)
+    last = starts.max(axis=0)
+    straggler = np.asarray(gpu_ids)[starts.argmax(axis=0)]
+    # Time inside the collective before the last rank arrived, capped at the collective itself
+    waits = np.clip(last - starts, 0, ends - starts)
+    lateness = starts - first
+    busy = segment_busy_time(ops, gpu_ids, ends)
+
+    steps = pd.DataFrame({
+        "step": np.arange(starts.shape[1]),
+        "phase": phases,
+        "collective": names,
+        "first_arrival_us": first / 1000,
+        "last_arrival_us": last / 1000,
+        "skew_us": (last - first) / 1000,
+        "straggler_gpuId": straggler,
+        "max_wait_us": waits.max(axis=0) / 1000,
+        "total_wait_us": waits.sum(axis=0) / 1000,
+        "max_busy_us": busy.max(axis=0) / 1000,
+        "min_busy_us": busy.min(axis=0) / 1000,
+    })
+
+    collective_time = (ends - starts).sum(axis=1)
+    last_counts = np.array([(straggler == gpu_id).sum() for gpu_id in gpu_ids])
+    ranks = pd.DataFrame({
+        "gpuId": gpu_ids,
+        "collectives": starts.shape[1],
+        "collective_us": collective_time / 1000,
+        "wait_us": waits.sum(axis=1) / 1000,
+        "wait_pct_of_collective": np.round(waits.sum(axis=1) / np.maximum(collective_time, 1) * 100, 2),
+        "arrived_last": last_counts,
+        "arrived_last_pct": np.round(last_counts / starts.shape[1] * 100, 2),
+        "mean_lateness_us": lateness.mean(axis=1) / 1000,
+        "busy_us": busy.sum(axis=1) / 1000,
+    })
+    return steps, ranks
+
+
+def phase_summary(steps):
+    """Skew and wait statistics of the steps of each phase."""
+    grouped = steps.groupby("phase")
+    summary = grouped.agg(steps=("step", "count"), mean_skew_us=("skew_us", "mean"), p90_skew_us=("skew_us", lambda x: x.quantile(0.9)),
+                          max_skew_us=("skew_us", "max"), total_wait_us=("total_wait_us", "sum"))
+    summary["top_straggler_gpuId"] = grouped["straggler_gpuId"].agg(lambda x: x.value_counts().idxmax())
+    return summary.reset_index()
+
+
+def load_straggler_tables(rpd_path, classifier=None):
+    """(steps, ranks, phases) tables of an rpd file."""
+    connection = connect_readonly(rpd_path)
+    ops = load_timed_ops(connection, load_strings(rpd_path, connection), classifier or KernelClassifier())
+    connection.close()
+    steps, ranks = straggler_analysis(ops)
+    return steps, ranks, phase_summary(steps) if len(steps) else pd.DataFrame()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Line up the collectives of all GPUs and report arrival skew and collective waits per step and per rank.")
+    parser.add_argument("input_rpd", help="The .rpd file to analyze.")
+    parser.add_argument("--rules", action="append", default=[], help="Kernel category rule file; kernels classified as 'collective' are the sync points (repeatable).")
+    parser.add_argument("--output-prefix", type=str, help="Write <prefix>_steps.csv, <prefix>_ranks.csv and <prefix>_phases.csv.")
+    parser.add_argument("--worst", type=int, default=10, help="Number of most skewed steps to print (default: %(default)s).")
+    args = parser.parse_args()
+
+    steps, ranks, phases = load_straggler_tables(args.input_rpd, KernelClassifier(rule_files=args.rules))
+    if steps.empty:
+        raise SystemExit("No collective kernels found.")
+    with pd.option_context("display.width", 200, "display.max_columns", 20, "display.max_colwidth", 40):
+        print("Per rank:")
+        print(ranks.to_string(index=False))
+        print("\nPer phase:")
+        print(phases.to_string(index=False))
+        print(f"\n{args.worst} most skewed steps:")
+        print(steps.sort_values("skew_us", ascending=False).head(args.worst).to_string(index=False))
+    if args.output_prefix:
+        for name, table in (("steps", steps), ("ranks", ranks), ("phases", phases)):
+            table.to_csv(f"{args.output_prefix}_{name}.csv", index=False)
+        print(f"Tables written to {args.output_prefix}_*.csv")
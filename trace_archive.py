@@ -0,0 +1,402 @@
+#
+# Parallel, temp-file-free compression of trace chunks
+#
+# Chunk text is cut into blocks that are compressed in a thread pool (zlib and
+# zstd release the GIL) and written in order as soon as they are ready.  Every
+# block is a complete gzip member / zstd frame; concatenated members are a
+# valid .gz / .zst stream, so a chunk never exists uncompressed on disk.
+#
+# Chunks go either to their own compressed files or into one tar archive.  A
+# tar member header needs the member size up front, so the archive writes a
+# placeholder header, streams the compressed blocks after it and patches the
+# header when the member is closed.
+#
+# Every chunk is a complete {"traceEvents": [...]} trace.  A manifest next to
+# the output records each chunk's time range, event count, pids (GPU ids for
+# rpd conversions) and byte offset, so a time window can be pulled out of the
+# archive without decompressing the other chunks.
+#
+
+import os
+import io
+import re
+import gzip
+import json
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Characters of chunk text compressed per block
+DEFAULT_BLOCK_SIZE = 8 * 1024 ** 2
+
+COMPRESSIONS = ("gzip", "zstd", "none")
+SUFFIXES = {"gzip": ".gz", "zstd": ".zst", "none": ""}
+
+# name: file or archive member name
+# offset: byte offset of the member data in the archive (0 for separate files)
+# raw_bytes, size: uncompressed and compressed size
+ChunkInfo = namedtuple("ChunkInfo", ["name", "offset", "raw_bytes", "size"])
+
+
+class BlockCompressor:
+    """Compress one block into a self-contained gzip member or zstd frame."""
+
+    def __init__(self, compression="gzip", level=None):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression}")
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("zstd compression needs the zstandard package (pip install zstandard)")
+        self.compression = compression
+        self.level = level
+        self.local = threading.local()
+
+    def __call__(self, data):
+        if self.compression == "gzip":
+            return gzip.compress(data, compresslevel=6 if self.level is None else self.level, mtime=0)
+        if self.compression == "zstd":
+            # Compressor objects are not thread safe
+            compressor = getattr(self.local, "compressor", None)
+            if compressor is None:
+                compressor = self.local.compressor = zstandard.ZstdCompressor(level=3 if self.level is None else self.level)
+            return compressor.compress(data)
+        return data
+
+
+class Chunk:
+    """One chunk being written.  Text goes in with write(); close() returns its ChunkInfo,
+    or None for a spooled chunk still waiting for its turn in the archive."""
+
+    def __init__(self, writer, name, out, offset=0):
+        self.writer = writer
+        self.name = name
+        self.out = out
+        self.offset = offset
+        self.text = []
+        self.text_size = 0
+        self.pending = deque()
+        self.raw_bytes = 0
+        self.size = 0
+
+    def write(self, text):
+        self.text.append(text)
+        self.text_size += len(text)
+        if self.text_size >= self.writer.block_size:
+            self._submit()
+
+    def _submit(self):
+        data = "".join(self.text).encode("utf-8")
+        self.text = []
+        self.text_size = 0
+        self.raw_bytes += len(data)
+        self.pending.append(self.writer.executor.submit(self.writer.compress, data))
+        # Keep a bounded number of blocks in flight; write finished ones in order
+        while self.pending and (len(self.pending) > self.writer.max_pending or self.pending[0].done()):
+            self._write(self.pending.popleft().result())
+
+    def _write(self, block):
+        self.out.write(block)
+        self.size += len(block)
+
+    def close(self):
+        if self.text:
+            self._submit()
+        while self.pending:
+            self._write(self.pending.popleft().result())
+        return self.writer._close_chunk(self)
+
+
+class ChunkWriter:
+    """
+    Compress chunks in parallel into per-chunk files, or into one tar archive
+    when archive is a path.  Chunk names get the compression suffix.
+    """
+
+    def __init__(self, compression="gzip", level=None, jobs=None, archive=None, block_size=DEFAULT_BLOCK_SIZE):
+        self.compress = BlockCompressor(compression, level)
+        self.suffix = SUFFIXES[compression]
+        self.jobs = jobs or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self.max_pending = 2 * self.jobs
+        self.block_size = block_size
+        self.archive_path = archive
+        self.archive = open(archive, 'wb') if archive else None
+        self.active = None      # chunk streaming straight into the archive
+        self.spooled = []       # closed chunks waiting for the archive, (name, file, raw_bytes)
+        self.chunks = []        # ChunkInfo of every closed chunk, in archive order
+
+    def open(self, name):
+        name += self.suffix
+        if self.archive is None:
+            return Chunk(self, name, open(name, 'wb'))
+        if self.active is None:
+            # Placeholder header, same length as the final one
+            offset = self.archive.tell() + len(self._header(name, 0))
+            self.archive.write(self._header(name, 0))
+            self.active = Chunk(self, name, self.archive, offset)
+            return self.active
+        # Another chunk is streaming into the archive; spool this one compressed
+        return Chunk(self, name, tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.archive_path))))
+
+    @staticmethod
+    def _header(name, size):
+        info = tarfile.TarInfo(os.path.basename(name))
+        info.size = size
+        info.mode = 0o644
+        info.mtime = int(time.time())
+        return info.tobuf(format=tarfile.GNU_FORMAT)
+
+    def _end_member(self, size):
+        self.archive.write(b"\0" * (-size % tarfile.BLOCKSIZE))
+
+    def _close_chunk(self, chunk):
+        if self.archive is None:
+            chunk.out.close()
+            info = ChunkInfo(chunk.name, 0, chunk.raw_bytes, chunk.size)
+            self.chunks.append(info)
+            return info
+        if chunk is not self.active:
+            self.spooled.append((chunk.name, chunk.out, chunk.raw_bytes))
+            self._drain_spooled()
+            return None
+        header = self._header(chunk.name, chunk.size)
+        self.archive.seek(chunk.offset - len(header))
+        self.archive.write(header)
+        self.archive.seek(0, os.SEEK_END)
+        self._end_member(chunk.size)
+        self.active = None
+        info = ChunkInfo(chunk.name, chunk.offset, chunk.raw_bytes, chunk.size)
+        self.chunks.append(info)
+        self._drain_spooled()
+        return info
+
+    def _drain_spooled(self):
+        while self.spooled and self.active is None:
+            name, spool, raw_bytes = self.spooled.pop(0)
+            size = spool.tell()
+            spool.seek(0)
+            header = self._header(name, size)
+            self.archive.write(header)
+            offset = self.archive.tell()
+            while True:
+                data = spool.read(16 << 20)
+                if not data:
+                    break
+                self.archive.write(data)
+            spool.close()
+            self._end_member(size)
+            self.chunks.append(ChunkInfo(name, offset, raw_bytes, size))
+
+    def close(self):
+        self.executor.shutdown()
+        if self.archive is not None:
+            self._drain_spooled()
+            # End of archive: two zero blocks, padded to a full record
+            self.archive.write(b"\0" * (2 * tarfile.BLOCKSIZE))
+            self.archive.write(b"\0" * (-self.archive.tell() % tarfile.RECORDSIZE))
+            self.archive.close()
+        return self.chunks
+
+
+class TraceChunk:
+    """
+    A complete trace written into a Chunk: the header events, then one event per
+    add() call.  Keeps the time range, event count and pids for the manifest.
+    Times are in the trace's ts unit (us).
+    """
+
+    def __init__(self, chunk, headers, window=None):
+        self.chunk = chunk
+        self.name = chunk.name
+        self.window = window
+        opening = '{"traceEvents":[\n' + ",\n".join(headers)
+        chunk.write(opening)
+        self.size = len(opening)
+        self.separator = ",\n" if headers else ""
+        self.events = 0
+        self.first_ts = None
+        self.last_ts = None
+        self.max_end = None
+        self.pids = set()
+
+    def add(self, ts, end, pid, tid, event):
+        self.chunk.write(self.separator)
+        self.chunk.write(event)
+        self.size += len(event) + len(self.separator)
+        self.separator = ",\n"
+        if self.first_ts is None:
+            self.first_ts = ts
+            self.max_end = end
+        self.last_ts = ts
+        if end > self.max_end:
+            self.max_end = end
+        self.pids.add(pid)
+        self.events += 1
+
+    def close(self):
+        self.chunk.write("\n]}")
+        self.chunk.close()
+
+    def entry(self, info):
+        entry = {"name": info.name, "offset": info.offset, "size": info.size, "raw_bytes": info.raw_bytes,
+                 "events": self.events, "first_ts": self.first_ts, "last_ts": self.last_ts, "max_end": self.max_end,
+                 "pids": sorted((pid for pid in self.pids if pid is not None), key=str)}
+        if self.window is not None:
+            entry["window"] = list(self.window)
+        return entry
+
+
+def write_trace_chunks(headers, records, output_prefix, sink, chunk_bytes=None, chunk_counts=None, shard_us=None):
+    """
+    Write (ts, end, pid, tid, event) records, sorted by ts, into numbered chunks of sink
+    as they stream in.  A new chunk starts
+      - with shard_us, whenever an event falls into the next fixed-duration time
+        shard (shards are aligned to multiples of shard_us; empty ones are skipped)
+      - with chunk_counts, after chunk_counts[i] events in chunk i
+      - otherwise once the chunk holds chunk_bytes of JSON.
+    Returns the TraceChunks in order.
+    """
+    chunks = []
+    chunk = None
+    shard = first_shard = None
+    for ts, end, pid, tid, event in records:
+        if shard_us:
+            index = int(ts // shard_us)
+            if chunk is not None and index != shard:
+                chunk.close()
+                chunk = None
+            shard = index
+        if chunk is None:
+            if shard_us:
+                if first_shard is None:
+                    first_shard = shard
+                chunk = TraceChunk(sink.open(f"{output_prefix}_shard_{shard - first_shard + 1}.json"), headers,
+                                   (shard * shard_us, (shard + 1) * shard_us))
+            else:
+                chunk = TraceChunk(sink.open(f"{output_prefix}_split_{len(chunks) + 1}.json"), headers)
+            chunks.append(chunk)
+        chunk.add(ts, end, pid, tid, event)
+        if shard_us:
+            continue
+        if chunk_counts is not None:
+            if chunk.events >= chunk_counts[len(chunks) - 1]:
+                chunk.close()
+                chunk = None
+        elif chunk.size >= chunk_bytes:
+            chunk.close()
+            chunk = None
+    if chunk is not None:
+        chunk.close()
+    # Always leave at least one (valid, possibly event-less) trace
+    if chunk_counts is not None:
+        while len(chunks) < len(chunk_counts):
+            chunks.append(TraceChunk(sink.open(f"{output_prefix}_split_{len(chunks) + 1}.json"), headers))
+            chunks[-1].close()
+    elif not chunks:
+        chunks.append(TraceChunk(sink.open(f"{output_prefix}_split_1.json"), headers))
+        chunks[-1].close()
+    return chunks
+
+
+def write_keyed_chunks(headers, records, output_prefix, sink, by_tid=False, labels=("pid", "tid"), shard_us=None):
+    """
+    Write (ts, end, pid, tid, event) records, sorted by ts, into one trace per pid
+    (per pid and tid with by_tid), each covering the whole run, or cut into
+    fixed-duration time shards with shard_us.  A shard gets the header events
+    of its own pid plus those without a pid, so it opens with the right
+    process and thread names.  labels name the pid and tid in file names.
+    Returns the TraceChunks in the order they were started.
+    """
+    header_pids = [json.loads(header).get("pid") for header in headers]
+    open_chunks = {}    # key -> (time shard, TraceChunk)
+    first_shard = None
+    chunks = []
+    for ts, end, pid, tid, event in records:
+        key = (pid, tid) if by_tid else pid
+        shard = int(ts // shard_us) if shard_us else 0
+        current = open_chunks.get(key)
+        if current is not None and current[0] != shard:
+            current[1].close()
+            current = None
+        if current is None:
+            name = f"{output_prefix}_{labels[0]}{_file_label(pid)}"
+            if by_tid:
+                name += f"_{labels[1]}{_file_label(tid)}"
+            window = None
+            if shard_us:
+                if first_shard is None:
+                    first_shard = shard
+                name += f"_shard_{shard - first_shard + 1}"
+                window = (shard * shard_us, (shard + 1) * shard_us)
+            chunk = TraceChunk(sink.open(name + ".json"), [header for header, header_pid in zip(headers, header_pids)
+                                                           if header_pid is None or header_pid == pid], window)
+            current = open_chunks[key] = (shard, chunk)
+            chunks.append(chunk)
+        current[1].add(ts, end, pid, tid, event)
+    for shard, chunk in open_chunks.values():
+        chunk.close()
+    return chunks
+
+
+def _file_label(value):
+    return re.sub(r"[^\w.-]", "_", str(value))
+
+
+def manifest_path(output_prefix):
+    return f"{output_prefix}_split.manifest.json"
+
+
+def write_manifest(path, sink, chunks, infos, **metadata):
+    """Record every chunk with its archive location next to the output."""
+    location = {info.name: info for info in infos}
+    manifest = {"archive": os.path.basename(sink.archive_path) if sink.archive_path else None,
+                "compression": sink.compress.compression, "ts_unit": "us"}
+    manifest.update(metadata)
+    manifest["shards"] = [chunk.entry(location[chunk.name]) for chunk in chunks]
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def read_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def select_shards(manifest, start=None, end=None, pid=None):
+    """Shards holding an event that overlaps [start, end] (us), optionally only those with events of pid."""
+    return [shard for shard in manifest["shards"] if shard["events"] and
+            (end is None or shard["first_ts"] <= end) and (start is None or shard["max_end"] >= start) and
+            (pid is None or pid in map(str, shard["pids"]))]
+
+
+def extract_shard(manifest, manifest_dir, shard, outfile, decompress=False):
+    """
+    Copy one shard to outfile, reading only its bytes from the archive.
+    With decompress the shard is written as plain JSON.
+    """
+    if manifest["archive"]:
+        with open(os.path.join(manifest_dir, manifest["archive"]), 'rb') as archive:
+            archive.seek(shard["offset"])
+            data = archive.read(shard["size"])
+    else:
+        with open(os.path.join(manifest_dir, os.path.basename(shard["name"])), 'rb') as f:
+            data = f.read()
+    if decompress and manifest["compression"] == "gzip":
+        with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+            shutil.copyfileobj(f, outfile, 16 << 20)
+    elif decompress and manifest["compression"] == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd shards need the zstandard package (pip install zstandard)")
+        with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True) as f:
+            shutil.copyfileobj(f, outfile, 16 << 20)
+    else:
+        outfile.write(data)
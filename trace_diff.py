@@ -0,0 +1,141 @@
+#
+# A/B diff of rpd traces per normalized kernel and category
+#
+# Kernels are matched across traces by their normalized name (see
+# kernel_categories.py), so template or tile changes between builds still line
+# up.  Per-kernel totals come from the cached kernel summary; the per-invocation
+# durations are bootstrapped to tell a real change of a kernel's mean duration
+# apart from run-to-run noise.  The first trace is the baseline.
+#
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from rpd_db import connect_readonly, load_strings
+from kernel_summary import KERNEL_QUERY, kernel_summary
+from kernel_categories import KernelClassifier
+
+# Bootstrap resamples per kernel
+DEFAULT_RESAMPLES = 1000
+
+# Invocations per kernel and trace used for the bootstrap; longer series are subsampled
+DEFAULT_MAX_SAMPLES = 5000
+
+
+def load_kernel_totals(rpd_path, classifier):
+    """Calls and total duration (ns) per normalized kernel name, with its category."""
+    summary = classifier.annotate(kernel_summary(rpd_path))
+    totals = summary.groupby(["category", "normalizedName"])[["call_count", "total_duration"]].sum()
+    return totals
+
+
+def load_durations(rpd_path, classifier):
+    """Per-invocation durations (ns) of every kernel, as {normalized name: array}, all GPUs pooled."""
+    connection = connect_readonly(rpd_path)
+    strings = load_strings(rpd_path, connection)
+    rows = pd.read_sql_query(KERNEL_QUERY, connection)
+    connection.close()
+    rows.columns = ["gpuId", "name_id", "duration"]
+    codes, name_ids = pd.factorize(rows["name_id"])
+    names = np.array([classifier.normalize(strings[id]) for id in name_ids.tolist()], dtype=object)
+    return {name: group.to_numpy() for name, group in rows["duration"].groupby(names[codes])}
+
+
+def load_trace(rpd_path, classifier):
+    """(kernel totals, per-kernel durations) of one trace, as taken by diff_traces."""
+    return load_kernel_totals(rpd_path, classifier), load_durations(rpd_path, classifier)
+
+
+def bootstrap_mean_change(baseline, candidate, resamples, max_samples, rng, confidence=0.95):
+    """
+    Bootstrap confidence interval of the relative change (%) of the mean duration
+    from baseline to candidate.  Resamples both series with replacement, all
+    resamples of a series in one vectorized draw.
+    """
+    def subsample(values):
+        if len(values) > max_samples:
+            return rng.choice(values, max_samples, replace=False)
+        return values
+
+    baseline, candidate = subsample(baseline).astype(np.float64), subsample(candidate).astype(np.float64)
+    baseline_means = baseline[rng.integers(0, len(baseline), (resamples, len(baseline)))].mean(axis=1)
+    candidate_means = candidate[rng.integers(0, len(candidate), (resamples, len(candidate)))].mean(axis=1)
+    changes = (candidate_means - baseline_means) / np.maximum(baseline_means, 1e-9) * 100
+    alpha = (1 - confidence) / 2
+    return np.quantile(changes, alpha), np.quantile(changes, 1 - alpha)
+
+
+def diff_traces(baseline, candidate, resamples=DEFAULT_RESAMPLES, max_samples=DEFAULT_MAX_SAMPLES,
+                min_change=1.0, seed=0):
+    """
+    Per-kernel and per-category diff of candidate against baseline, both from
+    load_trace so a baseline is loaded once for any number of candidates.
+    A kernel's change is flagged significant when the bootstrap CI of its mean
+    duration change excludes 0 and the change is at least min_change percent.
+    Kernels present in only one trace are reported with their whole time as the delta.
+    Times in us.
+    """
+    rng = np.random.default_rng(seed)
+    (totals_a, durations_a), (totals_b, durations_b) = baseline, candidate
+    totals = totals_a.join(totals_b, how="outer", lsuffix="_a", rsuffix="_b").fillna(0)
+
+    kernels = totals.reset_index()
+    kernels[["call_count_a", "call_count_b"]] = kernels[["call_count_a", "call_count_b"]].astype(np.int64)
+    kernels["total_a_us"] = kernels.pop("total_duration_a") / 1000
+    kernels["total_b_us"] = kernels.pop("total_duration_b") / 1000
+    kernels["delta_us"] = kernels["total_b_us"] - kernels["total_a_us"]
+    kernels["mean_a_us"] = kernels["total_a_us"] / kernels["call_count_a"].where(kernels["call_count_a"] > 0)
+    kernels["mean_b_us"] = kernels["total_b_us"] / kernels["call_count_b"].where(kernels["call_count_b"] > 0)
+    kernels["mean_change_pct"] = (kernels["mean_b_us"] / kernels["mean_a_us"] - 1) * 100
+
+    intervals = []
+    for name in kernels["normalizedName"]:
+        a, b = durations_a.get(name), durations_b.get(name)
+        if a is None or b is None or len(a) < 2 or len(b) < 2:
+            intervals.append((np.nan, np.nan))
+        else:
+            intervals.append(bootstrap_mean_change(a, b, resamples, max_samples, rng))
+    kernels["ci_low_pct"], kernels["ci_high_pct"] = np.array(intervals, dtype=np.float64).reshape(-1, 2).T
+    excludes_zero = (kernels["ci_low_pct"] > 0) | (kernels["ci_high_pct"] < 0)
+    kernels["significant"] = np.where(kernels["ci_low_pct"].isna(), "n/a",
+                                      np.where(excludes_zero & (kernels["mean_change_pct"].abs() >= min_change), "yes", "no"))
+    kernels.loc[(kernels["call_count_a"] == 0) | (kernels["call_count_b"] == 0), "significant"] = "only in one trace"
+    kernels = kernels.reindex(kernels["delta_us"].abs().sort_values(ascending=False).index).reset_index(drop=True)
+
+    categories = kernels.groupby("category")[["total_a_us", "total_b_us", "delta_us"]].sum()
+    categories["delta_pct"] = (categories["delta_us"] / categories["total_a_us"].where(categories["total_a_us"] != 0) * 100).round(2)
+    categories = categories.reindex(categories["delta_us"].abs().sort_values(ascending=False).index).reset_index()
+    return kernels, categories
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Diff the kernel time of rpd traces against the first one, per normalized kernel and category.")
+    parser.add_argument("traces", nargs="+", help="Baseline .rpd file followed by one or more candidates.")
+    parser.add_argument("--rules", action="append", default=[], help="Kernel category rule file (repeatable).")
+    parser.add_argument("--resamples", type=int, default=DEFAULT_RESAMPLES, help="Bootstrap resamples per kernel (default: %(default)s).")
+    parser.add_argument("--max-samples", type=int, default=DEFAULT_MAX_SAMPLES, help="Invocations per kernel used for the bootstrap (default: %(default)s).")
+    parser.add_argument("--min-change", type=float, default=1.0, help="Smallest mean-duration change in %% flagged as significant (default: %(default)s).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the bootstrap (default: %(default)s).")
+    parser.add_argument("--top", type=int, default=20, help="Number of kernels to print per diff (default: %(default)s).")
+    parser.add_argument("--output-prefix", type=str, help="Write <prefix>_<candidate>_kernels.csv and _categories.csv per candidate.")
+    args = parser.parse_args()
+
+    if len(args.traces) < 2:
+        parser.error("need a baseline and at least one candidate trace")
+    classifier = KernelClassifier(rule_files=args.rules)
+    baseline = args.traces[0]
+    baseline_trace = load_trace(baseline, classifier)
+    for candidate in args.traces[1:]:
+        kernels, categories = diff_traces(baseline_trace, load_trace(candidate, classifier), args.resamples, args.max_samples, args.min_change, args.seed)
+        with pd.option_context("display.width", 220, "display.max_columns", 20, "display.max_colwidth", 50):
+            print(f"\n{candidate} vs {baseline}")
+            print(categories.to_string(index=False))
+            print()
+            print(kernels.head(args.top).to_string(index=False))
+        if args.output_prefix:
+            label = os.path.splitext(os.path.basename(candidate))[0]
+            kernels.to_csv(f"{args.output_prefix}_{label}_kernels.csv", index=False)
+            categories.to_csv(f"{args.output_prefix}_{label}_categories.csv", index=False)
+            print(f"Diff written to {args.output_prefix}_{label}_*.csv")